@@ -0,0 +1,175 @@
+"""Table of the addresses seen by the pipeline, mapping each 20 byte address to a dense int32 ID.
+
+Transfers, balances and donations are kept as IDs from the moment transfers are
+cached and addresses are turned back into hex strings only when results are
+written. The table is append-only, so IDs stay valid across runs, and its file
+starts with a random table id that caches referring to IDs record to detect a
+table that was deleted and rebuilt.
+
+File layout: magic, 8 byte table id, then 20 bytes per address in ID order.
+"""
+import os
+
+import numpy as np
+
+ADDRESS_TABLE_FILE_NAME = 'addresses.bin'
+MAGIC = b'AIRDADR1'
+ADDRESS_SIZE = 20
+ADDRESS_DTYPE = np.dtype('V%s' % ADDRESS_SIZE)
+# the same 20 bytes as sortable strings, numpy ignores trailing NULs when comparing
+# `S` values but all addresses have the same length so the order is the byte order
+ADDRESS_KEY_DTYPE = np.dtype('S%s' % ADDRESS_SIZE)
+# the same 20 bytes as big-endian words, sorting on them sorts the addresses
+ADDRESS_WORDS_DTYPE = np.dtype([('prefix', '>u8'), ('middle', '>u8'), ('suffix', '>u4')])
+
+
+def get_address_table_path(save_path):
+    return os.path.join(save_path, ADDRESS_TABLE_FILE_NAME)
+
+
+def to_address_array(addresses):
+    """Array of 20 byte values of a list of hex address strings."""
+    return np.frombuffer(b''.join(bytes.fromhex(a[2:]) for a in addresses), dtype=ADDRESS_DTYPE)
+
+
+def address_strings(addresses):
+    """Lowercase `0x` hex strings of an array of 20 byte values."""
+    h = addresses.tobytes().hex()
+    n = 2 * ADDRESS_SIZE
+    return ['0x' + h[i:i + n] for i in range(0, len(h), n)]
+
+
+def unique_addresses(*address_arrays):
+    """Sorted unique addresses of all `address_arrays` and the index of each address in it.
+
+    Sorting 20 byte values with `np.unique` is slow, so addresses are sorted on their first
+    8 bytes as a uint64 and only the addresses sharing a prefix with a different address
+    (e.g. the zero address and the precompiles) are sorted again on all their bytes.
+
+    :return: (unique addresses, list of index arrays, one per input array)
+    """
+    sizes = [len(a) for a in address_arrays]
+    addresses = np.concatenate(address_arrays) if address_arrays else np.empty(0, dtype=ADDRESS_DTYPE)
+    if not len(addresses):
+        return addresses, [np.empty(0, dtype=np.int64) for _ in sizes]
+
+    words = addresses.view(ADDRESS_WORDS_DTYPE)
+    prefix = words['prefix'].astype(np.uint64)
+    middle = words['middle'].astype(np.uint64)
+    suffix = words['suffix'].astype(np.uint32)
+    order = np.argsort(prefix)
+    sorted_prefix = prefix[order]
+    is_new = _is_new_address(sorted_prefix, middle[order], suffix[order])
+    collisions = is_new[1:] & (sorted_prefix[1:] == sorted_prefix[:-1])
+    if np.any(collisions):
+        colliding = np.isin(sorted_prefix, sorted_prefix[1:][collisions])
+        subset = order[colliding]
+        order[colliding] = subset[np.lexsort((suffix[subset], middle[subset], prefix[subset]))]
+        is_new = _is_new_address(prefix[order], middle[order], suffix[order])
+
+    ids = np.empty(len(order), dtype=np.int64)
+    ids[order] = np.cumsum(is_new) - 1
+    table = addresses[order[is_new]]
+    return table, np.split(ids, np.cumsum(sizes)[:-1])
+
+
+def _is_new_address(prefix, middle, suffix):
+    is_new = np.empty(len(prefix), dtype=bool)
+    is_new[0] = True
+    is_new[1:] = (prefix[1:] != prefix[:-1]) | (middle[1:] != middle[:-1]) | (suffix[1:] != suffix[:-1])
+    return is_new
+
+
+class AddressTable:
+    def __init__(self, path=None):
+        """
+        :param path: file the table is loaded from and saved to, None for an in-memory table
+        """
+        self.path = path
+        self.table_id = os.urandom(8)
+        addresses = b''
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError('%s is not an address table file.' % path)
+            self.table_id = data[len(MAGIC):len(MAGIC) + 8]
+            addresses = data[len(MAGIC) + 8:]
+
+        # addresses by ID, and the IDs in address order for lookups
+        self._addresses = np.frombuffer(addresses, dtype=ADDRESS_DTYPE)
+        sorted_addresses, (ranks,) = unique_addresses(self._addresses)
+        self._sorted_keys = sorted_addresses.view(ADDRESS_KEY_DTYPE)
+        self._sorted_ids = np.empty(len(ranks), dtype=np.int32)
+        self._sorted_ids[ranks] = np.arange(len(ranks), dtype=np.int32)
+        self._saved = len(self._addresses) if path and os.path.exists(path) else 0
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def get_ids(self, addresses):
+        """IDs of an array of 20 byte addresses (or a list of hex strings), unknown addresses are added.
+
+        :return: int32 array
+        """
+        if not isinstance(addresses, np.ndarray):
+            addresses = to_address_array(addresses)
+        uniques, (inverse,) = unique_addresses(addresses)
+        keys = uniques.view(ADDRESS_KEY_DTYPE)
+        positions = np.searchsorted(self._sorted_keys, keys)
+        found = positions < len(self._sorted_keys)
+        found[found] = self._sorted_keys[positions[found]] == keys[found]
+
+        unique_ids = np.empty(len(uniques), dtype=np.int32)
+        unique_ids[found] = self._sorted_ids[positions[found]]
+        new = ~found
+        if np.any(new):
+            new_ids = np.arange(len(self._addresses), len(self._addresses) + np.count_nonzero(new), dtype=np.int32)
+            unique_ids[new] = new_ids
+            self._addresses = np.concatenate([self._addresses, uniques[new]])
+            # the unique addresses are sorted, so inserting them keeps the lookup index sorted
+            self._sorted_keys = np.insert(self._sorted_keys, positions[new], keys[new])
+            self._sorted_ids = np.insert(self._sorted_ids, positions[new], new_ids)
+
+        return unique_ids[inverse]
+
+    def get_id(self, address):
+        return int(self.get_ids([address])[0])
+
+    def find_id(self, address):
+        """ID of a hex address, None when it isn't in the table (it isn't added)."""
+        key = to_address_array([address]).view(ADDRESS_KEY_DTYPE)
+        position = int(np.searchsorted(self._sorted_keys, key)[0])
+        if position < len(self._sorted_keys) and self._sorted_keys[position] == key[0]:
+            return int(self._sorted_ids[position])
+        return None
+
+    def get_addresses(self, ids):
+        """Lowercase hex strings of an array of IDs."""
+        return address_strings(self._addresses[ids])
+
+    def get_address(self, _id):
+        return '0x' + self._addresses[_id].tobytes().hex()
+
+    def save(self):
+        """Append the addresses added since the table was loaded to its file."""
+        if not self.path or self._saved == len(self._addresses):
+            return
+
+        with open(self.path, 'ab') as f:
+            if self._saved == 0:
+                f.truncate(0)
+                f.write(MAGIC + self.table_id)
+            f.write(self._addresses[self._saved:].tobytes())
+        self._saved = len(self._addresses)
+
+
+_tables = {}
+
+
+def get_address_table(save_path):
+    """The address table of `save_path`, shared by all the steps of a run."""
+    path = get_address_table_path(save_path)
+    if path not in _tables:
+        _tables[path] = AddressTable(path)
+    return _tables[path]
@@ -11,12 +11,41 @@ from export_recipients import (
     get_ubeswap_users,
     get_moola_users,
     get_impact_market_info,
+    dispatch_community_event_logs,
     process_ube_token, process_moo_token, get_ubeswap_info, process_cUSD_token, process_celo_token, get_impact_market_beneficiaries)
-from events_helpers import get_imarket_communities
-from util import get_block_steps, get_start_block, get_target_block, set_envvars, initConnection, to_base_18
+from async_fetcher import AsyncLogFetcher
+from address_table import get_address_table
+from events_helpers import get_imarket_communities, set_pool_size
+from util import (
+    RPC_CACHE_CONFIRMATIONS, RPC_CACHE_PATH, RPC_HEDGE_PERCENTILE, get_block_steps, get_hedge_kwargs,
+    get_response_cache, get_start_block, get_target_block, init_worker, set_envvars, initConnection, to_base_18)
+from metrics import METRICS_DIR, MetricsReporter, format_report
+from response_cache import get_response_cache_path
+from sync_state import sync_chain
 from web3_instance import get_web3
 
-mp_pool = mp.Pool(mp.cpu_count()-2)
+_process_pool = None
+
+
+def get_process_pool(processes=None):
+    """The worker pool of the "process" fetcher, created on first use so nothing is forked at import
+    and the workers start with the connection settings of the config, see `init_worker`.
+
+    :param processes: number of workers, all cores but two by default
+    """
+    global _process_pool
+    if _process_pool is None:
+        processes = processes or max(1, mp.cpu_count() - 2)
+        _process_pool = mp.Pool(
+            processes, initializer=init_worker, initargs=(os.getenv('WEB3_NETWORK'), get_target_block()))
+        set_pool_size(_process_pool, processes)
+    return _process_pool
+
+
+def with_hex_addresses(address_table, id_values):
+    """Replace the address IDs of (ID, value) tuples with hex addresses."""
+    addresses = address_table.get_addresses([_id for _id, value in id_values])
+    return [(address, value) for address, (_id, value) in zip(addresses, id_values)]
 
 
 def main(config_file_path):
@@ -32,13 +61,38 @@ def main(config_file_path):
         save_path = os.path.expanduser('~/celo_events_dir')
 
     network = config_dict.get("network", "http://localhost:8545")
+    if isinstance(network, list):
+        # several nodes, requests are balanced across them
+        network = ','.join(network)
     target_block = config_dict.get("targetBlock")
     # distributions = config_dict.get("distributions")
     # assert distributions, '`distributions` are required in the config file.'
+    if config_dict.get("hedgePercentile"):
+        # requests still waiting after this percentile of the recent latency are sent again
+        os.environ[RPC_HEDGE_PERCENTILE] = str(config_dict["hedgePercentile"])
+    if config_dict.get("rpcCache", True):
+        # results of calls on blocks older than `rpcCacheConfirmations` are kept in the save path
+        os.environ.setdefault(RPC_CACHE_PATH, get_response_cache_path(save_path))
+        os.environ[RPC_CACHE_CONFIRMATIONS] = str(config_dict.get("rpcCacheConfirmations", 20))
+    reporter = None
+    if config_dict.get("metrics", True):
+        # counters of all processes are merged into metrics.json and metrics.prom every `metricsInterval` seconds
+        os.environ.setdefault(METRICS_DIR, os.path.join(save_path, 'metrics'))
+        reporter = MetricsReporter(os.environ[METRICS_DIR], config_dict.get("metricsInterval", 30)).start()
     set_envvars(network, target_block)
     initConnection()
 
     web3 = get_web3()
+    # "async" runs all scans from this process with up to `maxConcurrency` requests in flight,
+    # "process" uses a pool of `processes` worker processes
+    if config_dict.get("fetcher", "async") == "async":
+        process_pool = AsyncLogFetcher(
+            network, max_concurrency=config_dict.get("maxConcurrency", 200), hedge_kwargs=get_hedge_kwargs(),
+            response_cache=get_response_cache()
+        )
+    else:
+        process_pool = get_process_pool(config_dict.get("processes"))
+
     start_block = get_start_block()
     target_block = get_target_block()
     if target_block is not None:
@@ -47,8 +101,12 @@ def main(config_file_path):
     if not target_block or target_block < start_block:
         target_block = web3.eth.blockNumber
 
+    # what was cached for blocks that a reorg replaced since the last run is fetched again,
+    # the blocks within `confirmations` of the head are checked on the next run
+    sync_chain(save_path, target_block, config_dict.get("confirmations", 20))
+
     # 0. Impact Market Communities ###########
-    imarket_address, factory_address, cusd_address, celo_address, start_block = get_impact_market_info()
+    imarket_address, factory_address, cusd_address, celo_address, start_block = get_impact_market_info(target_block)
     print('get impact market communities (imarket-address %s): %s - %s' % (imarket_address, start_block, target_block))
     communities = get_imarket_communities(save_path, web3, imarket_address, start_block, target_block)
 
@@ -57,17 +115,20 @@ def main(config_file_path):
     print('get cUSD donors (token-address %s): %s - %s' % (cusd_address, start_block, target_block))
     # values in donors and holders are already converted to floats (i.e. not in base_18)
     cusd_transfers, cusd_donors_list, cusd_holders = process_cUSD_token(
-        mp_pool, save_path, 1, target_block, cusd_address, communities
+        process_pool, save_path, 1, target_block, cusd_address, communities
     )
 
     # 2. CELO ##############
     print('get CELO donors (token-address %s): %s - %s' % (celo_address, start_block, target_block))
     celo_transfers, celo_donors_list, celo_holders = process_celo_token(
-        mp_pool, save_path, 1, target_block, celo_address, communities
+        process_pool, save_path, 1, target_block, celo_address, communities
     )
 
-    impactMarketOldAddress = "0x69d174b5934ea2e20b0a31dd848c79ae5300a095"
-    impactMarketNewAddress = "0x62c06ebce770f7166f726fab4924940adb520eec"
+    # donors, holders, managers and beneficiaries are aggregated by address table ID and
+    # turned back into hex addresses when written
+    address_table = get_address_table(save_path)
+    impactMarketOldAddress = address_table.get_id("0x69d174b5934ea2e20b0a31dd848c79ae5300a095")
+    impactMarketNewAddress = address_table.get_id("0x62c06ebce770f7166f726fab4924940adb520eec")
 
     celo_donors_list = [(a, amount*celo_2_usd_rate) for a, amount in celo_donors_list]
     celo_holders_list = [(a, amount*celo_2_usd_rate) for a, amount in celo_holders.items()]
@@ -87,17 +148,17 @@ def main(config_file_path):
     donors_file = os.path.join(save_results_path, 'donors.csv')
     with open(donors_file, 'w') as f:
         csv_writer = csv.writer(f)
-        csv_writer.writerows(sorted_donors)
+        csv_writer.writerows(with_hex_addresses(address_table, sorted_donors))
 #
 #     # # 3. UBE token holders ############## UBE holders (around 3.3K at moment)
 #     # ube_address, ube_block, factory, router, factory_block = get_ubeswap_info()
 #     # print('get UBE token holders (token-address %s): %s - %s' % (ube_address, ube_block, target_block))
-#     # ube_transfers, ube_holders = process_ube_token(mp_pool, save_path, ube_block, target_block, ube_address)
+#     # ube_transfers, ube_holders = process_ube_token(process_pool, save_path, ube_block, target_block, ube_address)
 #     #
 #     # # 4. MOO token holders ############## MOO holders (around 900 at moment)
 #     # moo_address, moo_block, lending_contract_address, lending_block = get_moola_info()
 #     # print('get MOO token holders (token-address %s): %s - %s' % (moo_address, moo_block, target_block))
-#     # moo_transfers, moo_holders = process_moo_token(mp_pool, save_path, moo_block, target_block, moo_address)
+#     # moo_transfers, moo_holders = process_moo_token(process_pool, save_path, moo_block, target_block, moo_address)
 
     address_amount_tuples = []
     address_amount_tuples.extend(sorted(celo_holders_list, key=lambda x: x[1]))
@@ -106,36 +167,44 @@ def main(config_file_path):
     # address_amount_tuples.extend(sorted(moo_holders.items(), key=lambda x: x[1]))
 
 
-    aggregated_holders = {a.lower(): 0 for a, v in address_amount_tuples}
+    aggregated_holders = {a: 0 for a, v in address_amount_tuples}
     for a, v in address_amount_tuples:
-        aggregated_holders[a.lower()] = 1
+        aggregated_holders[a] = 1
 
     sorted_holders = sorted(aggregated_holders.items(), key=lambda x: x[1])
 
     holders_file = os.path.join(save_results_path, 'holders.csv')
     with open(holders_file, 'w') as f:
         csv_writer = csv.writer(f)
-        csv_writer.writerows(sorted_holders)
+        csv_writer.writerows(with_hex_addresses(address_table, sorted_holders))
 
 #     # users_file = os.path.join(save_results_path, 'ube-moola-users.csv')
 #     # # 5. UBE swap users ##############
 #     # print('get ubeswap users (Factory address %s): %s - %s' % (factory, factory_block, target_block))
-#     # ube_users = get_ubeswap_users(mp_pool, save_path, target_block, 2000)
+#     # ube_users = get_ubeswap_users(process_pool, save_path, target_block, 2000)
 #
 #     # # 6. MOO market users ##############
 #     # print('get moola users (LendingPool address %s): %s - %s' % (lending_contract_address, lending_block, target_block))
-#     # moola_users = get_moola_users(mp_pool, save_path, target_block, 2000)
+#     # moola_users = get_moola_users(process_pool, save_path, target_block, 2000)
 #
 #     # addresses = [(address,) for address in set(ube_users + moola_users)]
 #     # with open(users_file, 'w') as f:
 #     #     csv_writer = csv.writer(f)
 #     #     csv_writer.writerows(addresses)
 
+    # 7. Impact market community Managers and Beneficiaries events, in a single scan ##############
+    print('get imarket community events (%s communities): %s - %s' % (len(communities), start_block, target_block))
+    # the managers and beneficiaries steps below then find these logs in the log store
+    dispatch_community_event_logs(
+        process_pool, save_path, communities, start_block, target_block, ['ManagerAdded', 'BeneficiaryAdded'],
+        chunk_size=50000
+    )
+
     # 7. Impact market community Managers ##############
     print('get imarket managers (%s communities): %s - %s' % (len(communities), start_block, target_block))
-    managers = get_impact_market_managers(mp_pool, save_path, communities, start_block, target_block, chunk_size=500000)
-    managers = {address.lower() for address, block in managers}
-    addresses = [(address,) for address in managers]
+    managers = get_impact_market_managers(process_pool, save_path, communities, start_block, target_block, chunk_size=500000)
+    managers = set(address_table.get_ids([address for address, block in managers]).tolist())
+    addresses = [(address,) for address in address_table.get_addresses(list(managers))]
     managers_file = os.path.join(save_results_path, 'managers.csv')
     with open(managers_file, 'w') as f:
         csv_writer = csv.writer(f)
@@ -143,17 +212,18 @@ def main(config_file_path):
 
     # 8. Impact market community Beneficiaries ##############
     print('get imarket beneficiaries (%s communities): %s - %s' % (len(communities), start_block, target_block))
-    beneficiaries = get_impact_market_beneficiaries(mp_pool, save_path, communities, start_block, target_block, chunk_size=5000)
+    beneficiaries = get_impact_market_beneficiaries(process_pool, save_path, communities, start_block, target_block, chunk_size=5000)
     # values in beneficiaries are already converted to floats (i.e. not in base_18)
-    aggregated_beneficiareies = {a.lower(): 0 for a in beneficiaries}
+    beneficiaries = address_table.get_ids(beneficiaries).tolist()
+    aggregated_beneficiareies = {a: 0 for a in beneficiaries}
     for a in beneficiaries:
-        aggregated_beneficiareies[a.lower()] = 1
+        aggregated_beneficiareies[a] = 1
 
     sorted_beneficiaries = sorted(aggregated_beneficiareies.items(), key=lambda x: x[1])
     beneficiaries_file = os.path.join(save_results_path, 'beneficiaries.csv')
     with open(beneficiaries_file, 'w') as f:
         csv_writer = csv.writer(f)
-        csv_writer.writerows(sorted_beneficiaries)
+        csv_writer.writerows(with_hex_addresses(address_table, sorted_beneficiaries))
 
     print('Completed, all info is saved in the following files: \n'
           '%s\n'
@@ -170,6 +240,8 @@ def main(config_file_path):
     beneficiaries_tokens = 100 * million
     holders_tokens = 100 * million
     receivers = []
+    # wallets that aren't in the address table aren't among the receivers, they aren't added to it
+    accounts_to_ignore = {address_table.find_id(a) for a in accounts_to_ignore} - {None}
     # donation_multiplier = distributions['donors']
     sorted_donors = [(a, amount) for a, amount in sorted_donors if a not in accounts_to_ignore]
 
@@ -208,7 +280,7 @@ def main(config_file_path):
         aggregated_receivers[a] += v
 
 
-    sorted_receivers = sorted(aggregated_receivers.items(), key=lambda x: x[1])
+    sorted_receivers = with_hex_addresses(address_table, sorted(aggregated_receivers.items(), key=lambda x: x[1]))
     rewards_file = os.path.join(save_results_path, 'reward_distributions.csv')
     with open(rewards_file, 'w') as f:
         csv_writer = csv.writer(f)
@@ -230,6 +302,14 @@ def main(config_file_path):
     print('biggest reward = %s' % sorted_receivers[-1][1])
     print('Final distributions file is saved in %s, and %s' % (rewards_file, rewards_file_base_18))
 
+    if reporter is not None:
+        print('Run metrics, also in %s:' % reporter.path)
+        for line in format_report(reporter.stop()):
+            print(line)
+    for provider in (web3.providers[0], getattr(process_pool, 'provider', None)):
+        if getattr(provider, 'hedge', None) is not None and provider.hedge.percentile is not None:
+            print('%s: %s' % (provider, provider.hedge.summary()[-1]))
+
 
 if __name__ == "__main__":
     # path = os.path.expanduser('~/celo_events_dir_1')
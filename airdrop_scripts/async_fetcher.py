@@ -0,0 +1,321 @@
+"""Asyncio based event log fetcher.
+
+Scanning event logs is almost entirely waiting on the RPC node, so instead of a
+process per scan this keeps many `eth_getLogs` requests in flight from a single
+process, bounded by a semaphore.
+"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+from web3.middleware.pythonic import filter_params_formatter
+from web3.providers.base import JSONBaseProvider
+
+from chunk_sizer import MAX_RATE_LIMIT_RETRIES, is_rate_limit_error, is_result_limit_error, rate_limit_delay
+from contract import get_chunk_ranges
+from metrics import get_metrics
+from response_cache import cacheable_blocks
+from rpc_pool import EndpointPool, HedgePolicy, split_endpoints
+
+logger = logging.getLogger(__name__)
+
+MAX_ERRORS = 5
+
+
+class AsyncHTTPProvider(JSONBaseProvider):
+    """Minimal asyncio JSON-RPC provider sharing one `aiohttp` session per event loop.
+
+    `endpoint_uri` can be a comma separated list of endpoints, requests can be hedged and
+    served from a response cache, see `CustomHTTPProvider`.
+    """
+
+    def __init__(self, endpoint_uri, timeout=10, max_connections=200, pool_kwargs=None, hedge_kwargs=None,
+                 response_cache=None):
+        self.pool = EndpointPool(split_endpoints(endpoint_uri), **(pool_kwargs or {}))
+        self.hedge = HedgePolicy(**(hedge_kwargs or {}))
+        self.response_cache = response_cache
+        self.endpoint_uri = self.pool.endpoints[0].uri
+        self._timeout = timeout
+        # the connection limit is per endpoint
+        self._max_connections = max_connections * len(self.pool)
+        self._session = None
+        super().__init__()
+        get_metrics().add_source('rpc', self.latency_stats)
+
+    def __str__(self):
+        return "Async RPC connection {0}".format(', '.join(e.uri for e in self.pool.endpoints))
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_connections),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+                headers={'Content-Type': 'application/json'},
+            )
+        return self._session
+
+    def latency_stats(self):
+        return self.hedge.stats()
+
+    async def make_request(self, method, params):
+        if self.response_cache is not None and await self._is_cacheable(method, params):
+            result = self.response_cache.get(method, params)
+            if result is not None:
+                return {'jsonrpc': '2.0', 'id': next(self.request_counter), 'result': result}
+            response = await self._make_request(method, params)
+            if 'error' not in response:
+                self.response_cache.put(method, params, response.get('result'))
+            return response
+        return await self._make_request(method, params)
+
+    async def _is_cacheable(self, method, params):
+        blocks = cacheable_blocks(method, params)
+        if blocks is None:
+            return False
+        if self.response_cache.needs_head(blocks):
+            response = await self._make_request('eth_blockNumber', [])
+            if 'result' in response:
+                self.response_cache.set_head(int(response['result'], 16))
+        return self.response_cache.is_final(blocks)
+
+    async def _make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        delay = self.hedge.delay(method)
+        if delay is None:
+            return await self._post(request_data, method, [])
+
+        # same hedging as `CustomHTTPProvider._post`, the slower attempt is cancelled
+        tried = []
+        tasks = [asyncio.ensure_future(self._post(request_data, method, tried))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return tasks[0].result()
+
+        tasks.append(asyncio.ensure_future(self._post(request_data, method, list(tried))))
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.hedge.record_hedge(won=task is tasks[1])
+                        return task.result()
+                    error = error or task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        self.hedge.record_hedge(won=False)
+        raise error
+
+    async def _post(self, request_data, method, tried):
+        while True:
+            endpoint = self.pool.acquire(exclude=tried)
+            tried.append(endpoint)
+            start_time = time.time()
+            try:
+                async with self._get_session().post(endpoint.uri, data=request_data) as response:
+                    response.raise_for_status()
+                    raw_response = await response.read()
+            except asyncio.TimeoutError:
+                self._record_failure(endpoint, method, time.time() - start_time)
+                raise
+            except asyncio.CancelledError:
+                # the other attempt of a hedged request answered first, it took at least this long
+                self.pool.release(endpoint, time.time() - start_time)
+                self.hedge.record(method, time.time() - start_time)
+                raise
+            except aiohttp.ClientResponseError as err:
+                if err.status < 500:
+                    self.pool.record_success(endpoint, time.time() - start_time)
+                    raise
+                self._record_failure(endpoint, method, time.time() - start_time)
+                if len(tried) >= len(self.pool):
+                    raise
+                continue
+            except aiohttp.ClientConnectionError:
+                self._record_failure(endpoint, method, time.time() - start_time)
+                if len(tried) >= len(self.pool):
+                    raise
+                continue
+            except BaseException:
+                # e.g. a truncated response, the endpoint isn't in flight anymore either way
+                self.pool.release(endpoint, time.time() - start_time)
+                raise
+
+            latency = time.time() - start_time
+            self.pool.record_success(endpoint, latency)
+            self.hedge.record(method, latency)
+            get_metrics().add(bytes=len(raw_response))
+            return self.decode_rpc_response(raw_response)
+
+    def _record_failure(self, endpoint, method, elapsed):
+        self.pool.record_failure(endpoint, elapsed)
+        # the request took at least this long, leaving it out would bias the hedge delay low
+        self.hedge.record(method, elapsed)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncLogFetcher:
+    """Fetch event logs concurrently, with at most `max_concurrency` requests in flight per endpoint.
+
+    Has a `map(job, args_lists)` method so it can stand in for the multiprocessing pool,
+    where `job` is a coroutine function taking `(fetcher, args)`.
+    """
+
+    def __init__(self, endpoint_uri, max_concurrency=200, timeout=10, hedge_kwargs=None, response_cache=None):
+        self.provider = AsyncHTTPProvider(
+            endpoint_uri, timeout=timeout, max_connections=max_concurrency, hedge_kwargs=hedge_kwargs,
+            response_cache=response_cache
+        )
+        self.max_concurrency = max_concurrency * len(self.provider.pool)
+        self._semaphore = None
+
+    def map(self, job, args_lists):
+        return asyncio.run(self._map(job, args_lists))
+
+    async def _map(self, job, args_lists):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            return await asyncio.gather(*[job(self, args) for args in args_lists])
+        finally:
+            await self.provider.close()
+
+    async def get_event_logs(self, contract, event_name, from_block, to_block, filters, chunk_size=1000,
+                             chunk_sizer=None, addresses=None, compact=False):
+        """Async counterpart of `Contract.get_event_logs`.
+
+        All chunks of the range are requested concurrently, a chunk that times out or
+        hits a result limit is split in half and retried, the same way
+        `Contract.get_event_logs` halves its chunk on `ReadTimeout`.
+
+        :param chunk_sizer: AdaptiveChunkSizer, its learned chunk size is used instead of
+            `chunk_size` and it adapts to the responses of this scan for the next one
+        :param addresses: list of contract addresses to filter on instead of the contract's address
+        :param compact: bool decode logs into compact tuples, see `log_decoder`
+        :return: list of decoded logs ordered by block
+        """
+        chunks = []
+        async for _from, _to, logs in self.iter_event_logs(
+                contract, event_name, from_block, to_block, filters, chunk_size, chunk_sizer, addresses, compact):
+            chunks.append((_from, logs))
+        chunks.sort(key=lambda c: c[0])
+        return [l for _from, logs in chunks for l in logs]
+
+    async def iter_event_logs(self, contract, event_name, from_block, to_block, filters, chunk_size=1000,
+                              chunk_sizer=None, addresses=None, compact=False):
+        """Async generator version of `get_event_logs`, yields `(chunk_from_block, chunk_to_block, logs)`
+        for each chunk as soon as it completes. Chunks complete out of order, so each one is its own
+        resume token: blocks of the chunks already yielded don't need to be fetched again.
+        """
+        if chunk_sizer is not None:
+            chunk_size = chunk_sizer.chunk
+
+        abi = contract.get_event_abi(event_name)
+        decode = contract.get_raw_log_decoder(abi, addresses, compact)
+        block_ranges = get_chunk_ranges(from_block, to_block, chunk_size, to_block - from_block + 1)
+        tasks = [
+            asyncio.ensure_future(
+                self._get_chunk_logs(contract, abi, decode, filters, addresses, _from, _to, chunk_sizer))
+            for _from, _to in block_ranges
+        ]
+        nlogs = 0
+        try:
+            for next_chunk in asyncio.as_completed(tasks):
+                _from, _to, logs = await next_chunk
+                nlogs += len(logs)
+                get_metrics().add(blocks=_to - _from + 1, logs=len(logs))
+                yield _from, _to, logs
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        print(f"Done processing {contract.contract_name} {event_name} events ({from_block}, {to_block}), "
+              f"found {nlogs} logs.")
+        if chunk_sizer is not None:
+            chunk_sizer.save()
+
+    async def _get_chunk_logs(self, contract, abi, decode, filters, addresses, _from, _to, chunk_sizer=None):
+        return _from, _to, await self._get_logs(
+            contract, abi, decode, filters, addresses, _from, _to, chunk_sizer=chunk_sizer)
+
+    async def _get_logs(self, contract, abi, decode, filters, addresses, _from, _to, error_count=0, chunk_sizer=None):
+        params = filter_params_formatter(
+            contract._get_filter_params(abi, filters, fromBlock=_from, toBlock=_to, addresses=addresses)
+        )
+        metrics = get_metrics()
+        response, elapsed = await self._request_logs(params, _from, _to)
+        if response is None:
+            print(f"ReadTimeout ({_from}, {_to})")
+            metrics.add(requests=1, retries=1)
+            if chunk_sizer is not None:
+                chunk_sizer.on_timeout()
+            return await self._split_get_logs(
+                contract, abi, decode, filters, addresses, _from, _to, error_count + 1, chunk_sizer)
+
+        if 'error' in response:
+            print(f"Error ({_from}, {_to}): {response['error']}")
+            if not is_result_limit_error(response['error']):
+                raise ValueError(response['error'])
+
+            metrics.add(requests=1, halvings=1)
+            if chunk_sizer is not None:
+                chunk_sizer.on_result_limit()
+            return await self._split_get_logs(
+                contract, abi, decode, filters, addresses, _from, _to, error_count + 1, chunk_sizer)
+
+        with metrics.timer('decode_seconds'):
+            logs = [decode(entry) for entry in response['result']]
+        metrics.add(requests=1)
+        if chunk_sizer is not None:
+            # the next scan starts at the chunk learned from the responses of this one
+            chunk_sizer.on_success(_to - _from + 1, len(logs), elapsed)
+        return logs
+
+    async def _request_logs(self, params, _from, _to):
+        """`eth_getLogs` response and its seconds, a rate limited request is sent again after a
+        backoff, the response is None when the request timed out."""
+        metrics = get_metrics()
+        rate_limited = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    start_time = time.time()
+                    with metrics.timer('rpc_seconds'):
+                        response = await self.provider.make_request('eth_getLogs', [params])
+                    elapsed = time.time() - start_time
+            except asyncio.TimeoutError:
+                return None, None
+            except aiohttp.ClientResponseError as err:
+                if not is_rate_limit_error(err) or rate_limited >= MAX_RATE_LIMIT_RETRIES:
+                    raise
+                response = {'error': str(err)}
+            if 'error' not in response or not is_rate_limit_error(response['error']) \
+                    or rate_limited >= MAX_RATE_LIMIT_RETRIES:
+                return response, elapsed
+
+            # the same range again once the node accepts requests, its size isn't the problem
+            print(f"Rate limited ({_from}, {_to}): {response['error']}")
+            metrics.add(requests=1, retries=1)
+            await asyncio.sleep(rate_limit_delay(rate_limited))
+            rate_limited += 1
+
+    async def _split_get_logs(self, contract, abi, decode, filters, addresses, _from, _to, error_count,
+                              chunk_sizer=None):
+        if error_count > MAX_ERRORS:
+            raise AssertionError('Errors encountered while fetching event logs.')
+
+        if _to - _from + 1 <= 2:
+            return await self._get_logs(contract, abi, decode, filters, addresses, _from, _to, error_count, chunk_sizer)
+
+        mid = _from + (_to - _from + 1) // 2
+        first, second = await asyncio.gather(
+            self._get_logs(contract, abi, decode, filters, addresses, _from, mid - 1, error_count, chunk_sizer),
+            self._get_logs(contract, abi, decode, filters, addresses, mid, _to, error_count, chunk_sizer),
+        )
+        return first + second
@@ -0,0 +1,103 @@
+"""NumPy engine for token balances computed from transfers.
+
+Addresses are handled as `address_table` IDs and uint256 amounts are split in
+16 limbs of 16 bits. Each limb is summed per address with `np.bincount`, whose
+float64 accumulation stays exact up to 2**37 transfers, and the limbs are
+recombined into Python ints at the end, so balances are exactly the ones the
+pure Python loop produced.
+"""
+import numpy as np
+
+from address_table import AddressTable, to_address_array
+from transfer_cache import TransferColumns, VALUE_SIZE
+
+LIMB_DTYPE = np.dtype('>u2')
+NUM_LIMBS = VALUE_SIZE // LIMB_DTYPE.itemsize
+LIMB_POWERS = np.array([1 << (16 * (NUM_LIMBS - 1 - k)) for k in range(NUM_LIMBS)], dtype=object)
+
+
+def transfer_arrays(transfers, table):
+    """Return `(from, to, limbs)` arrays of `transfers`, addresses as IDs of `table` and
+    amounts as big-endian 16-bit limbs of shape (n, 16).
+
+    :param transfers: `TransferColumns` (used without copying, with its own table) or list of
+        `(from, to, value, block)` tuples
+    """
+    if isinstance(transfers, TransferColumns):
+        _from = np.frombuffer(transfers.from_column, dtype=np.uint32)
+        _to = np.frombuffer(transfers.to_column, dtype=np.uint32)
+        limbs = np.frombuffer(transfers.value_column, dtype=LIMB_DTYPE).reshape(-1, NUM_LIMBS)
+        return _from, _to, limbs
+
+    _from = table.get_ids(to_address_array([t[0] for t in transfers]))
+    _to = table.get_ids(to_address_array([t[1] for t in transfers]))
+    values = b''.join(int(t[2]).to_bytes(VALUE_SIZE, 'big') for t in transfers)
+    limbs = np.frombuffer(values, dtype=LIMB_DTYPE).reshape(-1, NUM_LIMBS)
+    return _from, _to, limbs
+
+
+def get_table(transfers):
+    """The address table of `transfers`, a new in-memory table for a list of transfers."""
+    return transfers.table if isinstance(transfers, TransferColumns) else AddressTable()
+
+
+def net_limb_sums(transfers, table):
+    """Per address sums of the 16-bit limbs of the amounts received minus the amounts sent.
+
+    Limb sums are not carried, so sums of several transfer sets can be added exactly with
+    `merge_limb_sums` and turned into balances once with `combine_limbs`.
+
+    :return: (sorted address IDs, int64 array of shape (n addresses, 16)) aligned by index
+    """
+    _from, _to, limbs = transfer_arrays(transfers, table)
+    if not len(limbs):
+        return np.empty(0, dtype=np.int32), np.empty((0, NUM_LIMBS), dtype=np.int64)
+
+    ids, inverse = np.unique(np.concatenate([_from, _to]), return_inverse=True)
+    from_index = inverse[:len(_from)]
+    to_index = inverse[len(_from):]
+    sums = np.empty((len(ids), NUM_LIMBS), dtype=np.int64)
+    for k in range(NUM_LIMBS):
+        limb = limbs[:, k].astype(np.float64)
+        received = np.bincount(to_index, weights=limb, minlength=len(ids))
+        sent = np.bincount(from_index, weights=limb, minlength=len(ids))
+        sums[:, k] = received.astype(np.int64) - sent.astype(np.int64)
+    return ids.astype(np.int32), sums
+
+
+def merge_limb_sums(ids, sums, other_ids, other_sums):
+    """Add two sets of per address limb sums, see `net_limb_sums`."""
+    merged, inverse = np.unique(np.concatenate([ids, other_ids]), return_inverse=True)
+    merged_sums = np.zeros((len(merged), NUM_LIMBS), dtype=np.int64)
+    merged_sums[inverse[:len(ids)]] += sums
+    merged_sums[inverse[len(ids):]] += other_sums
+    return merged, merged_sums
+
+
+def combine_limbs(sums):
+    """Object array of the int values of limb sums."""
+    return (sums.astype(object) * LIMB_POWERS).sum(axis=1)
+
+
+def net_balances(transfers, table):
+    """Net balance of every address that appears in `transfers`.
+
+    :return: (sorted address IDs, object array of int balances) aligned by index
+    """
+    ids, sums = net_limb_sums(transfers, table)
+    return ids, combine_limbs(sums)
+
+
+def filter_balances(ids, balances, min_amount=None):
+    """IDs and balances of the addresses with balance >= `min_amount` (all when None)."""
+    if min_amount is not None and len(balances):
+        mask = np.asarray(balances >= min_amount, dtype=bool)
+        ids = ids[mask]
+        balances = balances[mask]
+    return ids, balances
+
+
+def balances_dict(table, ids, balances, min_amount=None):
+    """{lowercase address: balance} of the addresses with balance >= `min_amount` (all when None)."""
+    ids, balances = filter_balances(ids, balances, min_amount)
+    return dict(zip(table.get_addresses(ids), balances.tolist()))
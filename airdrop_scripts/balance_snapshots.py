@@ -0,0 +1,162 @@
+"""Balance and donor checkpoints so reruns only apply new transfers.
+
+A token's balances at the last block of a run are kept as per address limb sums
+(see `balance_engine`) together with the block, the number of transfers applied
+and a hash of the inputs. The next run loads the checkpoint and adds the sums of
+the transfers after that block, the checkpoint is recomputed from scratch when
+the inputs changed or the transfers before its block don't match anymore.
+
+Donations are kept the same way, as the `extract_community_donations` of the
+transfers up to the checkpoint block. Addresses are kept as `address_table` IDs,
+so checkpoints are only valid with the address table they were saved with.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from balance_engine import combine_limbs, filter_balances, merge_limb_sums, net_limb_sums
+from events_helpers import extract_community_donations
+from util import from_base_18, to_base_18
+
+
+def get_snapshot_path(save_path, token_name, from_block, kind):
+    ext = 'npz' if kind == 'balances' else 'json'
+    return os.path.join(save_path, '%s.%s.%s.%s' % (token_name, kind, from_block, ext))
+
+
+def inputs_hash(*inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _start_index(snapshot, transfers, key):
+    """Index of the first transfer not applied in `snapshot`, None when it can't be rolled forward."""
+    if snapshot is None or snapshot['key'] != key or snapshot['block'] > transfers.to_block:
+        return None
+    if snapshot.get('table_id') != transfers.table_id.hex():
+        return None
+    if transfers.index_after(snapshot['block']) != snapshot['count']:
+        # transfers up to the checkpoint block changed since it was saved
+        return None
+    return snapshot['count']
+
+
+def _load_balances_snapshot(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if 'table_id' not in data.files:
+            return None
+        return {
+            'key': str(data['key']),
+            'table_id': str(data['table_id']),
+            'block': int(data['block']),
+            'count': int(data['count']),
+            'ids': data['ids'],
+            'sums': data['sums'],
+        }
+
+
+def _save_balances_snapshot(path, key, transfers, ids, sums):
+    tmp_path = '%s.%s.tmp.npz' % (path, os.getpid())
+    np.savez(
+        tmp_path, key=key, table_id=transfers.table_id.hex(), block=transfers.to_block, count=len(transfers),
+        ids=ids, sums=sums
+    )
+    os.replace(tmp_path, path)
+
+
+def get_balances(save_path, token_name, token_address, from_block, transfers):
+    """Net balances of all addresses in `transfers` (a `TransferColumns` starting at `from_block`),
+    rolled forward from the last checkpoint of `token_name` when possible.
+
+    :return: (address IDs, object array of int balances), see `balance_engine.net_balances`
+    """
+    path = get_snapshot_path(save_path, token_name, from_block, 'balances')
+    key = inputs_hash(token_address.lower(), from_block)
+    snapshot = _load_balances_snapshot(path)
+    start = _start_index(snapshot, transfers, key)
+    if start is None:
+        print('computing %s balances of %s transfers' % (token_name, len(transfers)))
+        ids, sums = net_limb_sums(transfers, transfers.table)
+    else:
+        print('rolling %s balances forward from block %s with %s transfers' % (
+            token_name, snapshot['block'], len(transfers) - start))
+        ids, sums = merge_limb_sums(
+            snapshot['ids'], snapshot['sums'], *net_limb_sums(transfers[start:], transfers.table)
+        )
+
+    if snapshot is None or start is None or transfers.to_block > snapshot['block']:
+        _save_balances_snapshot(path, key, transfers, ids, sums)
+    return ids, combine_limbs(sums)
+
+
+def get_token_holders(save_path, token_name, token_address, from_block, transfers, min_amount=1.0):
+    """Same as `events_helpers.extract_token_holders` using the balances checkpoint, with holders
+    as IDs of the transfers' address table.
+
+    :return: {holder ID: float amount}
+    """
+    ids, balances = get_balances(save_path, token_name, token_address, from_block, transfers)
+    ids, balances = filter_balances(ids, balances, min_amount=to_base_18(min_amount))
+    return {_id: from_base_18(value) for _id, value in zip(ids.tolist(), balances.tolist())}
+
+
+def get_community_donors(save_path, token_name, token_address, from_block, transfers, communities):
+    """Same as `events_helpers.extract_community_donors` using the donors checkpoint, which is
+    only reused for the same set of communities, with donors as IDs of the transfers' address table.
+
+    :return: list of (donor ID, float amount)
+    """
+    path = get_snapshot_path(save_path, token_name, from_block, 'donors')
+    key = inputs_hash(token_address.lower(), from_block, sorted(comm.lower() for comm, block in communities))
+    snapshot = None
+    if os.path.exists(path):
+        with open(path) as f:
+            snapshot = json.load(f)
+
+    start = _start_index(snapshot, transfers, key)
+    if start is None:
+        donors = list(zip(*_donations(transfers, communities)))
+    else:
+        donors = [tuple(d) for d in snapshot['donors']]
+        donors.extend(zip(*_donations(transfers[start:], communities)))
+
+    if snapshot is None or start is None or transfers.to_block > snapshot['block']:
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'key': key, 'table_id': transfers.table_id.hex(), 'block': transfers.to_block,
+                'count': len(transfers), 'donors': donors
+            }, f)
+        os.replace(tmp_path, path)
+    return donors
+
+
+def _donations(transfers, communities):
+    donor_ids, amounts = extract_community_donations(transfers, communities, transfers.table)
+    return donor_ids.tolist(), amounts
+
+
+def rollback_snapshots(save_path, block):
+    """Remove the balance and donor checkpoints of `save_path` saved after `block`, the transfers
+    after it were reorganized.
+
+    :return: list of the paths removed
+    """
+    removed = []
+    for name in sorted(os.listdir(save_path)):
+        parts = name.split('.')
+        if len(parts) != 4 or (parts[1], parts[3]) not in (('balances', 'npz'), ('donors', 'json')):
+            continue
+        path = os.path.join(save_path, name)
+        if parts[1] == 'balances':
+            snapshot = _load_balances_snapshot(path)
+        else:
+            with open(path) as f:
+                snapshot = json.load(f)
+        if snapshot is None or snapshot['block'] > block:
+            os.remove(path)
+            removed.append(path)
+    return removed
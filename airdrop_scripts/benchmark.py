@@ -0,0 +1,261 @@
+"""Offline benchmark of the airdrop pipeline against `fake_node` servers.
+
+Each stage runs in its own forked process, so its peak memory is the peak RSS of that process,
+against the same synthetic chain of `transfers` token transfers:
+
+  * `get_event_logs`: `Contract.get_event_logs` of all cUSD transfers, compact logs in memory
+  * `dispatch_get_all_transfers`: cUSD transfers into the log store and the transfers cache
+  * `calculate_balances`: net balances of the cached cUSD transfers
+  * `main`: `airdrop_main.main` on the whole chain, cUSD and CELO transfers and community events
+
+Results are printed and appended to `<work_dir>/benchmark.jsonl` to compare runs:
+
+    python benchmark.py <work_dir> [1M 10M 100M] [nodes=2] [concurrency=16] [latency=0.0]
+        [max_results=10000] [stages=get_event_logs,main]
+"""
+import json
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import sys
+import time
+
+from eth_utils import encode_hex, event_abi_to_log_topic, function_abi_to_4byte_selector
+
+from fake_node import FakeNode, IndexedEncoder, LogStream, NodeSettings, SyntheticChain, TransferEncoder, \
+    account_address, to_word
+from util import load_contract_definition
+
+IMARKET_ADDRESS = '0xe55C3eb4a04F93c3302A5d8058348157561BF5ca'
+FACTORY_ADDRESS = '0xF3ba2c917b01627fb90673Aae0E170EE767Af8b6'
+CUSD_ADDRESS = '0x765DE816845861e75A25fCA122bb6898B8B1282a'
+CELO_ADDRESS = '0x471EcE3750Da237f93B8E339c536989b8978a438'
+# share of the transfers that are cUSD, the others are CELO
+CUSD_SHARE = 0.5
+
+STAGES = ('get_event_logs', 'dispatch_get_all_transfers', 'calculate_balances', 'main')
+
+
+def _abi(path):
+    definition = load_contract_definition(path)
+    return definition['abi'] if isinstance(definition, dict) else definition
+
+
+def event_topic(abi_path, event_name):
+    return encode_hex(event_abi_to_log_topic(
+        next(a for a in _abi(abi_path) if a['type'] == 'event' and a['name'] == event_name)))
+
+
+def function_selector(abi_path, function_name):
+    return encode_hex(function_abi_to_4byte_selector(
+        next(a for a in _abi(abi_path) if a['type'] == 'function' and a['name'] == function_name)))
+
+
+def pipeline_chain(transfers, blocks=None, communities=100, block_time=None):
+    """`SyntheticChain` of the airdrop pipeline: cUSD and CELO transfers between `transfers` / 10
+    accounts, 1% of them donations to the communities, which are created in the first tenth of
+    the blocks and have 2 managers each and a beneficiary per 100 transfers between them.
+
+    :param blocks: number of blocks, about 40 transfers per block by default
+    """
+    blocks = blocks or max(1000, transfers // 40)
+    accounts = min(max(1000, transfers // 10), 10 ** 7)
+    community_addresses = [account_address(i, base=0xC0000000) for i in range(communities)]
+    per_block = transfers / blocks
+    erc20_abi = os.getenv('ERC20_ABI', './abi/ERC20.json')
+    community_abi = os.getenv('COMMUNITY_ABI', './abi/Community.json')
+    creation_blocks = max(1, blocks // 10)
+    streams = [
+        LogStream(
+            CUSD_ADDRESS, event_topic(erc20_abi, 'Transfer'), per_block * CUSD_SHARE,
+            TransferEncoder(accounts, community_addresses, 0.01, seed=1)),
+        LogStream(
+            CELO_ADDRESS, event_topic(erc20_abi, 'Transfer'), per_block * (1 - CUSD_SHARE),
+            TransferEncoder(accounts, community_addresses, 0.01, seed=2), log_index_base=1000),
+        LogStream(
+            IMARKET_ADDRESS, event_topic(os.getenv('IMARKET_ABI', './abi/ImpactMarket.json'), 'CommunityAdded'),
+            [(1, communities / creation_blocks), (1 + creation_blocks, 0)],
+            IndexedEncoder([community_addresses, None], accounts, data_words=4, seed=3), log_index_base=2000),
+        LogStream(
+            community_addresses, event_topic(community_abi, 'ManagerAdded'),
+            [(creation_blocks, 2 * communities / (blocks - creation_blocks + 1))],
+            IndexedEncoder([None], accounts, seed=4), log_index_base=3000),
+        LogStream(
+            community_addresses, event_topic(community_abi, 'BeneficiaryAdded'),
+            [(creation_blocks, per_block / 100)],
+            IndexedEncoder([None], accounts, seed=5), log_index_base=4000),
+    ]
+    factory_abi = os.getenv('CFACTORY_ABI', './abi/CommunityFactory.json')
+    calls = {
+        (FACTORY_ADDRESS, function_selector(factory_abi, 'impactMarketAddress')): '0x' + to_word(IMARKET_ADDRESS),
+        (FACTORY_ADDRESS, function_selector(factory_abi, 'cUSDAddress')): '0x' + to_word(CUSD_ADDRESS),
+    }
+    return SyntheticChain(streams, blocks, calls, block_time)
+
+
+def parse_count(text):
+    """1M -> 1000000"""
+    multiplier = {'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9}.get(text[-1].lower(), 1)
+    return int(float(text.rstrip('kKmMgG')) * multiplier)
+
+
+def _connect(network, target_block):
+    from util import initConnection, set_envvars
+
+    os.environ['IMPACT_MARKET_START_BLOCK'] = '1'
+    set_envvars(network, target_block)
+    return initConnection()
+
+
+def stage_get_event_logs(network, save_path, head, concurrency):
+    from chunk_sizer import AdaptiveChunkSizer
+    from contract import get_contract
+
+    web3 = _connect(network, head)
+    erc20 = get_contract('cUSD', os.getenv('ERC20_ABI'), CUSD_ADDRESS)
+    logs = erc20.get_event_logs(
+        'Transfer', 1, head, {}, web3, verbose=False, chunk_sizer=AdaptiveChunkSizer(1000), compact=True)
+    return len(logs)
+
+
+def stage_dispatch_get_all_transfers(network, save_path, head, concurrency):
+    from async_fetcher import AsyncLogFetcher
+    from export_recipients import dispatch_get_all_transfers
+
+    _connect(network, head)
+    fetcher = AsyncLogFetcher(network, max_concurrency=concurrency)
+    transfers = dispatch_get_all_transfers(fetcher, save_path, 1, head, CUSD_ADDRESS, 'cUSD')
+    return len(transfers)
+
+
+def stage_calculate_balances(network, save_path, head, concurrency):
+    from address_table import get_address_table
+    from events_helpers import calculate_balances
+    from transfer_cache import get_cache_path, load_transfers
+
+    transfers = load_transfers(get_cache_path(save_path, 'cUSD', 1, head), get_address_table(save_path))
+    calculate_balances(transfers)
+    return len(transfers)
+
+
+def stage_main(network, save_path, head, concurrency):
+    import airdrop_main
+
+    results_path = os.path.join(save_path, 'results')
+    os.makedirs(results_path, exist_ok=True)
+    config_path = os.path.join(save_path, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({
+            'network': network.split(','), 'savePath': save_path, 'saveResultsPath': results_path,
+            'targetBlock': head, 'walletsToIgnore': [], 'maxConcurrency': concurrency,
+        }, f)
+    _connect(network, head)
+    airdrop_main.main(config_path)
+
+
+def _run_in_child(stage, args, conn):
+    try:
+        start_time = time.time()
+        items = globals()['stage_%s' % stage](*args)
+        seconds = time.time() - start_time
+        # KB on Linux
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        conn.send({'seconds': seconds, 'items': items, 'peak_mb': peak_mb})
+    except Exception as e:
+        conn.send({'error': '%s: %s' % (type(e).__name__, e)})
+        raise
+
+
+def run_stage(stage, *args):
+    """Run a stage in a forked process, returns its seconds, items processed and peak RSS in MB."""
+    ctx = mp.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_run_in_child, args=(stage, args, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+def start_nodes(chain, count, settings):
+    """`count` fake nodes of `chain` in their own processes, returns (processes, comma separated URIs)."""
+    ctx = mp.get_context('fork')
+    processes = []
+    uris = []
+    for _ in range(count):
+        node = FakeNode(chain, port=0, settings=settings)
+        process = ctx.Process(target=node.server.serve_forever, daemon=True)
+        process.start()
+        node.server.server_close()
+        processes.append(process)
+        uris.append(node.uri)
+    return processes, ','.join(uris)
+
+
+def benchmark(work_dir, transfers, stages=STAGES, nodes=2, settings=None, concurrency=16):
+    """
+    :param nodes: number of fake node processes, the requests are balanced across them
+    :param settings: `NodeSettings` of the nodes, a 10000 logs result limit by default
+    :param concurrency: requests in flight per node of the asyncio fetcher, a python node
+        can't keep up with the default 200
+    """
+    chain = pipeline_chain(transfers)
+    processes, network = start_nodes(chain, nodes, settings or NodeSettings(max_results=10000))
+    save_path = os.path.join(work_dir, 'run-%s' % transfers)
+    shutil.rmtree(save_path, ignore_errors=True)
+    os.makedirs(save_path)
+    rows = []
+    try:
+        for stage in stages:
+            print('benchmark %s at %s transfers (%s blocks)' % (stage, transfers, chain.head))
+            stage_save_path = save_path
+            if stage == 'main':
+                # from scratch, not from the log store of the previous stages
+                stage_save_path = os.path.join(save_path, 'main')
+                os.makedirs(stage_save_path)
+            result = run_stage(stage, network, stage_save_path, chain.head, concurrency)
+            if stage == 'main' and 'error' not in result:
+                # cUSD and CELO transfers
+                result['items'] = sum(s.count(1, chain.head) for s in chain.streams[:2])
+            rows.append(dict(result, stage=stage, transfers=transfers, blocks=chain.head, nodes=nodes,
+                             concurrency=concurrency, time=time.time()))
+    finally:
+        for process in processes:
+            process.terminate()
+
+    with open(os.path.join(work_dir, 'benchmark.jsonl'), 'a') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+    return rows
+
+
+def print_results(rows):
+    print('  %12s %28s %10s %12s %10s %10s' % ('transfers', 'stage', 'seconds', 'items', 'items/s', 'peak MB'))
+    for r in rows:
+        if 'error' in r:
+            print('  %12s %28s failed: %s' % (r['transfers'], r['stage'], r['error']))
+            continue
+        print('  %12s %28s %10.1f %12s %10.0f %10.0f' % (
+            r['transfers'], r['stage'], r['seconds'], r['items'], r['items'] / max(r['seconds'], 1e-9), r['peak_mb']))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('usage: python benchmark.py <work_dir> [transfers ...] [nodes=N] [concurrency=N] [latency=S] '
+              '[max_results=N] [stages=a,b]')
+        sys.exit(1)
+
+    work_dir = os.path.expanduser(sys.argv[1])
+    os.makedirs(work_dir, exist_ok=True)
+    options = dict(arg.split('=', 1) for arg in sys.argv[2:] if '=' in arg)
+    scales = [parse_count(arg) for arg in sys.argv[2:] if '=' not in arg] or [10 ** 6]
+    node_settings = NodeSettings(
+        latency=float(options.get('latency', 0)), max_results=int(options.get('max_results', 10000)))
+    all_rows = []
+    for scale in scales:
+        all_rows.extend(benchmark(
+            work_dir, scale, options['stages'].split(',') if 'stages' in options else STAGES,
+            int(options.get('nodes', 2)), node_settings, int(options.get('concurrency', 16))
+        ))
+    print_results(all_rows)
@@ -0,0 +1,159 @@
+"""Adaptive block-range (chunk) sizing for eth_getLogs scans.
+
+The right chunk size depends on how many logs an event emits per block, which
+differs by orders of magnitude between e.g. community events and cUSD transfers.
+The sizer grows the chunk after fast, light responses and shrinks it on
+timeouts, slow or heavy responses and result-limit errors. The learned density
+is kept per (contract, event) in a json file so the next run starts at a good size.
+"""
+import json
+import os
+
+DENSITY_FILE_NAME = 'chunk_density.json'
+
+# Substrings of node errors returned when a query matches too many logs or the response is too big
+RESULT_LIMIT_ERRORS = (
+    'query returned more than',
+    'more than 10000 results',
+    'too many results',
+    'too many logs',
+    'response size',
+    'block range is too',
+    'query timeout exceeded',
+)
+# Substrings of errors of a node or gateway limiting the request rate, e.g. HTTP 429
+RATE_LIMIT_ERRORS = (
+    'too many requests',
+    'rate limit',
+)
+# seconds before retrying a rate limited request, doubled after each attempt up to the max
+RATE_LIMIT_DELAY = 1.0
+MAX_RATE_LIMIT_DELAY = 30.0
+MAX_RATE_LIMIT_RETRIES = 8
+
+
+def is_rate_limit_error(err):
+    # requests' HTTPError has the response, aiohttp's ClientResponseError the status
+    response = getattr(err, 'response', None)
+    if getattr(response, 'status_code', None) == 429 or getattr(err, 'status', None) == 429:
+        return True
+    msg = str(err).lower()
+    return any(e in msg for e in RATE_LIMIT_ERRORS)
+
+
+def is_result_limit_error(err):
+    """Whether the request failed because of its size, a smaller block range can succeed.
+    A rate limited request isn't, it is retried as is after `rate_limit_delay`."""
+    if is_rate_limit_error(err):
+        return False
+    msg = str(err).lower()
+    return any(e in msg for e in RESULT_LIMIT_ERRORS)
+
+
+def rate_limit_delay(attempt):
+    """Seconds to wait before the `attempt`-th retry (from 0) of a rate limited request."""
+    return min(RATE_LIMIT_DELAY * 2 ** attempt, MAX_RATE_LIMIT_DELAY)
+
+
+class AdaptiveChunkSizer:
+    def __init__(
+        self,
+        chunk_size,
+        min_chunk=2,
+        max_chunk=2000000,
+        target_logs=5000,
+        target_latency=3.0,
+        growth=2.0,
+        store_path=None,
+        key=None,
+    ):
+        """
+        :param chunk_size: initial number of blocks per request
+        :param min_chunk: int
+        :param max_chunk: int
+        :param target_logs: number of logs to aim for in a single eth_getLogs response
+        :param target_latency: seconds to aim for per round trip
+        :param growth: max factor to grow or shrink the chunk after a successful response
+        :param store_path: json file where the learned density is persisted, optional
+        :param key: key of this contract/event in the density file
+        """
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.target_logs = target_logs
+        self.target_latency = target_latency
+        self.growth = growth
+        self.store_path = store_path
+        self.key = key
+        self.logs_per_block = None
+        self.total_blocks = 0
+        self.total_logs = 0
+        self._chunk = self._clamp(chunk_size)
+
+    @classmethod
+    def from_store(cls, save_path, contract_address, event_name, chunk_size, **kwargs):
+        """Create a sizer that starts from the density learned in earlier runs, if any."""
+        store_path = os.path.join(save_path, DENSITY_FILE_NAME) if save_path else None
+        key = '%s:%s' % (contract_address.lower(), event_name)
+        sizer = cls(chunk_size, store_path=store_path, key=key, **kwargs)
+        stats = _load_density(store_path).get(key)
+        if stats:
+            sizer.logs_per_block = stats['logs_per_block']
+            sizer._chunk = sizer._clamp(stats['chunk'])
+        return sizer
+
+    @property
+    def chunk(self):
+        return self._chunk
+
+    def _clamp(self, chunk):
+        return int(max(self.min_chunk, min(self.max_chunk, chunk)))
+
+    def record(self, nblocks, nlogs):
+        """Update the running logs-per-block density estimate."""
+        self.total_blocks += nblocks
+        self.total_logs += nlogs
+        self.logs_per_block = self.total_logs / max(self.total_blocks, 1)
+
+    def on_success(self, nblocks, nlogs, elapsed, nrequests=1):
+        """Adjust the chunk after a successful round trip of `nrequests` eth_getLogs calls
+        covering `nblocks` blocks and returning `nlogs` logs in `elapsed` seconds."""
+        self.record(nblocks, nlogs)
+        blocks_per_request = max(nblocks / nrequests, 1)
+        expected_logs = nlogs / nrequests * self._chunk / blocks_per_request
+        expected_latency = elapsed * self._chunk / blocks_per_request
+        factor = min(
+            self.growth,
+            self.target_logs / max(expected_logs, 1),
+            self.target_latency / max(expected_latency, 1e-3),
+        )
+        factor = max(factor, 1 / self.growth)
+        self._chunk = self._clamp(self._chunk * factor)
+
+    def on_timeout(self):
+        self._chunk = self._clamp(self._chunk / 2)
+
+    def on_result_limit(self):
+        self._chunk = self._clamp(self._chunk / 2)
+
+    def save(self):
+        """Persist the learned density, merging with entries written by other workers."""
+        if not self.store_path or self.logs_per_block is None:
+            return
+
+        density = _load_density(self.store_path)
+        density[self.key] = {'logs_per_block': self.logs_per_block, 'chunk': self._chunk}
+        tmp_path = '%s.%s.tmp' % (self.store_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(density, f, indent=2)
+        os.replace(tmp_path, self.store_path)
+
+
+def _load_density(store_path):
+    if not store_path or not os.path.exists(store_path):
+        return {}
+
+    try:
+        with open(store_path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
@@ -1,24 +1,75 @@
 
 import logging
-from typing import Any, Dict, Optional
+import os
+import time
+from typing import Any, Dict, List, Optional
 
 import requests
 from eth_typing import BlockIdentifier
+from eth_utils import encode_hex, event_abi_to_log_topic
 from hexbytes import HexBytes
-from web3 import Web3
 from web3.contract import ConciseContract
 from web3.exceptions import ValidationError
+from web3.middleware.pythonic import filter_params_formatter, log_entry_formatter
 from web3.utils.events import get_event_data
 from web3.utils.filters import construct_event_filter_params
 from web3.utils.threads import Timeout
 from websockets import ConnectionClosed
 
+from log_decoder import COMPACT_ADDRESS, COMPACT_EVENT, CompactLogDecoder
+from chunk_sizer import MAX_RATE_LIMIT_RETRIES, AdaptiveChunkSizer, is_rate_limit_error, is_result_limit_error, \
+    rate_limit_delay
+from metrics import get_metrics
 from util import load_contract
 from web3_instance import get_web3
 
 logger = logging.getLogger(__name__)
 
 
+def get_chunk_ranges(from_block, to_block, chunk_size, count):
+    """Return up to `count` consecutive (from, to) block ranges of `chunk_size` blocks starting at `from_block`."""
+    ranges = []
+    _from = from_block
+    while _from <= to_block and len(ranges) < count:
+        _to = min(_from + chunk_size - 1, to_block)
+        ranges.append((_from, _to))
+        _from = _to + 1
+    return ranges
+
+
+def group_logs_by_address(logs):
+    """Split logs fetched for several contracts into a dict of contract address -> list of logs."""
+    address_to_logs = {}
+    for l in logs:
+        address = l[COMPACT_ADDRESS] if isinstance(l, tuple) else l.address
+        address_to_logs.setdefault(address, []).append(l)
+    return address_to_logs
+
+
+def group_logs_by_event(logs):
+    """Split logs fetched for several events into a dict of event name -> list of logs."""
+    event_to_logs = {}
+    for l in logs:
+        event = l[COMPACT_EVENT] if isinstance(l, tuple) else l.event
+        event_to_logs.setdefault(event, []).append(l)
+    return event_to_logs
+
+
+_contracts = {}
+
+
+def get_contract(name, abi_path, address):
+    """The `Contract` of `address` with the ABI at `abi_path`, built once per process and web3
+    instance, with its event topics, and shared by all the jobs that use it.
+
+    :param name: name of the contract in messages, the one of the first call is kept
+    """
+    key = (os.path.abspath(abi_path), address.lower(), id(get_web3()))
+    if key not in _contracts:
+        _contracts[key] = Contract(name, abi_path, address)
+    return _contracts[key]
+
+
 class Contract(object):
 
     def __init__(self, name: str, abi_path: str, address: str):
@@ -30,6 +81,12 @@ class Contract(object):
 
         self.contract = load_contract(abi_path, address)
         self.contract_concise = ConciseContract(self.contract)
+        # topic0 -> event abi, to decode logs of several events fetched together
+        self._topic_to_abi = {
+            event_abi_to_log_topic(abi): abi for abi in self.contract.abi if abi['type'] == 'event'
+        }
+        # event name -> topic0 hex
+        self._event_topics = {abi['name']: encode_hex(topic) for topic, abi in self._topic_to_abi.items()}
 
         assert self.contract.address == address and self.address == address
         assert self.contract_concise is not None
@@ -57,21 +114,17 @@ class Contract(object):
         Return signature of event definition to use in the call to eth_getLogs.
 
         The event signature is used as topic0 (first topic) in the eth_getLogs arguments
-        The signature reflects the event name and argument types.
+        The signature reflects the event name and argument types, it's computed once
+        when the contract is built.
 
         :param event_name:
         :return:
         """
-        e = getattr(self.events, event_name)
-        if not e:
+        if event_name not in self._event_topics:
             raise ValueError(
                 f"Event {event_name} not found in {self.contract_name} contract."
             )
-
-        abi = e().abi
-        types = [param["type"] for param in abi["inputs"]]
-        sig_str = f'{event_name}({",".join(types)})'
-        return Web3.sha3(text=sig_str).hex()
+        return self._event_topics[event_name]
 
     @staticmethod
     def get_tx_receipt(tx_hash: str, timeout=20):
@@ -129,7 +182,7 @@ class Contract(object):
         :param to_block: int or None
         :return: event if blocking is True and an event is received, otherwise returns None
         """
-        from .event_listener import EventListener
+        from event_listener import EventListener
 
         return EventListener(
             getattr(self.events, event_name),
@@ -142,59 +195,239 @@ class Contract(object):
             callback, timeout_callback=timeout_callback, timeout=timeout, blocking=wait
         )
 
+    def get_event(self, event_name):
+        """Return the contract event `event_name`, or a list of events when given a list of names."""
+        if isinstance(event_name, (list, tuple)):
+            return [getattr(self.events, name) for name in event_name]
+        return getattr(self.events, event_name)
+
+    def get_event_abi(self, event_name):
+        return _get_event_abi(self.get_event(event_name))
+
+    def decode_log(self, abi, log_entry):
+        """Decode a formatted log entry, `abi` can be a list of event abis in which case
+        the abi matching the log's topic0 is used."""
+        if isinstance(abi, list):
+            abi = self._topic_to_abi[bytes(log_entry['topics'][0])]
+        return get_event_data(abi, log_entry)
+
+    def get_raw_log_decoder(self, abi, addresses=None, compact=False):
+        """Return a function that decodes raw (unformatted) eth_getLogs entries of `abi`."""
+        if compact:
+            return CompactLogDecoder(abi, with_source=isinstance(abi, list) or bool(addresses))
+        return lambda entry: self.decode_log(abi, log_entry_formatter(entry))
+
     def get_event_argument_names(self, event_name: str):
         event = getattr(self.contract.events, event_name, None)
         if event:
             return event().argument_names
 
     def get_event_logs(
-        self, event_name, from_block, to_block, filters, web3=None, chunk_size=1000, verbose=True
+        self, event_name, from_block, to_block, filters, web3=None, chunk_size=1000, verbose=True, batch_size=1,
+        chunk_sizer=None, addresses=None, compact=False
     ):
-        event = getattr(self.events, event_name)
+        """
+        Get all `event_name` logs between `from_block` and `to_block` in chunks of blocks.
+
+        :param event_name: name of the event, str. Or a list of event names to fetch all of them
+            in one scan using a topic0 OR-list, use `group_logs_by_event` to split the result
+        :param from_block: int
+        :param to_block: int
+        :param filters: dict of argument filters
+        :param web3: Web3 instance
+        :param chunk_size: initial number of blocks per eth_getLogs call, ignored when `chunk_sizer` is given
+        :param verbose: bool print progress after each chunk
+        :param batch_size: number of chunks packed in one JSON-RPC batch request, only used
+            when the web3 provider supports `make_batch_request`
+        :param chunk_sizer: AdaptiveChunkSizer, grows the chunk after fast responses and shrinks
+            it on timeouts and result-limit errors
+        :param addresses: list of addresses of contracts sharing this contract's abi, when given the
+            logs of all of them are fetched with the same eth_getLogs filter instead of this contract's,
+            use `group_logs_by_address` to split the result
+        :param compact: bool decode logs into compact tuples `(*args, blockNumber, logIndex)` instead of
+            `AttributeDict`s, see `log_decoder`. The log address and event name are appended to each tuple
+            when fetching several contracts or events.
+        :return: list of decoded logs
+        """
+        all_logs = []
+        for _from, _to, logs in self.iter_event_logs(
+                event_name, from_block, to_block, filters, web3, chunk_size, verbose, batch_size,
+                chunk_sizer, addresses, compact):
+            all_logs.extend(logs)
+
+        if verbose:
+            print(f"Done processing events, found {len(all_logs)} logs.")
+        return all_logs
+
+    def iter_event_logs(
+        self, event_name, from_block, to_block, filters, web3=None, chunk_size=1000, verbose=True, batch_size=1,
+        chunk_sizer=None, addresses=None, compact=False, get_to_block=None
+    ):
+        """
+        Generator version of `get_event_logs`, yields the logs of each chunk (or batch of chunks)
+        as soon as it is fetched instead of accumulating the whole range.
+
+        Yields `(chunk_from_block, chunk_to_block, logs)` tuples in block order. `chunk_to_block` is a
+        resume token: every block up to it was fully scanned, so an interrupted scan can be resumed
+        from `chunk_to_block + 1`.
+
+        Takes the same arguments as `get_event_logs`, plus:
+
+        :param get_to_block: callable returning the current last block of the range, called before
+            each request when the end of the range can move back while it is scanned (work stealing)
+        """
+        event = self.get_event(event_name)
         if not web3:
             web3 = get_web3()
 
-        chunk = chunk_size
+        provider = web3.providers[0]
+        if batch_size > 1 and not hasattr(provider, 'make_batch_request'):
+            batch_size = 1
+
+        if chunk_sizer is None:
+            chunk_sizer = AdaptiveChunkSizer(chunk_size)
+
         _from = from_block
-        _to = _from + chunk - 1
+        _to = min(_from + chunk_sizer.chunk - 1, to_block)
 
-        all_logs = []
+        nlogs = 0
         error_count = 0
-        _to = min(_to, to_block)
-        while _from <= to_block:
-            try:
-                logs = self.getLogs(
-                    event, web3, argument_filters=filters, fromBlock=_from, toBlock=_to
-                )
-                all_logs.extend(logs)
+        rate_limited = 0
+        metrics = get_metrics()
+        try:
+            while _from <= to_block:
+                if get_to_block is not None:
+                    to_block = min(to_block, get_to_block())
+                    if _from > to_block:
+                        break
+                block_ranges = get_chunk_ranges(_from, to_block, chunk_sizer.chunk, batch_size)
+                _to = block_ranges[-1][1]
+                try:
+                    start_time = time.time()
+                    if batch_size > 1:
+                        logs = self.getLogsBatch(
+                            event, provider, block_ranges, argument_filters=filters, addresses=addresses,
+                            compact=compact
+                        )
+                    else:
+                        logs = self.getLogs(
+                            event, web3, argument_filters=filters, fromBlock=_from, toBlock=_to, addresses=addresses,
+                            compact=compact
+                        )
+                    chunk_sizer.on_success(_to - _from + 1, len(logs), time.time() - start_time, len(block_ranges))
+                    error_count = 0
+                    rate_limited = 0
+
+                except requests.exceptions.ReadTimeout as err:
+                    print(f"ReadTimeout ({_from}, {_to}): {err}")
+                    error_count += 1
+                    chunk_sizer.on_timeout()
+                    metrics.add(requests=len(block_ranges), retries=1)
+
+                except Exception as err:
+                    print(f"Error ({_from}, {_to}): {err}")
+                    if is_rate_limit_error(err) and rate_limited < MAX_RATE_LIMIT_RETRIES:
+                        # the same chunk again once the node accepts requests, its size isn't the problem
+                        time.sleep(rate_limit_delay(rate_limited))
+                        rate_limited += 1
+                        metrics.add(requests=len(block_ranges), retries=1)
+                        continue
+
+                    error_count += 1
+                    if not is_result_limit_error(err):
+                        raise
+
+                    chunk_sizer.on_result_limit()
+                    metrics.add(requests=len(block_ranges), halvings=1)
+
+                if error_count > 5:
+                    print(f"Stopped processing events at block {_from} with errors.")
+                    raise AssertionError('Errors encountered while fetching event logs.')
+
+                if error_count:
+                    continue
+
+                nlogs += len(logs)
+                metrics.add(blocks=_to - _from + 1, logs=len(logs), requests=len(block_ranges))
+                yield _from, _to, logs
                 _from = _to + 1
-                _to = min(_from + chunk - 1, to_block)
-                error_count = 0
-                # if (_from - from_block) % 1000 == 0:
                 if verbose or (_from - from_block) % 1000 == 0:
                     print(
-                        f"    So far processed {len(all_logs)} {event_name} events from {_from-from_block} blocks. last block: {_from}"
+                        f"    So far processed {nlogs} {event_name} events from {_from-from_block} blocks. last block: {_from}"
                     )
 
-            except requests.exceptions.ReadTimeout as err:
-                print(f"ReadTimeout ({_from}, {_to}): {err}")
-                error_count += 1
-                chunk = max(int(chunk / 2), 2)
-                _to = min(_from + chunk - 1, to_block)
+        finally:
+            chunk_sizer.save()
 
-            except Exception as err:
-                print(f"Error ({_from}, {_to}): {err}")
-                error_count += 1
-                raise
+    def getLogsBatch(self, event, provider, block_ranges, argument_filters=None, addresses=None, compact=False):
+        """Get events for several block ranges using a single JSON-RPC batch request.
+
+        :param event: contract event or list of events
+        :param provider: web3 provider that supports `make_batch_request`
+        :param block_ranges: list of (fromBlock, toBlock) tuples
+        :param argument_filters: dict of argument filters
+        :param addresses: list of contract addresses to filter on instead of this contract's address
+        :param compact: bool decode logs into compact tuples
+        :return: Tuple of :class:`AttributeDict` instances ordered by block range
+        """
+        abi = _get_event_abi(event)
+        calls = [
+            ('eth_getLogs', [filter_params_formatter(
+                self._get_filter_params(abi, argument_filters, fromBlock=_from, toBlock=_to, addresses=addresses)
+            )])
+            for _from, _to in block_ranges
+        ]
+        decode = self.get_raw_log_decoder(abi, addresses, compact)
+        metrics = get_metrics()
+        with metrics.timer('rpc_seconds'):
+            responses = provider.make_batch_request(calls)
+        logs = []
+        with metrics.timer('decode_seconds'):
+            for response in responses:
+                if 'error' in response:
+                    raise ValueError(response['error'])
+                logs.extend(decode(entry) for entry in response['result'])
+
+        return tuple(logs)
+
+    def _get_filter_params(self, abi, argument_filters=None, fromBlock=None, toBlock=None, addresses=None):
+        if not self.address:
+            raise TypeError(
+                "This method can be only called on "
+                "an instated contract with an address"
+            )
 
-            if error_count > 5:
-                break
+        if argument_filters is None:
+            argument_filters = dict()
 
-        print(f"Done processing events, found {len(all_logs)} logs." + "with errors" if error_count else "")
-        if error_count:
-            raise AssertionError('Errors encountered while fetching event logs.')
+        if isinstance(abi, list):
+            return self._get_multi_event_filter_params(abi, argument_filters, fromBlock, toBlock, addresses)
 
-        return all_logs
+        # Construct JSON-RPC raw filter presentation based on human readable Python descriptions
+        # Namely, convert event names to their keccak signatures
+        _, event_filter_params = construct_event_filter_params(
+            abi,
+            contract_address=None if addresses else self.address,
+            argument_filters=dict(**argument_filters),
+            address=list(addresses) if addresses else None,
+            fromBlock=fromBlock,
+            toBlock=toBlock,
+        )
+        return event_filter_params
+
+    def _get_multi_event_filter_params(self, abis, argument_filters, fromBlock, toBlock, addresses):
+        if argument_filters:
+            raise ValueError("argument filters are not supported when fetching several events.")
+
+        event_filter_params = {
+            'topics': [[encode_hex(event_abi_to_log_topic(abi)) for abi in abis]],
+            'address': list(addresses) if addresses else self.address,
+        }
+        if fromBlock is not None:
+            event_filter_params['fromBlock'] = fromBlock
+        if toBlock is not None:
+            event_filter_params['toBlock'] = toBlock
+        return event_filter_params
 
     def getLogs(
         self,
@@ -204,6 +437,8 @@ class Contract(object):
         fromBlock: Optional[BlockIdentifier] = None,
         toBlock: Optional[BlockIdentifier] = None,
         blockHash: Optional[HexBytes] = None,
+        addresses: Optional[List[str]] = None,
+        compact: bool = False,
     ):
         """Get events for this contract instance using eth_getLogs API.
 
@@ -246,20 +481,11 @@ class Contract(object):
         :param toBlock: block number or "latest". Defaults to "latest"
         :param blockHash: block hash. blockHash cannot be set at the
           same time as fromBlock or toBlock
+        :param addresses: list of contract addresses to filter on instead of this contract's address
+        :param compact: decode logs into compact tuples, see `log_decoder`
         :yield: Tuple of :class:`AttributeDict` instances
         """
-        if not self.address:
-            raise TypeError(
-                "This method can be only called on "
-                "an instated contract with an address"
-            )
-
-        abi = event._get_event_abi()
-
-        if argument_filters is None:
-            argument_filters = dict()
-
-        _filters = dict(**argument_filters)
+        abi = _get_event_abi(event)
 
         blkhash_set = blockHash is not None
         blknum_set = fromBlock is not None or toBlock is not None
@@ -268,21 +494,36 @@ class Contract(object):
                 "blockHash cannot be set at the same" " time as fromBlock or toBlock"
             )
 
-        # Construct JSON-RPC raw filter presentation based on human readable Python descriptions
-        # Namely, convert event names to their keccak signatures
-        _, event_filter_params = construct_event_filter_params(
-            abi,
-            contract_address=self.address,
-            argument_filters=_filters,
-            fromBlock=fromBlock,
-            toBlock=toBlock,
+        event_filter_params = self._get_filter_params(
+            abi, argument_filters, fromBlock=fromBlock, toBlock=toBlock, addresses=addresses
         )
 
         if blockHash is not None:
             event_filter_params["blockHash"] = blockHash
 
+        metrics = get_metrics()
+        if compact:
+            # Call JSON-RPC API without the web3 result formatters, the compact decoder reads the raw hex
+            with metrics.timer('rpc_seconds'):
+                response = web3.providers[0].make_request(
+                    'eth_getLogs', [filter_params_formatter(event_filter_params)]
+                )
+            if 'error' in response:
+                raise ValueError(response['error'])
+            decode = self.get_raw_log_decoder(abi, addresses, compact)
+            with metrics.timer('decode_seconds'):
+                return tuple(decode(entry) for entry in response['result'])
+
         # Call JSON-RPC API
-        logs = web3.eth.getLogs(event_filter_params)
+        with metrics.timer('rpc_seconds'):
+            logs = web3.eth.getLogs(event_filter_params)
 
         # Convert raw binary data to Python proxy objects as described by ABI
-        return tuple(get_event_data(abi, entry) for entry in logs)
+        with metrics.timer('decode_seconds'):
+            return tuple(self.decode_log(abi, entry) for entry in logs)
+
+
+def _get_event_abi(event):
+    if isinstance(event, (list, tuple)):
+        return [e._get_event_abi() for e in event]
+    return event._get_event_abi()
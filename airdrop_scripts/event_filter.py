@@ -1,6 +1,9 @@
 import logging
 import time
 
+from web3.middleware.pythonic import log_entry_formatter
+
+from log_subscriber import END_OF_BLOCK
 from web3_instance import get_web3
 
 logger = logging.getLogger(__name__)
@@ -21,7 +24,15 @@ class EventFilter:
         self.event = event
         self.argument_filters = argument_filters
         self.block_range = (from_block, to_block)
+        # (block, logIndex) of the last entry returned by `get_new_entries`, a filter that expired
+        # on the node is created again from there
+        self.cursor = None
+        if from_block == "latest":
+            # a number to create the filter again from when it expires before the first entry
+            self.cursor = (get_web3().eth.blockNumber - 1, END_OF_BLOCK)
         self._filter = None
+        # whether all the entries of the current filter were read, the next ones are its changes
+        self._synced = False
         self._poll_interval = poll_interval if poll_interval else 0.5
         self._create_filter()
 
@@ -40,9 +51,17 @@ class EventFilter:
     def recreate_filter(self):
         self._create_filter()
 
+    @property
+    def start_block(self):
+        """First block of the filter, the cursor's block once entries were returned."""
+        if self.cursor is None:
+            return self.block_range[0]
+        return self.cursor[0] + 1 if self.cursor[1] == END_OF_BLOCK else self.cursor[0]
+
     def _create_filter(self):
+        self._synced = False
         self._filter = self.event().createFilter(
-            fromBlock=self.block_range[0],
+            fromBlock=self.start_block,
             toBlock=self.block_range[1],
             argument_filters=self.argument_filters,
         )
@@ -50,16 +69,43 @@ class EventFilter:
             self._filter.poll_interval = self._poll_interval
 
     def get_new_entries(self, max_tries=1):
-        return self._get_entries(self._filter.get_new_entries, max_tries=max_tries)
+        """Entries after the cursor: all the entries of the filter the first time, and again after it
+        was created again from the cursor, then only its changes since the last call."""
+        return self._get_entries(incremental=True, max_tries=max_tries)
 
     def get_all_entries(self, max_tries=1):
-        return self._get_entries(self._filter.get_all_entries, max_tries=max_tries)
+        return self._get_entries(incremental=False, max_tries=max_tries)
+
+    @property
+    def poll_method(self):
+        """JSON-RPC method of the next `get_new_entries`, to poll several filters in one batch."""
+        return 'eth_getFilterChanges' if self._synced else 'eth_getFilterLogs'
+
+    def new_entries_of(self, raw_logs):
+        """`get_new_entries` of the raw result of a `poll_method` call made in a batch."""
+        logs = [log_entry_formatter(log) for log in raw_logs]
+        self._synced = True
+        return self.advance(self._filter._format_log_entries(self._filter._filter_valid_entries(logs)))
 
-    def _get_entries(self, entries_getter, max_tries=1):
+    def advance(self, entries):
+        """The entries after the cursor, which moves to the last of them."""
+        if self.cursor is not None:
+            entries = [e for e in entries if (e['blockNumber'], e['logIndex']) > self.cursor]
+        if entries:
+            self.cursor = max((e['blockNumber'], e['logIndex']) for e in entries)
+        return entries
+
+    def _get_entries(self, incremental, max_tries=1):
         i = 0
         while i < max_tries:
             try:
-                logs = entries_getter()
+                if not incremental:
+                    logs = self._filter.get_all_entries()
+                elif self._synced:
+                    logs = self.advance(self._filter.get_new_entries())
+                else:
+                    logs = self.advance(self._filter.get_all_entries())
+                    self._synced = True
                 if logs:
                     logger.debug(
                         f"found event logs: event-name={self.event_name}, "
@@ -68,10 +114,11 @@ class EventFilter:
                     )
                     return logs
             except ValueError as e:
-                if "Filter not found" in str(e):
+                if "filter not found" in str(e).lower():
                     logger.debug(
                         f"recreating filter (Filter not found): event={self.event_name}, "
-                        f"arg-filter={self.argument_filters}, from/to={self.block_range}"
+                        f"arg-filter={self.argument_filters}, from/to={self.block_range}, "
+                        f"cursor={self.cursor}"
                     )
                     time.sleep(1)
                     self._create_filter()
@@ -1,10 +1,18 @@
-
+import json
 import logging
+import os
+import threading
 import time
-from datetime import datetime
-from threading import Thread
+from concurrent.futures import Future
+
+from web3 import WebsocketProvider
+from web3.middleware.pythonic import log_entry_formatter
+from web3.utils.events import get_event_data
+from web3.utils.filters import construct_data_filter_regex, construct_event_filter_params
 
-from .event_filter import EventFilter
+from event_filter import EventFilter
+from log_subscriber import LogSubscriber
+from web3_instance import get_web3
 
 logger = logging.getLogger(__name__)
 
@@ -28,11 +36,20 @@ class EventListener(object):
         self.filters = filters if filters else {}
         self.from_block = from_block if from_block is not None else "latest"
         self.to_block = to_block if to_block is not None else "latest"
-        self.event_filter = self.make_event_filter()
-        self.event_filter.poll_interval = 0.5
         self.timeout = 600  # seconds
         self.args = args
 
+    @property
+    def key(self):
+        """Listeners of the same contract, event, argument filters and block range share a filter."""
+        return (
+            str(getattr(self.event, 'address', None)).lower(),
+            self.event_name,
+            json.dumps(self.filters, sort_keys=True, default=str),
+            str(self.from_block),
+            str(self.to_block),
+        )
+
     def make_event_filter(self):
         """Create a new event filter."""
         event_filter = EventFilter(
@@ -45,6 +62,21 @@ class EventListener(object):
         event_filter.set_poll_interval(0.5)
         return event_filter
 
+    def log_subscription(self):
+        """`eth_subscribe` logs filter of the event and the decoder of its raw logs, which returns None
+        for the logs that don't match the argument filters of non-indexed arguments."""
+        abi = self.event._get_event_abi()
+        data_filters, params = construct_event_filter_params(
+            abi, contract_address=self.event.address, argument_filters=dict(**self.filters))
+        data_regex = construct_data_filter_regex(data_filters) if any(data_filters) else None
+
+        def decode(raw_log):
+            if data_regex is not None and not data_regex.match(raw_log['data']):
+                return None
+            return get_event_data(abi, log_entry_formatter(raw_log))
+
+        return params, decode
+
     def listen_once(
         self,
         callback,
@@ -68,76 +100,225 @@ class EventListener(object):
                 timeout is not None
             ), "`timeout` argument is required when `blocking` is True."
 
-        events = []
-        original_callback = callback
+        future = get_event_watcher().subscribe(
+            self,
+            callback,
+            timeout_callback,
+            timeout if timeout is not None else self.timeout,
+            self.args,
+            start_time,
+        )
+        if blocking:
+            # None once the timeout expired
+            return [future.result()]
+
+        return None
 
-        def _callback(event, *args):
-            events.append(event)
-            if original_callback:
-                original_callback(event, *args)
 
-        if blocking:
-            callback = _callback
-
-        # TODO Review where to close this threads.
-        Thread(
-            target=self.watch_one_event,
-            args=(
-                self.event_filter,
-                callback,
-                timeout_callback,
-                timeout if timeout is not None else self.timeout,
-                self.args,
-                start_time,
-            ),
-            daemon=True,
-        ).start()
-        if blocking:
-            while not events:
-                time.sleep(0.2)
+class Subscription:
+    def __init__(self, callback, timeout_callback, args, deadline):
+        self.callback = callback
+        self.timeout_callback = timeout_callback
+        self.args = args or []
+        self.deadline = deadline
+        # result is the event, or None on timeout
+        self.future = Future()
 
-            return events
+    def deliver(self, event):
+        try:
+            if event is None and self.timeout_callback is not None:
+                self.timeout_callback(*self.args)
+            elif self.callback is not None:
+                self.callback(event, *self.args)
+        except Exception as err:
+            logger.error(f"Error in event callback: {str(err)}")
+        finally:
+            self.future.set_result(event)
 
-        return None
 
-    @staticmethod
-    def watch_one_event(
-        event_filter, callback, timeout_callback, timeout, args, start_time=None
-    ):
+class EventWatcher:
+
+    """One thread polling the event filters of all the listeners of the process.
+
+    Subscriptions are grouped by `EventListener.key`, each distinct filter is polled once per tick
+    for its changes since the previous tick (`EventFilter.get_new_entries`), with a single JSON-RPC
+    batch for all of them when the provider supports it, and the first
+    matching event is handed to all the subscriptions of the filter. A filter is uninstalled once
+    it has no subscriptions left.
+
+    With a `LogSubscriber` the events are pushed by the node with `eth_subscribe` instead, and
+    only the events whose subscription the node refuses are polled. The thread then only checks
+    the timeouts.
+    """
+
+    def __init__(self, poll_interval=0.5, subscriber=None):
         """
-        Start to watch one event.
-
-        :param event_filter:
-        :param callback:
-        :param timeout_callback:
-        :param timeout:
-        :param args:
-        :param start_time:
-        :return:
+        :param poll_interval: seconds between two polls of the filters
+        :param subscriber: `LogSubscriber` of the websocket of the node, events are polled without it
+        """
+        self.poll_interval = poll_interval
+        self.subscriber = subscriber
+        self._filters = {}
+        # key -> `LogSubscriber` subscription id of the keys whose events are pushed
+        self._streams = {}
+        self._subscriptions = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def subscribe(self, listener, callback, timeout_callback, timeout, args, start_time=None):
+        """Deliver the next event of `listener` to `callback`, or call `timeout_callback` after
+        `timeout` seconds from `start_time`.
+
+        :return: `Future` of the event, None when the timeout expired
         """
         if timeout and not start_time:
-            start_time = int(datetime.now().timestamp())
+            start_time = time.time()
+        subscription = Subscription(callback, timeout_callback, args, start_time + timeout if timeout else None)
+        key = listener.key
+        with self._condition:
+            if key not in self._filters and key not in self._streams:
+                if self.subscriber is not None:
+                    self._streams[key] = self._subscribe_logs(key, listener)
+                else:
+                    self._filters[key] = listener.make_event_filter()
+            self._subscriptions.setdefault(key, []).append(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-watcher', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return subscription.future
+
+    def _subscribe_logs(self, key, listener):
+        params, decode = listener.log_subscription()
+        from_block = listener.from_block if isinstance(listener.from_block, int) else None
+        to_block = listener.to_block if isinstance(listener.to_block, int) else None
+
+        def on_log(raw_log):
+            if raw_log.get('removed') or (to_block is not None and int(raw_log['blockNumber'], 16) > to_block):
+                return
+            event = decode(raw_log)
+            if event is not None:
+                self._push(key, event)
+
+        def on_error(err):
+            self._poll_instead(key, listener)
+
+        return self.subscriber.subscribe(params, on_log, from_block, on_error)
 
-        if not args:
-            args = []
+    def _push(self, key, event):
+        with self._condition:
+            subscriptions = self._subscriptions.pop(key, [])
+            stream_id = self._streams.pop(key, None)
+        if stream_id is not None:
+            self.subscriber.unsubscribe(stream_id)
+        for subscription in subscriptions:
+            subscription.deliver(event)
 
+    def _poll_instead(self, key, listener):
+        # the node refused the subscription
+        with self._condition:
+            if self._streams.pop(key, None) is None:
+                return
+            if self._subscriptions.get(key):
+                self._filters[key] = listener.make_event_filter()
+            self._condition.notify()
+
+    @property
+    def subscription_count(self):
+        with self._condition:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def _run(self):
         while True:
+            with self._condition:
+                while not self._subscriptions:
+                    self._condition.wait()
+                filters = dict(self._filters)
+
+            self.tick(filters)
+            time.sleep(self.poll_interval)
+
+    def tick(self, filters):
+        """Poll `filters` (key -> `EventFilter`) once and deliver their events and timeouts."""
+        entries = self.poll(filters)
+        now = time.time()
+        deliveries = []
+        with self._condition:
+            for key, events in entries.items():
+                if events and key in self._subscriptions:
+                    deliveries.extend((s, events[0]) for s in self._subscriptions.pop(key))
+            for key, subscriptions in list(self._subscriptions.items()):
+                expired = [s for s in subscriptions if s.deadline is not None and now > s.deadline]
+                if expired:
+                    deliveries.extend((s, None) for s in expired)
+                    self._subscriptions[key] = [s for s in subscriptions if s not in expired]
+            done = [key for key in list(self._filters) + list(self._streams) if not self._subscriptions.get(key)]
+            finished_filters = [self._filters.pop(key) for key in done if key in self._filters]
+            finished_streams = [self._streams.pop(key) for key in done if key in self._streams]
+            for key in done:
+                self._subscriptions.pop(key, None)
+
+        for stream_id in finished_streams:
+            self.subscriber.unsubscribe(stream_id)
+        for event_filter in finished_filters:
             try:
-                events = event_filter.get_all_entries()
-                if events:
-                    callback(events[0], *args)
-                    return
+                event_filter.uninstall()
+            except Exception as err:
+                logger.debug(f"Error uninstalling filter {event_filter.filter_id}: {str(err)}")
+        for subscription, event in deliveries:
+            subscription.deliver(event)
 
+    def poll(self, filters):
+        """Entries of each of `filters`, with one batch request when the provider supports it."""
+        entries = {}
+        if not filters:
+            return entries
+        provider = get_web3().providers[0]
+        if len(filters) > 1 and hasattr(provider, 'make_batch_request'):
+            try:
+                responses = provider.make_batch_request(
+                    [(event_filter.poll_method, [event_filter.filter_id]) for event_filter in filters.values()])
+            except Exception as err:
+                logger.debug(f"Got error grabbing keeper events: {str(err)}")
+                return entries
+
+            for (key, event_filter), response in zip(filters.items(), responses):
+                if 'error' not in response:
+                    entries[key] = event_filter.new_entries_of(response['result'])
+                elif "filter not found" in str(response['error']).lower():
+                    logger.debug(f"recreating filter (Filter not found): event={event_filter.event_name}")
+                    self._recreate_filter(event_filter)
+                else:
+                    logger.debug(f"Got error grabbing keeper events: {response['error']}")
+            return entries
+
+        for key, event_filter in filters.items():
+            try:
+                entries[key] = event_filter.get_new_entries()
             except (ValueError, Exception) as err:
                 # ignore error, but log it
                 logger.debug(f"Got error grabbing keeper events: {str(err)}")
+        return entries
+
+    @staticmethod
+    def _recreate_filter(event_filter):
+        try:
+            event_filter.recreate_filter()
+        except Exception as err:
+            logger.debug(f"Error recreating filter of {event_filter.event_name}: {str(err)}")
+
+
+_watcher = None
+_watcher_pid = None
+
 
-            time.sleep(0.5)
-            if timeout:
-                elapsed = int(datetime.now().timestamp()) - start_time
-                if elapsed > timeout:
-                    if timeout_callback is not None:
-                        timeout_callback(*args)
-                    elif callback is not None:
-                        callback(None, *args)
-                    break
+def get_event_watcher():
+    """The `EventWatcher` of this process, a forked process starts its own. Events are pushed by
+    the node when web3 is connected through a websocket."""
+    global _watcher, _watcher_pid
+    if _watcher is None or _watcher_pid != os.getpid():
+        provider = get_web3().providers[0]
+        subscriber = LogSubscriber(provider.endpoint_uri) if isinstance(provider, WebsocketProvider) else None
+        _watcher = EventWatcher(subscriber=subscriber)
+        _watcher_pid = os.getpid()
+    return _watcher
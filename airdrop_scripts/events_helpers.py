@@ -1,58 +1,69 @@
 import os
-import json
+import weakref
+
+import numpy as np
 
 import util as util
 from util import to_base_18, from_base_18, initConnection, set_envvars
-from contract import Contract
+from chunk_sizer import AdaptiveChunkSizer
+from contract import get_contract
+from async_fetcher import AsyncLogFetcher
+from balance_engine import balances_dict, combine_limbs, get_table, net_balances, transfer_arrays
+from log_store import LogStore, get_store_path
+from metrics import get_metrics
+from range_scheduler import RangeScheduler
+from web3_instance import get_web3
+
+# worker count of the multiprocessing pools, recorded where they are created
+_pool_sizes = weakref.WeakKeyDictionary()
 
 
 def get_imarket_communities(save_path, _web3, imarket_address, _from, _to):
     # imarket_address = '0xe55C3eb4a04F93c3302A5d8058348157561BF5ca'
-    imarket = Contract('ImpactMarket', os.getenv('IMARKET_ABI'), imarket_address)
+    imarket = get_contract('ImpactMarket', os.getenv('IMARKET_ABI'), imarket_address)
     event_name_CommunityAdded = 'CommunityAdded'
-    filename = os.path.join(save_path, 'communities.%s-%s.json' % (_from, _to))
-    if os.path.exists(filename):
-        with open(filename) as f:
-            communities = json.load(f)
-    else:
-        logs = imarket.get_event_logs(event_name_CommunityAdded, _from, _to, {}, _web3, chunk_size=500000)
-        communities = [(l.args._communityAddress, l.blockNumber) for l in logs]
-        with open(filename, 'w') as f:
-            json.dump(communities, f)
-
-    return communities
-
-
-def get_all_transfers(_web3, token_address, token_name, _from, _to, filters=None, chunk_size=1000):
+    store = LogStore(get_store_path(save_path))
+    topic0 = imarket.get_event_signature(event_name_CommunityAdded)
+    metrics = get_metrics()
+    for _from_missing, _to_missing in store.missing_ranges(imarket.address, topic0, _from, _to):
+        chunk_sizer = AdaptiveChunkSizer.from_store(save_path, imarket.address, event_name_CommunityAdded, 500000)
+        with metrics.stage(_stage_name('ImpactMarket', [event_name_CommunityAdded])):
+            logs = imarket.get_event_logs(
+                [event_name_CommunityAdded], _from_missing, _to_missing, {}, _web3,
+                chunk_sizer=chunk_sizer, addresses=[imarket.address], compact=True
+            )
+            with metrics.timer('store_seconds'):
+                store.add_logs([imarket.address], {event_name_CommunityAdded: topic0}, _from_missing, _to_missing, logs)
+
+    logs = store.get_logs(imarket.address, topic0, _from, _to)
+    return get_event_values(logs, ['_communityAddress'], imarket.get_event_abi(event_name_CommunityAdded))
+
+
+def get_all_transfers(
+        _web3, token_address, token_name, _from, _to, filters=None, chunk_size=1000, batch_size=1, save_path=None):
     filters = filters if filters is not None else {}
-    erc20 = Contract(token_name, os.getenv('ERC20_ABI'), _web3.toChecksumAddress(token_address))
+    erc20 = get_contract(token_name, os.getenv('ERC20_ABI'), _web3.toChecksumAddress(token_address))
     event_name_Transfer = 'Transfer'
     logs = erc20.get_event_logs(
         event_name_Transfer, _from, _to,
         filters,
         _web3,
-        chunk_size=chunk_size
+        batch_size=batch_size,
+        chunk_sizer=AdaptiveChunkSizer.from_store(save_path, erc20.address, event_name_Transfer, chunk_size),
+        compact=True
     )
-    return [(l.args["from"], l.args.to, l.args.value, l.blockNumber) for l in logs]
+    return transfers_from_logs(logs)
 
 
-def extract_transfers_and_save_to_file(args):
-    network, filename, token_address, token_name, _from, _to, filters, chunk_size = args
-    set_envvars(network)
-    web3 = initConnection()
-    print('start get transfers: _from %s, _to %s ' % (_from, _to))
-    transfers = get_all_transfers(web3, token_address, token_name, _from, _to, filters, chunk_size)
-    print('done get transfers: _from %s, _to %s ' % (_from, _to))
-    with open(filename, 'w') as outfile:
-        json.dump(transfers, outfile)
-
-    return transfers
+def transfers_from_logs(logs):
+    """(from, to, value, block) tuples of compact `Transfer` logs."""
+    return [(l[0], l[1], l[2], l[3]) for l in logs]
 
 
 def get_community_event_logs(
         event_name, community_address, web3, abi_path,
         from_block, to_block, filters, chunk_size=50000):
-    comm_contract = Contract('Community', abi_path, web3.toChecksumAddress(community_address))
+    comm_contract = get_contract('Community', abi_path, web3.toChecksumAddress(community_address))
     logs = comm_contract.get_event_logs(
         event_name, from_block, to_block,
         filters,
@@ -62,48 +73,209 @@ def get_community_event_logs(
     return logs
 
 
-def get_event_logs(args):
+def get_event_values(logs, args_names, event_abi):
+    """Return the `args_names` values and block number of each compact log of `event_abi`."""
+    abi_names = [arg['name'] for arg in event_abi['inputs']]
+    block_i = len(abi_names)
+    if len(args_names) == 1:
+        arg_i = abi_names.index(args_names[0])
+        return [(l[arg_i], l[block_i]) for l in logs]
+
+    args_i = [abi_names.index(a) for a in args_names]
+    values = []
+    for l in logs:
+        lvs = [l[i] for i in args_i]
+        lvs.append(l[block_i])
+        values.append(lvs)
+    return values
+
+
+def group_contracts_by_block(contracts, from_block, max_addresses=100):
+    """Split (address, start_block) pairs into groups of at most `max_addresses` contracts
+    with close start blocks, so one eth_getLogs filter can cover a whole group.
+
+    :return: list of (from_block, addresses) tuples, `from_block` being the earliest block of the group
+    """
+    contracts = sorted(contracts, key=lambda c: c[1])
+    groups = []
+    for i in range(0, len(contracts), max_addresses):
+        group = contracts[i:i + max_addresses]
+        groups.append((max(from_block, group[0][1]), [address for address, _block in group]))
+    return groups
+
+
+def fetch_logs_to_store(args):
+    """Get the logs of `event_names` of all `contract_addresses` between `from_block` and `to_block`
+    with one eth_getLogs filter and add them to the log store."""
     (
-        network, i, filename, contract_address, contract_name,
-        abi_path_envvar, event_name, args_names, from_block,
-        to_block, chunk_size, verbose
+        network, i, store_path, contract_addresses, contract_name,
+        abi_path_envvar, event_names, from_block,
+        to_block, chunk_size, batch_size, verbose
     ) = args
 
     set_envvars(network)
     web3 = initConnection()
-    abi_path = os.getenv(abi_path_envvar)
-    pair_contract = Contract(contract_name, abi_path, web3.toChecksumAddress(contract_address))
-    print('%s (%s): get %s logs from block %s to block %s' % (contract_name, i, event_name, from_block, to_block))
+    contract, addresses, topics, chunk_sizer = _prepare_fetch(
+        web3, store_path, contract_addresses, contract_name, abi_path_envvar, event_names, chunk_size)
+    print('%s (%s, %s contracts): get %s logs from block %s to block %s' % (
+        contract_name, i, len(addresses), event_names, from_block, to_block))
+    store = LogStore(store_path)
+    metrics = get_metrics()
+    nlogs = 0
     try:
-        logs = pair_contract.get_event_logs(
-            event_name,
-            from_block,
-            to_block,
-            {},
-            web3,
-            chunk_size=chunk_size,
-            verbose=verbose
-        )
+        # each chunk is stored with its coverage as it arrives, an interrupted job resumes after the last one
+        with metrics.stage(_stage_name(contract_name, event_names), i):
+            for _from, _to, logs in contract.iter_event_logs(
+                event_names,
+                from_block,
+                to_block,
+                {},
+                web3,
+                verbose=verbose,
+                batch_size=batch_size,
+                chunk_sizer=chunk_sizer,
+                addresses=addresses,
+                compact=True
+            ):
+                with metrics.timer('store_seconds'):
+                    store.add_logs(addresses, topics, _from, _to, logs)
+                nlogs += len(logs)
     except Exception as e:
-        print('Error processing event: %s.%s. \n error=%s'% (contract_name, event_name, e))
+        print('Error processing event: %s.%s. \n error=%s'% (contract_name, event_names, e))
         raise
-        # return
+    finally:
+        metrics.flush()
 
-    print('done processing %s (%s) %s events, got %s logs' % (contract_name, i, event_name, len(logs)))
-    if len(args_names) == 1:
-        values = [(l.args[args_names[0]], l.blockNumber) for l in logs]
-    else:
-        values = []
-        for l in logs:
-            lvs = [l.args[a] for a in args_names]
-            lvs.append(l.blockNumber)
-            values.append(lvs)
-
-    if filename:
-        with open(filename, 'w') as outfile:
-            json.dump(values, outfile)
+    print('done processing %s (%s) %s events, got %s logs' % (contract_name, i, event_names, nlogs))
+    return nlogs
+
+
+def fetch_scheduled_logs_to_store(args):
+    """Pool worker scanning the ranges of the `schedule_key` schedule into the log store, it claims
+    (or steals) ranges until no work is left, see `range_scheduler`."""
+    (
+        network, worker, store_path, schedule_key, contract_addresses, contract_name,
+        abi_path_envvar, event_names, chunk_size, batch_size, verbose
+    ) = args
+
+    set_envvars(network)
+    web3 = initConnection()
+    contract, addresses, topics, chunk_sizer = _prepare_fetch(
+        web3, store_path, contract_addresses, contract_name, abi_path_envvar, event_names, chunk_size)
+    store = LogStore(store_path)
+    scheduler = RangeScheduler(store_path, schedule_key)
+    metrics = get_metrics()
+    nlogs = 0
+    while True:
+        claimed = scheduler.claim(worker)
+        if claimed is None:
+            break
+
+        range_id, from_block, to_block = claimed
+        print('%s (worker %s): get %s logs from block %s to block %s' % (
+            contract_name, worker, event_names, from_block, to_block))
+        # the span of the next request, an idle worker only steals the part of the range after it
+        end = [scheduler.advance(range_id, from_block, chunk_sizer.chunk * batch_size)]
+        try:
+            with metrics.stage(_stage_name(contract_name, event_names), worker):
+                for _from, _to, logs in contract.iter_event_logs(
+                    event_names,
+                    from_block,
+                    to_block,
+                    {},
+                    web3,
+                    verbose=verbose,
+                    batch_size=batch_size,
+                    chunk_sizer=chunk_sizer,
+                    addresses=addresses,
+                    compact=True,
+                    get_to_block=lambda: end[0]
+                ):
+                    with metrics.timer('store_seconds'):
+                        store.add_logs(addresses, topics, _from, _to, logs)
+                    nlogs += len(logs)
+                    end[0] = scheduler.advance(range_id, _to + 1, chunk_sizer.chunk * batch_size)
+        except Exception as e:
+            print('Error processing event: %s.%s. \n error=%s'% (contract_name, event_names, e))
+            raise
+        finally:
+            metrics.flush()
+        scheduler.finish(range_id)
+
+    print('done processing %s (worker %s) %s events, got %s logs' % (contract_name, worker, event_names, nlogs))
+    return nlogs
+
+
+async def fetch_logs_to_store_async(fetcher, args):
+    (
+        network, i, store_path, contract_addresses, contract_name,
+        abi_path_envvar, event_names, from_block,
+        to_block, chunk_size, batch_size, verbose
+    ) = args
+
+    web3 = get_web3()
+    contract, addresses, topics, chunk_sizer = _prepare_fetch(
+        web3, store_path, contract_addresses, contract_name, abi_path_envvar, event_names, chunk_size)
+    print('%s (%s, %s contracts): get %s logs from block %s to block %s' % (
+        contract_name, i, len(addresses), event_names, from_block, to_block))
+    store = LogStore(store_path)
+    metrics = get_metrics()
+    nlogs = 0
+    try:
+        # each job runs in its own asyncio task, the stage only applies to it
+        with metrics.stage(_stage_name(contract_name, event_names), i):
+            async for _from, _to, logs in fetcher.iter_event_logs(
+                contract, event_names, from_block, to_block, {}, chunk_sizer=chunk_sizer, addresses=addresses,
+                compact=True
+            ):
+                with metrics.timer('store_seconds'):
+                    store.add_logs(addresses, topics, _from, _to, logs)
+                nlogs += len(logs)
+    except Exception as e:
+        print('Error processing event: %s.%s. \n error=%s'% (contract_name, event_names, e))
+        raise
+
+    print('done processing %s (%s) %s events, got %s logs' % (contract_name, i, event_names, nlogs))
+    return nlogs
+
+
+def _stage_name(contract_name, event_names):
+    return '%s %s' % (contract_name, '+'.join(event_names))
+
+
+def _prepare_fetch(web3, store_path, contract_addresses, contract_name, abi_path_envvar, event_names, chunk_size):
+    addresses = [web3.toChecksumAddress(a) for a in contract_addresses]
+    contract = get_contract(contract_name, os.getenv(abi_path_envvar), addresses[0])
+    topics = {e: contract.get_event_signature(e) for e in event_names}
+    density_key = addresses[0] if len(addresses) == 1 else contract_name
+    chunk_sizer = AdaptiveChunkSizer.from_store(
+        os.path.dirname(store_path), density_key, '+'.join(sorted(event_names)), chunk_size)
+    return contract, addresses, topics, chunk_sizer
+
+
+ASYNC_JOBS = {
+    fetch_logs_to_store: fetch_logs_to_store_async,
+}
+
+
+def set_pool_size(process_pool, processes):
+    """Record the number of worker processes `process_pool` was created with."""
+    _pool_sizes[process_pool] = processes
+
+
+def pool_size(process_pool):
+    """Number of worker processes of a multiprocessing pool, see `set_pool_size`."""
+    return _pool_sizes.get(process_pool) or os.cpu_count()
+
+
+def map_jobs(process_pool, job, args_lists):
+    """Run `job` over `args_lists` with a multiprocessing pool or, for an `AsyncLogFetcher`,
+    its asyncio counterpart from `ASYNC_JOBS`."""
+    if isinstance(process_pool, AsyncLogFetcher):
+        return process_pool.map(ASYNC_JOBS[job], args_lists)
+
+    return process_pool.map(job, args_lists)
 
-    return values
 
 # def get_community_transfers(_web3, token_address, token_name, _from, _to, filters=None, chunk_size=500000, sender='donor'):
 #     erc20 = Contract(token_name, os.getenv('ERC20_ABI'), _web3.toChecksumAddress(token_address))
@@ -157,13 +329,21 @@ def extract_community_donors(transfers, communities):
     :param communities:
     :return:
     """
-    donor_value_list = []
-    communities_set = {comm for comm, block in communities}
-    for _from, _to, value, block in transfers:
-        if _to in communities_set:
-            donor_value_list.append((_from.lower(), util.from_base_18(value)))
+    table = get_table(transfers)
+    donor_ids, amounts = extract_community_donations(transfers, communities, table)
+    return list(zip(table.get_addresses(donor_ids), amounts))
 
-    return donor_value_list
+
+def extract_community_donations(transfers, communities, table):
+    """Same as `extract_community_donors` with donors as IDs of `table`.
+
+    :return: (array of donor IDs, list of float amounts)
+    """
+    _from, _to, limbs = transfer_arrays(transfers, table)
+    community_ids = table.get_ids([comm for comm, block in communities])
+    donations = np.nonzero(np.isin(_to, community_ids))[0]
+    values = combine_limbs(limbs[donations].astype(np.int64))
+    return _from[donations].astype(np.int32), [util.from_base_18(value) for value in values]
 
 
 def extract_token_holders(transfers, min_amount=1.0):
@@ -171,26 +351,16 @@ def extract_token_holders(transfers, min_amount=1.0):
         calculations are done using base_18 amounts
         but the returned holder token amounts are in float type, already converted from base_18
     """
-    balances = calculate_balances(transfers)
-    _min_amount = to_base_18(min_amount)
-    balances = {a: from_base_18(value) for a, value in balances.items() if value >= _min_amount}
-    return balances
+    table = get_table(transfers)
+    ids, balances = net_balances(transfers, table)
+    balances = balances_dict(table, ids, balances, min_amount=to_base_18(min_amount))
+    return {a: from_base_18(value) for a, value in balances.items()}
 
 
 def calculate_balances(transfers):
-    _from = [t[0].lower() for t in transfers]
-    _to = [t[1].lower() for t in transfers]
-    _value = [t[2] for t in transfers]
-    _blocks = [t[3] for t in transfers]
-
-    a_to_value = {a: 0 for a in _from}
-    a_to_value.update({a: 0 for a in _to})
-
-    for i, acc_f in enumerate(_from):
-        a_to_value[acc_f] -= int(_value[i])
-        a_to_value[_to[i]] += int(_value[i])
-
-    return a_to_value
+    """{lowercase address: net balance} of all addresses in `transfers`, see `balance_engine`."""
+    table = get_table(transfers)
+    return balances_dict(table, *net_balances(transfers, table))
 
 
 # def _get_pair_swap_logs(args):
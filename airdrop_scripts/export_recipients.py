@@ -1,19 +1,24 @@
 
 # IMCC == Impact Markets Community Contract
-import json
 import os
 import logging
 
 
-from contract import Contract
-from events_helpers import initConnection, get_event_logs, get_community_event_logs, extract_community_donors, \
-    extract_token_holders, extract_transfers_and_save_to_file
+from address_table import get_address_table
+from balance_snapshots import get_community_donors, get_token_holders
+from contract import get_contract
+from async_fetcher import AsyncLogFetcher
+from events_helpers import initConnection, \
+    extract_token_holders, map_jobs, fetch_logs_to_store, fetch_scheduled_logs_to_store, group_contracts_by_block, \
+    get_event_values, pool_size
+from log_store import LogStore, get_store_path
+from metrics import get_metrics
+from range_scheduler import RangeScheduler, coarse_ranges
+from scan_planner import get_profile
+from transfer_cache import get_cache_path, find_cache_path, load_transfers, write_transfers
 from util import from_base_18, get_start_block, get_block_steps, ENV_WEB3_NETWORK
 from web3_instance import get_web3
 
-STEP_SIZE = 100000
-# STEP_SIZE = 20000
-
 impactMarketContract = 'ImpactMarket'
 address_impactMarketContract = '0xe55C3eb4a04F93c3302A5d8058348157561BF5ca'
 imcEvents = ['CommunityAdded', 'CommunityRemoved', 'CommunityMigrated', 'CommunityFactoryChanged']
@@ -26,13 +31,19 @@ communityContract = 'Community'
 ccEvents = []
 
 
-def get_impact_market_info():
+def get_impact_market_info(block_identifier='latest'):
+    """
+    :param block_identifier: block the factory is called at, calls at a block number are
+        served from the RPC response cache on reruns
+    """
     initConnection()
 
-    imarket = Contract('ImpactMarket', os.getenv('IMARKET_ABI'), '0xe55C3eb4a04F93c3302A5d8058348157561BF5ca')
-    comm_factory = Contract('CommunityFactory', os.getenv('CFACTORY_ABI'), '0xF3ba2c917b01627fb90673Aae0E170EE767Af8b6')
-    assert comm_factory.contract_concise.impactMarketAddress() == imarket.contract.address
-    cusd_address = comm_factory.contract_concise.cUSDAddress()
+    imarket = get_contract('ImpactMarket', os.getenv('IMARKET_ABI'), '0xe55C3eb4a04F93c3302A5d8058348157561BF5ca')
+    comm_factory = get_contract('CommunityFactory', os.getenv('CFACTORY_ABI'), '0xF3ba2c917b01627fb90673Aae0E170EE767Af8b6')
+    factory_functions = comm_factory.contract.functions
+    impact_market_address = factory_functions.impactMarketAddress().call(block_identifier=block_identifier)
+    assert impact_market_address == imarket.contract.address
+    cusd_address = factory_functions.cUSDAddress().call(block_identifier=block_identifier)
     celo_address = '0x471ece3750da237f93b8e339c536989b8978a438'
 
     from_block = get_start_block()
@@ -59,102 +70,192 @@ def get_moola_info():
     return moo_token_address, start_block, lending_pool_proxy, lending_pool_block
 
 
-def dispatch_get_all_transfers(process_pool, save_path, from_block, to_block, token_address, token_name, chunk_size=500):
-    _start_name = token_name + '.transfers.'
-    prefix_length = len(_start_name)
-    existing_names = [n[prefix_length:] for n in os.listdir(save_path) if n.startswith(_start_name)]
-    _starting_names = []
-    saved_files = []
-    args_lists = []
+def split_block_range(from_block, to_block, step_size):
+    """Split [from_block, to_block] into consecutive (from, to) ranges of about `step_size` blocks."""
+    if to_block <= from_block:
+        return [(from_block, to_block)]
+
+    _r = get_block_steps(from_block, to_block, step_size)
+    ranges = []
+    _last = _r[0] - 1
+    for i in range(len(_r)-1):
+        _from = _last + 1
+        _last = _r[i+1]
+        ranges.append((_from, _last))
+    return ranges
+
+
+def dispatch_fetch_logs(
+        process_pool, save_path, contracts, contract_name, abi_path_envvar, event_names, from_block, to_block,
+        chunk_size=100000, batch_size=1, max_addresses=100, step_size=None, verbose=False, density_samples=16):
+    """Fetch into the log store the `event_names` logs of `contracts` that are not stored yet.
+
+    With a multiprocessing pool, the missing ranges of a single contract are shared by the pool
+    workers through a work-stealing `RangeScheduler`, starting from partitions with the same
+    expected number of logs when the range is worth `density_samples` probes. With an `AsyncLogFetcher` all chunks are
+    in flight at once anyway, a single contract gets one job per missing range, split in
+    `step_size` blocks pieces when given.
+    Several contracts are grouped by the first block they miss and each group is queried up to
+    `to_block` with a single multi-address eth_getLogs filter.
+
+    :param contracts: list of (address, creation block) tuples
+    :return: LogStore
+    """
+    store = LogStore(get_store_path(save_path))
     network = os.getenv(ENV_WEB3_NETWORK)
+    web3 = get_web3()
+    contract = get_contract(contract_name, os.getenv(abi_path_envvar), web3.toChecksumAddress(contracts[0][0]))
+    topics = [contract.get_event_signature(e) for e in event_names]
 
-    if existing_names:
-        _names = [os.path.splitext(n)[0] if n.endswith('.json') else n for n in existing_names]
-        _starting_ranges = sorted([int(n.split('-')[0]) for n in _names])
-        _ending_ranges = sorted([int(n.split('-')[1]) for n in _names])
-        valid_ranges_i = [i for i, block in enumerate(_ending_ranges) if block <= to_block]
-
-        if valid_ranges_i:
-            _starting_ranges = _starting_ranges[:max(valid_ranges_i)]
-            _ending_ranges = _ending_ranges[:max(valid_ranges_i)]
-
-            first_block = _starting_ranges[0]
-            last_end_block = _ending_ranges[0]
-            missing_ranges = []
-            if from_block < first_block:
-                missing_ranges.append((from_block, first_block-1))
-                _starting_names.append(os.path.join(save_path, '%s.transfers.%s-%s.json' % (token_name, from_block, first_block - 1)))
-
-            _starting_names.append(os.path.join(save_path, '%s.transfers.%s-%s.json' % (token_name, first_block, last_end_block)))
-            for i, start_block in enumerate(_starting_ranges[1:]):
-                d = start_block - last_end_block
-                if d > 1:
-                    missing_ranges.append((last_end_block + 1, start_block - 1))
-                    _starting_names.append(os.path.join(save_path, '%s.transfers.%s-%s.json' % (token_name, last_end_block + 1, start_block - 1)))
-                last_end_block = _ending_ranges[i+1]
-                _starting_names.append(os.path.join(save_path, '%s.transfers.%s-%s.json' % (token_name, start_block, last_end_block)))
-
-            last_block = last_end_block
-            if last_block > from_block:
-                from_block = last_block + 1
-
-        args_lists = []
-        saved_files = _starting_names
-        for _block_range in missing_ranges:
-            _from, _last = _block_range
-            name = os.path.join(save_path, '%s.transfers.%s-%s.json' % (token_name, _from, _last))
-            if os.path.exists(name):
-                print('transfers already completed for range: %s - %s, file %s' % (_from, _last, name))
-                # saved_files.append(name)
-                continue
-
-            print('getting transfers between blocks: %s, %s' % (_from, _last))
-            print('saving transfers to file: %s' % name)
-            # saved_files.append(name)
-            args_lists.append([network, name, token_address, token_name, _from, _last, None, chunk_size])
-
-    if from_block <= to_block:
-        _r = get_block_steps(from_block, to_block, STEP_SIZE)
-        _last = _r[0] - 1
-        for i in range(len(_r)-1):
-            _from = _last + 1
-            _last = _r[i+1]
-            name = os.path.join(save_path, '%s.transfers.%s-%s.json' % (token_name, _from, _last))
-            if os.path.exists(name):
-                print('transfers already completed for range: %s - %s, file %s' % (_from, _last, name))
-                saved_files.append(name)
-                continue
-
-            print('getting transfers between blocks: %s, %s' % (_from, _last))
-            print('saving transfers to file: %s' % name)
-
-            saved_files.append(name)
-            args_lists.append([network, name, token_address, token_name, _from, _last, None, chunk_size])
+    args_lists = []
+    if len(contracts) == 1:
+        address, block = contracts[0]
+        missing = _merge_ranges([
+            r for t in topics for r in store.missing_ranges(address, t, max(from_block, block), to_block)
+        ])
+        if missing and not isinstance(process_pool, AsyncLogFetcher):
+            _scan_scheduled(
+                process_pool, store, network, contract, address, event_names, abi_path_envvar, missing,
+                chunk_size, batch_size, verbose, density_samples
+            )
+            return store
+
+        for _block_range in missing:
+            for _from, _last in split_block_range(*_block_range, step_size) if step_size else [_block_range]:
+                print('getting %s %s logs between blocks: %s, %s' % (contract_name, event_names, _from, _last))
+                args_lists.append((
+                    network, len(args_lists), store.path, [address], contract_name,
+                    abi_path_envvar, event_names, _from,
+                    _last, chunk_size, batch_size, verbose
+                ))
+    else:
+        pending = []
+        for address, block in contracts:
+            missing = _merge_ranges([
+                r for t in topics for r in store.missing_ranges(address, t, max(from_block, block), to_block)
+            ])
+            if missing:
+                pending.append((address, missing[0][0]))
+
+        print('%s of %s %s contracts miss %s logs' % (len(pending), len(contracts), contract_name, event_names))
+        for _from, addresses in group_contracts_by_block(pending, from_block, max_addresses):
+            args_lists.append((
+                network, len(args_lists), store.path, addresses, contract_name,
+                abi_path_envvar, event_names, _from,
+                to_block, chunk_size, batch_size, verbose
+            ))
 
     if args_lists:
-        process_pool.map(extract_transfers_and_save_to_file, args_lists)
-
-    all_transfers = []
-    for name in saved_files:
-        with open(name) as f:
-            transfers = json.load(f)
-            all_transfers.extend(transfers)
-    if all_transfers[-1][3] > to_block:
-        all_transfers = [t for t in all_transfers if t[3] <= to_block]
-    return all_transfers
+        map_jobs(process_pool, fetch_logs_to_store, args_lists)
+
+    return store
+
+
+def _scan_scheduled(
+        process_pool, store, network, contract, address, event_names, abi_path_envvar, missing,
+        chunk_size, batch_size, verbose, density_samples, probe_window=1000):
+    contract_name = contract.contract_name
+    workers = pool_size(process_pool)
+    scheduler = RangeScheduler(store.path, '%s:%s:%s' % (address.lower(), '+'.join(event_names), os.getpid()))
+    if density_samples and sum(_to - _from + 1 for _from, _to in missing) > 10 * density_samples * probe_window:
+        # one range per worker with about the same number of logs, idle workers then split the busy ones
+        profile = get_profile(
+            os.path.dirname(store.path), contract, event_names, [contract.address], missing[0][0], missing[-1][1],
+            get_web3(), density_samples, probe_window
+        )
+        scheduler.seed(profile.split(missing, workers))
+    else:
+        scheduler.seed(coarse_ranges(missing, workers))
+    print('getting %s %s logs between blocks: %s, %s with %s workers' % (
+        contract_name, event_names, missing[0][0], missing[-1][1], workers))
+    map_jobs(process_pool, fetch_scheduled_logs_to_store, [
+        (
+            network, worker, store.path, scheduler.key, [address], contract_name,
+            abi_path_envvar, event_names, chunk_size, batch_size, verbose
+        )
+        for worker in range(workers)
+    ])
+    summary = scheduler.summary()
+    print('%s %s logs scanned in %s ranges, %s of them stolen by idle workers' % (
+        contract_name, event_names, summary['ranges'], summary['stolen']))
+    scheduler.clear()
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for _from, _to in sorted(ranges):
+        if merged and _from <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], _to))
+        else:
+            merged.append((_from, _to))
+    return merged
+
+
+def dispatch_get_all_transfers(
+        process_pool, save_path, from_block, to_block, token_address, token_name, chunk_size=500, batch_size=20):
+    """Return the token transfers between `from_block` and `to_block` as a memory-mapped
+    `TransferColumns`. The cache of an earlier, shorter range is extended with the transfers
+    after its last block instead of being rewritten from the log store."""
+    table = get_address_table(save_path)
+    cache_path = get_cache_path(save_path, token_name, from_block, to_block)
+    transfers = _load_transfers_cache(cache_path, table)
+    if transfers is not None:
+        print('loading %s transfers from %s' % (token_name, cache_path))
+        return transfers
+
+    base_path = find_cache_path(save_path, token_name, from_block, to_block)
+    base = _load_transfers_cache(base_path, table) if base_path else None
+    new_from_block = base.to_block + 1 if base is not None else from_block
+
+    event_name_Transfer = 'Transfer'
+    store = dispatch_fetch_logs(
+        process_pool, save_path, [(token_address, from_block)], token_name, 'ERC20_ABI', [event_name_Transfer],
+        from_block, to_block, chunk_size, batch_size
+    )
+    erc20 = get_contract(token_name, os.getenv('ERC20_ABI'), get_web3().toChecksumAddress(token_address))
+    logs = store.iter_logs(token_address, erc20.get_event_signature(event_name_Transfer), new_from_block, to_block)
+    metrics = get_metrics()
+    with metrics.stage('%s transfers cache' % token_name), metrics.timer('aggregate_seconds'):
+        n = write_transfers(cache_path, logs, table, from_block, to_block, base=base)
+        metrics.add(logs=n)
+    if base is not None:
+        print('extended %s transfers of %s to %s transfers' % (token_name, base_path, n))
+        base.close()
+        # the extended cache holds all of its transfers
+        os.remove(base_path)
+    print('saved %s %s transfers to %s' % (n, token_name, cache_path))
+    return load_transfers(cache_path, table)
+
+
+def _load_transfers_cache(path, table):
+    """Load a transfers cache, None if it doesn't exist or was written with another format or address table."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return load_transfers(path, table)
+    except ValueError as e:
+        print('ignoring transfers cache: %s' % e)
+        os.remove(path)
+        return None
 
 
 def process_cUSD_token(process_pool, save_path, start_block, target_block, cusd_address, communities):
     cusd_transfers = dispatch_get_all_transfers(process_pool, save_path, start_block, target_block, cusd_address, 'cUSD')
-    cusd_donors_list = extract_community_donors(cusd_transfers, communities)
-    cusd_holders = extract_token_holders(cusd_transfers, min_amount=10.0)
+    metrics = get_metrics()
+    with metrics.stage('cUSD aggregation'), metrics.timer('aggregate_seconds'):
+        cusd_donors_list = get_community_donors(save_path, 'cUSD', cusd_address, start_block, cusd_transfers, communities)
+        cusd_holders = get_token_holders(save_path, 'cUSD', cusd_address, start_block, cusd_transfers, min_amount=10.0)
+        metrics.add(logs=len(cusd_transfers))
     return cusd_transfers, cusd_donors_list, cusd_holders
 
 
 def process_celo_token(process_pool, save_path, start_block, target_block, celo_address, communities):
     celo_transfers = dispatch_get_all_transfers(process_pool, save_path, start_block, target_block, celo_address, 'CELO')
-    celo_donors_list = extract_community_donors(celo_transfers, communities)
-    celo_holders = extract_token_holders(celo_transfers, min_amount=1.0)
+    metrics = get_metrics()
+    with metrics.stage('CELO aggregation'), metrics.timer('aggregate_seconds'):
+        celo_donors_list = get_community_donors(save_path, 'CELO', celo_address, start_block, celo_transfers, communities)
+        celo_holders = get_token_holders(save_path, 'CELO', celo_address, start_block, celo_transfers, min_amount=1.0)
+        metrics.add(logs=len(celo_transfers))
     return celo_transfers, celo_donors_list, celo_holders
 
 
@@ -170,174 +271,89 @@ def process_moo_token(process_pool, save_path, start_block, target_block, moo_ad
     return moo_transfers, moo_holders
 
 
+def dispatch_community_event_logs(
+        process_pool, save_path, communities, from_block, to_block, event_names, chunk_size=100000):
+    """Fetch the logs of `event_names` of all communities into the log store, communities are
+    grouped by creation block and each group is queried with a single multi-address eth_getLogs
+    filter that matches all of `event_names`."""
+    return dispatch_fetch_logs(
+        process_pool, save_path, communities, 'Community', 'COMMUNITY_ABI', event_names,
+        from_block, to_block, chunk_size
+    )
+
+
+def get_community_event_values(
+        process_pool, save_path, communities, from_block, to_block, event_name, args_names, chunk_size=100000):
+    """Return the `args_names` values and block number of all communities' `event_name` logs."""
+    store = dispatch_community_event_logs(
+        process_pool, save_path, communities, from_block, to_block, [event_name], chunk_size
+    )
+    comm_contract = get_contract('Community', os.getenv('COMMUNITY_ABI'), get_web3().toChecksumAddress(communities[0][0]))
+    topic0 = comm_contract.get_event_signature(event_name)
+    event_abi = comm_contract.get_event_abi(event_name)
+    values = []
+    for comm, block in communities:
+        logs = store.get_logs(comm, topic0, max(from_block, block), to_block)
+        values.extend(get_event_values(logs, args_names, event_abi))
+    return values
+
+
 def get_impact_market_managers(process_pool, save_path, communities, from_block, to_block, chunk_size=100000):
     # All managers via the event ManagerAdded(address indexed _account); event
-    main_name = os.path.join(save_path, 'managers.%s-%s.json' % (from_block, to_block))
-    if os.path.exists(main_name):
-        with open(main_name) as f:
-            managers = json.load(f)
-            return managers
-
-    event_name_ManagerAdded = 'ManagerAdded'
-    args_lists = []
-    saved_files = []
-    network = os.getenv(ENV_WEB3_NETWORK)
-    for i, (comm, block) in enumerate(communities):
-        _from = max(from_block, block)
-        name = os.path.join(save_path, 'comm-managers.%s.%s-%s.json' % (comm, _from, to_block))
-        saved_files.append(name)
-        if os.path.exists(name):
-            print('community (%s) managers already processed for %s' % (i, comm))
-            continue
-
-        print('saving community managers to file: %s' % name)
-        args_lists.append((
-            network, i, name, comm, 'Community',
-            'COMMUNITY_ABI', event_name_ManagerAdded, ['_account'], _from,
-            to_block, chunk_size, False
-        ))
-
-    process_pool.map(get_event_logs, args_lists)
-    managers = []
-    for name in saved_files:
-        with open(name) as f:
-            manager_list = json.load(f)
-            managers.extend(manager_list)
-
-    with open(main_name, 'w') as f:
-        json.dump(managers, f)
-
-    return managers
+    return get_community_event_values(
+        process_pool, save_path, communities, from_block, to_block, 'ManagerAdded', ['_account'], chunk_size
+    )
 
 
 def get_impact_market_beneficiaries0(process_pool, save_path, communities, from_block, to_block, chunk_size=100000):
     # All beneficiaries via the event BeneficiaryClaim(address indexed _account, uint256 _amount);  event
-    main_name = os.path.join(save_path, 'beneficiary_claims.%s-%s.json' % (from_block, to_block))
-    if os.path.exists(main_name):
-        with open(main_name) as f:
-            beneficiary_claims = json.load(f)
-            return beneficiary_claims
-
-    event_name_BeneficiaryClaim = 'BeneficiaryClaim'
-    args_lists = []
-    saved_files = []
-    network = os.getenv(ENV_WEB3_NETWORK)
-    for i, (comm, block) in enumerate(communities):
-        _from = max(from_block, block)
-        name = os.path.join(save_path, 'comm.%s.%s-%s.json' % (comm, _from, to_block))
-        saved_files.append(name)
-        if os.path.exists(name):
-            print('community (%s) beneficiaries already processed for %s' % (i, comm))
-            continue
-
-        print('saving beneficiaries to file: %s' % name)
-        args_lists.append((
-            network, i, name, comm, 'Community',
-            'COMMUNITY_ABI', event_name_BeneficiaryClaim, ['_account', '_amount'], _from,
-            to_block, chunk_size, False
-        ))
-
-    process_pool.map(get_event_logs, args_lists)
-
-    beneficiary_claims = []
-    for name in saved_files:
-        with open(name) as f:
-            address_claim_list = json.load(f)
-            beneficiary_claims.extend([(a, from_base_18(value)) for a, value, _block in address_claim_list])
-
-    with open(main_name, 'w') as f:
-        json.dump(beneficiary_claims, f)
-
-    return beneficiary_claims
+    address_claim_list = get_community_event_values(
+        process_pool, save_path, communities, from_block, to_block,
+        'BeneficiaryClaim', ['_account', '_amount'], chunk_size
+    )
+    return [(a, from_base_18(value)) for a, value, _block in address_claim_list]
 
 def get_impact_market_beneficiaries(process_pool, save_path, communities, from_block, to_block, chunk_size=100000):
     # All beneficiaries via the event BeneficiaryAdded(address indexed _account);  event
-    main_name = os.path.join(save_path, 'beneficiary_added.%s-%s.json' % (from_block, to_block))
-    if os.path.exists(main_name):
-        with open(main_name) as f:
-            beneficiary_added = json.load(f)
-            return beneficiary_added
-
-    event_name_BeneficiaryAdded = 'BeneficiaryAdded'
-    args_lists = []
-    saved_files = []
-    network = os.getenv(ENV_WEB3_NETWORK)
-    for i, (comm, block) in enumerate(communities):
-        _from = max(from_block, block)
-        name = os.path.join(save_path, 'comm.%s.%s-%s.json' % (comm, _from, to_block))
-        saved_files.append(name)
-        if os.path.exists(name):
-            print('community (%s) beneficiaries already processed for %s' % (i, comm))
-            continue
-
-        print('saving beneficiaries to file: %s' % name)
-        args_lists.append((
-            network, i, name, comm, 'Community',
-            'COMMUNITY_ABI', event_name_BeneficiaryAdded, ['_account'], _from,
-            to_block, chunk_size, False
-        ))
-
-    process_pool.map(get_event_logs, args_lists)
-
-    beneficiary_added = []
-    for name in saved_files:
-        with open(name) as f:
-            address_added_list = json.load(f)
-            beneficiary_added.extend([(a) for a, _block in address_added_list])
-
-    with open(main_name, 'w') as f:
-        json.dump(beneficiary_added, f)
-
-    return beneficiary_added
+    address_added_list = get_community_event_values(
+        process_pool, save_path, communities, from_block, to_block, 'BeneficiaryAdded', ['_account'], chunk_size
+    )
+    return [(a) for a, _block in address_added_list]
 
 
 def get_ubeswap_users(process_pool, save_path, blockNumber: int, chunk_size=500):
     ube_token, start_block, ubeswap_factory, ube_swap_router, factory_start_block = get_ubeswap_info()
-    abi_path = os.getenv('UBE_FACTORY_ABI')
-    filters = {}
     web3 = get_web3()
 
     factory_name = 'Factory'
     event_name_PairCreated = 'PairCreated'
     arg_name = 'pair' # a Pair contract address
-    factory_contract = Contract(factory_name, abi_path, web3.toChecksumAddress(ubeswap_factory))
+    factory_contract = get_contract(factory_name, os.getenv('UBE_FACTORY_ABI'), web3.toChecksumAddress(ubeswap_factory))
     print('get pair contracts from block %s to block %s' % (factory_start_block, blockNumber))
-    logs = factory_contract.get_event_logs(
-        event_name_PairCreated,
-        factory_start_block,
-        blockNumber,
-        filters,
-        web3,
-        chunk_size=100000
+    store = dispatch_fetch_logs(
+        process_pool, save_path, [(ubeswap_factory, factory_start_block)], factory_name, 'UBE_FACTORY_ABI',
+        [event_name_PairCreated], factory_start_block, blockNumber, chunk_size=100000
     )
-    pair_contracts = [(l.args[arg_name], l.blockNumber) for l in logs]
+    logs = store.get_logs(
+        ubeswap_factory, factory_contract.get_event_signature(event_name_PairCreated), factory_start_block, blockNumber
+    )
+    pair_contracts = get_event_values(logs, [arg_name], factory_contract.get_event_abi(event_name_PairCreated))
     print('got %s Pair contracts' % len(pair_contracts))
 
     pair_name = 'Pair'
     event_name_Swap = 'Swap'
     arg_name = 'sender' # a user ethereum address
-    args_lists = []
-    saved_files = []
-    network = os.getenv(ENV_WEB3_NETWORK)
-    for i, (pair_address, block) in enumerate(pair_contracts):
-        name = os.path.join(save_path, 'ubeswap.pair%s.swaps.json' % i)
-        saved_files.append(name)
-        if os.path.exists(name):
-            print('pair (%s) swaps already processed.' % (i,))
-            continue
-
-        # args_lists.append((i, name, pair_address, block, blockNumber, chunk_size))
-        args_lists.append((
-            network, i, name, pair_address, pair_name,
-            'UBE_PAIR_ABI', event_name_Swap, [arg_name], block,
-            blockNumber, chunk_size, False
-        ))
-
-    process_pool.map(get_event_logs, args_lists)
+    store = dispatch_fetch_logs(
+        process_pool, save_path, pair_contracts, pair_name, 'UBE_PAIR_ABI',
+        [event_name_Swap], factory_start_block, blockNumber, chunk_size
+    )
+    pair_contract = get_contract(pair_name, os.getenv('UBE_PAIR_ABI'), pair_contracts[0][0])
+    topic0 = pair_contract.get_event_signature(event_name_Swap)
+    event_abi = pair_contract.get_event_abi(event_name_Swap)
     users = []
-    for name in saved_files:
-        with open(name) as f:
-            users.extend(json.load(f))
+    for pair_address, block in pair_contracts:
+        logs = store.get_logs(pair_address, topic0, block, blockNumber)
+        users.extend(get_event_values(logs, [arg_name], event_abi))
 
     return users
 
@@ -347,26 +363,14 @@ def get_moola_users(process_pool, save_path, blockNumber: int, chunk_size=500):
     lendingpool_name = 'LendingPool'
     events_names = ['Deposit', 'Borrow', 'Swap']
     arg_name = '_user' # a user ethereum address
-    saved_files = []
-    args_lists = []
-    network = os.getenv(ENV_WEB3_NETWORK)
-    for e in events_names:
-        name = os.path.join(save_path, 'moola.%s.json' % e)
-        saved_files.append(name)
-        if os.path.exists(name):
-            print('event (%s) logs already processed.' % (e,))
-            continue
-
-        args_lists.append((
-            network, '0', name, moola_lending_pool, lendingpool_name,
-            'MOOLA_LENDINGPOOL_ABI', e, [arg_name], lending_start_block,
-            blockNumber, chunk_size, True
-        ))
-
-    process_pool.map(get_event_logs, args_lists)
+    store = dispatch_fetch_logs(
+        process_pool, save_path, [(moola_lending_pool, lending_start_block)], lendingpool_name,
+        'MOOLA_LENDINGPOOL_ABI', events_names, lending_start_block, blockNumber, chunk_size, verbose=True
+    )
+    lending_pool = get_contract(lendingpool_name, os.getenv('MOOLA_LENDINGPOOL_ABI'), moola_lending_pool)
     users = []
-    for name in saved_files:
-        with open(name) as f:
-            users.extend(json.load(f))
+    for e in events_names:
+        logs = store.get_logs(moola_lending_pool, lending_pool.get_event_signature(e), lending_start_block, blockNumber)
+        users.extend(get_event_values(logs, [arg_name], lending_pool.get_event_abi(e)))
 
     return users
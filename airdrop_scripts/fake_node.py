@@ -0,0 +1,546 @@
+"""Local stand-in of a JSON-RPC node serving a synthetic chain, to measure the pipeline offline.
+
+Only the standard library is used. The chain is a set of `LogStream`s, each one the logs of one
+event of one or more contracts with a configurable density, generated on the fly from the block
+number so any number of logs can be served without storing them. The node answers
+`eth_getLogs`, the log filter methods, `eth_blockNumber`, `eth_getBlockByNumber`,
+`eth_chainId`/`net_version` and `eth_call` (from a table of canned results), alone or in batch
+requests, over HTTP or a websocket, where `eth_subscribe("logs")` pushes the logs of the new
+blocks as the head moves forward. It can inject latency,
+stalled requests (the client's read timeout) and result-size limits like public nodes, and
+`SyntheticChain.reorg` replaces the tail of the chain with a fork.
+
+`benchmark.pipeline_chain` builds the chain of the airdrop pipeline, running this file serves it:
+
+    python fake_node.py [port] [transfers] [blocks]
+"""
+import base64
+import hashlib
+import json
+import math
+import random
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHAIN_ID = 42220
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def to_word(value):
+    """32 bytes hex word (without 0x) of an int or a hex address."""
+    if isinstance(value, str):
+        return value[2:].lower().rjust(64, '0')
+    return '%064x' % value
+
+
+def account_address(i, base=0x10000000):
+    return '0x%040x' % (base + i)
+
+
+def block_hash(block, fork=0):
+    return '0x%064x' % ((fork << 200) + block + 1)
+
+
+def _mix(block, index, seed):
+    # cheap deterministic pseudo random 64 bits of a log
+    x = (block * 0x9E3779B97F4A7C15 + index * 0xBF58476D1CE4E5B9 + seed) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 31
+    x = (x * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 29)
+
+
+class TransferEncoder:
+    """ERC20 `Transfer(address indexed from, address indexed to, uint256 value)` arguments between
+    `accounts` accounts, a `recipient_share` of the transfers go to one of `recipients` instead."""
+
+    def __init__(self, accounts=100000, recipients=(), recipient_share=0.0, seed=0):
+        self.accounts = accounts
+        self.recipients = list(recipients)
+        self.recipient_share = recipient_share
+        self.seed = seed
+
+    def __call__(self, block, index, ordinal):
+        x = _mix(block, index, self.seed)
+        sender = account_address(x % self.accounts)
+        if self.recipients and (x >> 40) % 10000 < self.recipient_share * 10000:
+            recipient = self.recipients[(x >> 20) % len(self.recipients)]
+        else:
+            recipient = account_address((x >> 20) % self.accounts)
+        value = ((x >> 8) % 1000000 + 1) * 10 ** 15
+        return ['0x' + to_word(sender), '0x' + to_word(recipient)], '0x' + to_word(value)
+
+
+class IndexedEncoder:
+    """Arguments of events with indexed addresses and `data_words` uint arguments, e.g.
+    `ManagerAdded(address indexed _account)`. An indexed argument takes the values of its list
+    in order (the n-th log of the stream gets the n-th value) or random accounts when it's None."""
+
+    def __init__(self, indexed=(None,), accounts=100000, data_words=0, seed=0):
+        self.indexed = [list(values) if values is not None else None for values in indexed]
+        self.accounts = accounts
+        self.data_words = data_words
+        self.seed = seed
+
+    def __call__(self, block, index, ordinal):
+        x = _mix(block, index, self.seed)
+        topics = []
+        for i, values in enumerate(self.indexed):
+            if values is not None:
+                address = values[ordinal % len(values)]
+            else:
+                address = account_address((x >> (8 * i)) % self.accounts)
+            topics.append('0x' + to_word(address))
+        data = '0x' + ''.join(to_word((x >> i) % 10 ** 6 * 10 ** 15) for i in range(self.data_words))
+        return topics, data
+
+
+class LogStream:
+    def __init__(self, addresses, topic0, density, encoder, log_index_base=0):
+        """
+        :param addresses: address or list of addresses emitting the logs, the n-th log of the
+            stream comes from the n-th address (modulo their number)
+        :param topic0: hex event signature
+        :param density: logs per block, or list of (from_block, logs per block) segments, the
+            density before the first segment is 0
+        :param encoder: callable (block, index in block, ordinal) -> (topics after topic0, hex data)
+        :param log_index_base: added to the log indexes so streams of a block don't share them
+        """
+        self.addresses = [a.lower() for a in ([addresses] if isinstance(addresses, str) else addresses)]
+        self.topic0 = topic0.lower()
+        self.segments = sorted(density) if isinstance(density, (list, tuple)) else [(0, density)]
+        self.encoder = encoder
+        self.log_index_base = log_index_base
+
+    def cumulative(self, block):
+        """Number of logs before `block`."""
+        total = 0.0
+        for i, (start, logs_per_block) in enumerate(self.segments):
+            if block <= start:
+                break
+            end = self.segments[i + 1][0] if i + 1 < len(self.segments) else math.inf
+            total += (min(block, end) - start) * logs_per_block
+        return int(total)
+
+    def count(self, from_block, to_block):
+        return self.cumulative(to_block + 1) - self.cumulative(from_block)
+
+    def matches(self, addresses, topics):
+        if addresses is not None and not addresses.intersection(self.addresses):
+            return False
+        return topics is None or self.topic0 in topics
+
+    def logs(self, from_block, to_block, addresses=None, fork_of=None):
+        """
+        :param fork_of: callable block -> fork number, the logs of a fork have other arguments
+        """
+        ordinal = self.cumulative(from_block)
+        for block in range(from_block, to_block + 1):
+            n = self.cumulative(block + 1) - ordinal
+            block_hex = hex(block)
+            fork = fork_of(block) if fork_of is not None else 0
+            for index in range(n):
+                address = self.addresses[ordinal % len(self.addresses)]
+                if addresses is None or address in addresses:
+                    topics, data = self.encoder(block + (fork << 40), index, ordinal)
+                    yield {
+                        'address': address,
+                        'topics': [self.topic0] + topics,
+                        'data': data,
+                        'blockNumber': block_hex,
+                        'blockHash': block_hash(block, fork),
+                        'logIndex': hex(self.log_index_base + index),
+                        'transactionIndex': hex(index),
+                        'transactionHash': '0x%064x' % ((block << 24) + self.log_index_base + index),
+                        'removed': False,
+                    }
+                ordinal += 1
+
+
+class SyntheticChain:
+    def __init__(self, streams, head, calls=None, block_time=None):
+        """
+        :param streams: list of `LogStream`s
+        :param head: number of the last block
+        :param calls: dict of (contract address, 4 bytes hex selector) -> hex result of `eth_call`
+        :param block_time: seconds, the head moves forward by a block every `block_time` seconds
+            when given
+        """
+        self.streams = streams
+        self._head = head
+        self.calls = {(to.lower(), selector.lower()): result for (to, selector), result in (calls or {}).items()}
+        self.block_time = block_time
+        self._started = time.time()
+        # (first block, fork number) of each `reorg`
+        self.forks = []
+
+    @property
+    def head(self):
+        if not self.block_time:
+            return self._head
+        return self._head + int((time.time() - self._started) / self.block_time)
+
+    def reorg(self, from_block):
+        """Replace the blocks from `from_block` on with a fork, same number of logs with other arguments."""
+        self.forks.append((from_block, len(self.forks) + 1))
+
+    def fork_of(self, block):
+        fork = 0
+        for start, number in self.forks:
+            if block >= start:
+                fork = number
+        return fork
+
+    def count_logs(self, _filter):
+        from_block, to_block, addresses, topics = self._parse_filter(_filter)
+        return sum(s.count(from_block, to_block) for s in self.streams if s.matches(addresses, topics))
+
+    def get_logs(self, _filter):
+        from_block, to_block, addresses, topics = self._parse_filter(_filter)
+        logs = []
+        for stream in self.streams:
+            if stream.matches(addresses, topics):
+                logs.extend(stream.logs(from_block, to_block, addresses, self.fork_of))
+        if len(self.streams) > 1:
+            logs.sort(key=lambda l: (int(l['blockNumber'], 16), int(l['logIndex'], 16)))
+        return logs
+
+    def _parse_filter(self, _filter):
+        from_block = self._block_number(_filter.get('fromBlock', 'latest'))
+        to_block = min(self._block_number(_filter.get('toBlock', 'latest')), self.head)
+        addresses = _filter.get('address')
+        if addresses is not None:
+            addresses = {a.lower() for a in ([addresses] if isinstance(addresses, str) else addresses)}
+        topics = (_filter.get('topics') or [None])[0]
+        if topics is not None:
+            topics = {t.lower() for t in ([topics] if isinstance(topics, str) else topics)}
+        return from_block, to_block, addresses, topics
+
+    def _block_number(self, block):
+        if block in ('latest', 'pending'):
+            return self.head
+        if block == 'earliest':
+            return 0
+        return int(block, 16) if isinstance(block, str) else int(block)
+
+    def get_block(self, block):
+        number = self._block_number(block)
+        if number > self.head:
+            return None
+        return {
+            'number': hex(number), 'hash': block_hash(number, self.fork_of(number)),
+            'parentHash': block_hash(number - 1, self.fork_of(number - 1)) if number else '0x' + '0' * 64,
+            'timestamp': hex(1587571200 + 5 * number), 'transactions': [],
+        }
+
+    def call(self, transaction):
+        return self.calls.get((transaction.get('to', '').lower(), transaction.get('data', '')[:10].lower()))
+
+
+class NodeSettings:
+    def __init__(self, latency=0.0, latency_per_log=0.0, max_results=None, max_block_range=None,
+                 stall_rate=0.0, stall_above=None, stall=30.0, filter_timeout=300.0, seed=0):
+        """
+        :param latency: seconds added to each request
+        :param latency_per_log: seconds added per log of an `eth_getLogs` response
+        :param max_results: `eth_getLogs` matching more logs fail with a result limit error
+        :param max_block_range: `eth_getLogs` over more blocks fail with a block range error
+        :param stall_rate: fraction of the requests that don't answer for `stall` seconds
+        :param stall_above: `eth_getLogs` matching more logs don't answer for `stall` seconds, the
+            way heavy queries time out on a real node
+        :param stall: seconds, longer than the client timeout to make it time out
+        :param filter_timeout: seconds, log filters that aren't polled for longer are removed
+        """
+        self.latency = latency
+        self.latency_per_log = latency_per_log
+        self.max_results = max_results
+        self.max_block_range = max_block_range
+        self.stall_rate = stall_rate
+        self.stall_above = stall_above
+        self.stall = stall
+        self.filter_timeout = filter_timeout
+        self.random = random.Random(seed)
+
+
+class FakeNode:
+    """JSON-RPC server of a `SyntheticChain`, in a thread of this process (`start`) or in the
+    foreground (`serve_forever`)."""
+
+    def __init__(self, chain, port=8545, settings=None, host='127.0.0.1'):
+        self.chain = chain
+        self.settings = settings or NodeSettings()
+        self.requests = {}
+        # filter id -> [filter params, last block returned by eth_getFilterChanges, last poll time]
+        self.filters = {}
+        self._filter_count = 0
+        # subscription id -> [filter params, last block pushed, websocket connection]
+        self.subscriptions = {}
+        self._lock = threading.Lock()
+        self._pusher = None
+        self.server = _Server((host, port), _make_handler(self))
+        self.port = self.server.server_address[1]
+        self.uri = 'http://%s:%s' % (host, self.port)
+        self.ws_uri = 'ws://%s:%s' % (host, self.port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-node', daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        print('serving the synthetic chain at %s, head %s' % (self.uri, self.chain.head))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def drop_connections(self):
+        """Close all the websocket connections, like a node restart."""
+        with self._lock:
+            connections = {subscription[2] for subscription in self.subscriptions.values()}
+        for connection in connections:
+            connection.close()
+
+    def handle(self, request, connection=None):
+        """Response of a single JSON-RPC request, and the seconds it should be delayed.
+
+        :param connection: `_WebSocket` of the request, subscriptions are only served over websockets
+        """
+        method = request.get('method')
+        params = request.get('params') or []
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+        settings = self.settings
+        delay = settings.latency
+        if settings.stall_rate and settings.random.random() < settings.stall_rate:
+            delay += settings.stall
+
+        if method == 'eth_getLogs':
+            _filter = params[0] if params else {}
+            from_block, to_block = self.chain._parse_filter(_filter)[:2]
+            if settings.max_block_range and to_block - from_block + 1 > settings.max_block_range:
+                return _error(request, -32005, 'block range is too wide, max %s blocks' % settings.max_block_range), delay
+            nlogs = self.chain.count_logs(_filter)
+            if settings.stall_above is not None and nlogs > settings.stall_above:
+                return _error(request, -32000, 'query timeout exceeded'), delay + settings.stall
+            if settings.max_results is not None and nlogs > settings.max_results:
+                return _error(request, -32005, 'query returned more than %s results' % settings.max_results), delay
+            return _result(request, self.chain.get_logs(_filter)), delay + nlogs * settings.latency_per_log
+        if method in ('eth_subscribe', 'eth_unsubscribe'):
+            return self._handle_subscription(request, method, params, connection), delay
+        if method in ('eth_newFilter', 'eth_getFilterLogs', 'eth_getFilterChanges', 'eth_uninstallFilter'):
+            return self._handle_filter(request, method, params), delay
+        if method == 'eth_blockNumber':
+            return _result(request, hex(self.chain.head)), delay
+        if method == 'eth_getBlockByNumber':
+            return _result(request, self.chain.get_block(params[0])), delay
+        if method in ('eth_chainId', 'net_version'):
+            return _result(request, hex(CHAIN_ID) if method == 'eth_chainId' else str(CHAIN_ID)), delay
+        if method == 'eth_call':
+            result = self.chain.call(params[0])
+            if result is None:
+                return _error(request, -32000, 'execution reverted'), delay
+            return _result(request, result), delay
+        return _error(request, -32601, 'the method %s does not exist/is not available' % method), delay
+
+    def _handle_filter(self, request, method, params):
+        with self._lock:
+            if method == 'eth_newFilter':
+                self._filter_count += 1
+                filter_id = hex(self._filter_count)
+                self.filters[filter_id] = [params[0], self.chain.head, time.time()]
+                return _result(request, filter_id)
+            if method == 'eth_uninstallFilter':
+                return _result(request, self.filters.pop(params[0], None) is not None)
+            now = time.time()
+            for filter_id in [i for i, f in self.filters.items() if now - f[2] > self.settings.filter_timeout]:
+                del self.filters[filter_id]
+            if params[0] not in self.filters:
+                return _error(request, -32000, 'filter not found')
+            _filter, last_block = self.filters[params[0]][:2]
+            self.filters[params[0]][2] = now
+            if method == 'eth_getFilterChanges':
+                head = self.chain.head
+                self.filters[params[0]][1] = head
+                from_block = max(last_block + 1, self.chain._parse_filter(_filter)[0])
+                _filter = dict(_filter, fromBlock=hex(from_block), toBlock=hex(head))
+                if from_block > head:
+                    return _result(request, [])
+        return _result(request, self.chain.get_logs(_filter))
+
+    def _handle_subscription(self, request, method, params, connection):
+        if connection is None:
+            return _error(request, -32601, 'notifications not supported')
+        with self._lock:
+            if method == 'eth_unsubscribe':
+                return _result(request, self.subscriptions.pop(params[0], None) is not None)
+            if params[0] != 'logs':
+                return _error(request, -32602, 'unsupported subscription %s' % params[0])
+            self._filter_count += 1
+            subscription_id = hex(self._filter_count)
+            self.subscriptions[subscription_id] = [params[1] if len(params) > 1 else {}, self.chain.head, connection]
+            if self._pusher is None:
+                self._pusher = threading.Thread(target=self._push_logs, name='fake-node-pusher', daemon=True)
+                self._pusher.start()
+        return _result(request, subscription_id)
+
+    def _push_logs(self):
+        # sends the logs of the new blocks to the subscriptions, with the delay of each block
+        while True:
+            time.sleep(0.05)
+            head = self.chain.head
+            with self._lock:
+                subscriptions = [(i, s) for i, s in self.subscriptions.items() if s[1] < head]
+            for subscription_id, subscription in subscriptions:
+                _filter, last_block, connection = subscription
+                subscription[1] = head
+                logs = self.chain.get_logs(dict(_filter, fromBlock=hex(last_block + 1), toBlock=hex(head)))
+                for log in logs:
+                    connection.send_json({
+                        'jsonrpc': '2.0', 'method': 'eth_subscription',
+                        'params': {'subscription': subscription_id, 'result': log},
+                    })
+
+    def close_connection(self, connection):
+        with self._lock:
+            for subscription_id in [i for i, s in self.subscriptions.items() if s[2] is connection]:
+                del self.subscriptions[subscription_id]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients close the connections of the requests they gave up on
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _WebSocket:
+    """Server side of a websocket connection, unfragmented frames only."""
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def receive(self):
+        """(opcode, payload) of the next frame, (None, None) when the connection is closed."""
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None, None
+        length = header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('>H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', self.rfile.read(8))[0]
+        # client frames are masked
+        mask = self.rfile.read(4) if header[1] & 0x80 else None
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return header[0] & 0x0f, payload
+
+    def send(self, opcode, payload):
+        if len(payload) < 126:
+            header = struct.pack('>BB', 0x80 | opcode, len(payload))
+        elif len(payload) < 1 << 16:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, len(payload))
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, len(payload))
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+            except OSError:
+                self.closed = True
+
+    def send_json(self, message):
+        self.send(0x1, json.dumps(message).encode())
+
+    def close(self):
+        self.send(0x8, b'')
+        self.closed = True
+
+
+def _result(request, result):
+    return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+
+def _error(request, code, message):
+    return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': code, 'message': message}}
+
+
+def _make_handler(node):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if isinstance(body, list):
+                handled = [node.handle(request) for request in body]
+                response = [r for r, delay in handled]
+                # the calls of a batch are served concurrently
+                delay = max([d for r, d in handled] or [0])
+            else:
+                response, delay = node.handle(body)
+            if delay:
+                time.sleep(delay)
+            data = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.headers.get('Upgrade', '').lower() != 'websocket':
+                self.send_error(405)
+                return
+            accept = base64.b64encode(
+                hashlib.sha1((self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode()).digest())
+            self.send_response(101)
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', accept.decode())
+            self.end_headers()
+            self.wfile.flush()
+            connection = _WebSocket(self.rfile, self.wfile)
+            try:
+                while not connection.closed:
+                    opcode, payload = connection.receive()
+                    if opcode is None or opcode == 0x8:
+                        break
+                    if opcode == 0x9:
+                        connection.send(0xA, payload)
+                    elif opcode == 0x1:
+                        body = json.loads(payload)
+                        if isinstance(body, list):
+                            response = [node.handle(request, connection)[0] for request in body]
+                        else:
+                            response = node.handle(body, connection)[0]
+                        connection.send_json(response)
+            finally:
+                connection.closed = True
+                node.close_connection(connection)
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    # the pipeline chain needs the ABIs to compute the event topics
+    from benchmark import pipeline_chain
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8545
+    transfers = int(float(sys.argv[2])) if len(sys.argv) > 2 else 1000000
+    blocks = int(float(sys.argv[3])) if len(sys.argv) > 3 else None
+    FakeNode(pipeline_chain(transfers, blocks), port).serve_forever()
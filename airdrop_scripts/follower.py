@@ -0,0 +1,455 @@
+"""Live follower of the airdrop eligibility: keeps the cUSD/CELO balances and holders, community
+donations, communities, managers and beneficiaries current as new blocks arrive, and answers
+queries about an address from memory.
+
+On the first start the state is built up to the head by the steps of the batch pipeline, from the
+log store, transfers caches and checkpoints of `savePath` when they are there. New blocks are
+then tailed with cursor-bounded `eth_getLogs` scans (`Contract.get_event_logs`), and their
+`CommunityAdded`, `ManagerAdded`, `BeneficiaryAdded` and `Transfer` logs are applied to the state,
+block range by block range. The state is saved to `follower.npz` in `savePath` every
+`snapshotInterval` seconds and on exit, a restart loads it and only catches up from its block.
+
+The ranges applied within `confirmations` blocks of the head are kept in a journal with the hash
+of their last block and the values they changed. When a reorg replaces those blocks, the ranges
+after the last block still on the chain are undone and applied again from the new blocks. A
+snapshot of a block that was reorganized while the follower was stopped isn't loaded.
+
+    python follower.py config.json
+
+Queries are served over HTTP on `followerPort` (8000):
+
+    GET /status              last block applied, lag behind the head, number of holders, donors, ...
+    GET /address/<address>   balances, donations and memberships of an address
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from address_table import get_address_table
+from async_fetcher import AsyncLogFetcher
+from balance_snapshots import get_balances, get_community_donors
+from chunk_sizer import AdaptiveChunkSizer
+from contract import get_contract
+from events_helpers import get_imarket_communities
+from export_recipients import dispatch_get_all_transfers, get_impact_market_beneficiaries, \
+    get_impact_market_info, get_impact_market_managers
+from sync_state import get_block_hashes, sync_chain
+from util import from_base_18, get_hedge_kwargs, initConnection, set_envvars, to_base_18
+from web3_instance import get_web3
+
+SNAPSHOT_FILE_NAME = 'follower.npz'
+# min balance of a holder, the same as the batch pipeline's
+HOLDER_MIN_AMOUNTS = {'cUSD': 10.0, 'CELO': 1.0}
+# balances are saved as 32 byte two's complement values, the net balance of a minting address is negative
+VALUE_BYTES = 32
+MEMBER_EVENTS = ['ManagerAdded', 'BeneficiaryAdded']
+
+
+def get_follower_snapshot_path(save_path):
+    return os.path.join(save_path, SNAPSHOT_FILE_NAME)
+
+
+def _encode_ints(values):
+    data = b''.join(int(v).to_bytes(VALUE_BYTES, 'big', signed=True) for v in values)
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, VALUE_BYTES)
+
+
+def _decode_ints(array):
+    data = array.tobytes()
+    return [int.from_bytes(data[i:i + VALUE_BYTES], 'big', signed=True) for i in range(0, len(data), VALUE_BYTES)]
+
+
+class JournalEntry:
+    def __init__(self, block, block_hash, from_block, token_names):
+        """Undo information of the blocks (from_block, block] applied to a `Follower`."""
+        self.block = block
+        self.block_hash = block_hash
+        self.from_block = from_block
+        self.communities = []
+        self.managers = []
+        self.beneficiaries = []
+        # ID -> value before the range, None when the ID had none
+        self.balances = {token_name: {} for token_name in token_names}
+        self.donations = {token_name: {} for token_name in token_names}
+
+
+class Follower:
+    def __init__(self, save_path, max_blocks=10000, confirmations=20):
+        """
+        :param save_path: `savePath` of the batch pipeline, its address table, caches and log store are used
+        :param max_blocks: max blocks applied at once, a long catch up is applied (and saved) in steps
+        :param confirmations: blocks this far from the head are final, the ranges applied after
+            them can be undone
+        """
+        self.save_path = save_path
+        self.max_blocks = max_blocks
+        self.confirmations = confirmations
+        self.table = get_address_table(save_path)
+        self.block = None
+        self.block_hash = None
+        self.journal = []
+        self.head = None
+        imarket_address, factory_address, cusd_address, celo_address, self.start_block = get_impact_market_info()
+        self.imarket = get_contract('ImpactMarket', os.getenv('IMARKET_ABI'), imarket_address)
+        web3 = get_web3()
+        self.tokens = {
+            'cUSD': get_contract('cUSD', os.getenv('ERC20_ABI'), web3.toChecksumAddress(cusd_address)),
+            'CELO': get_contract('CELO', os.getenv('ERC20_ABI'), web3.toChecksumAddress(celo_address)),
+        }
+        self.balances = {token_name: {} for token_name in self.tokens}
+        self.holders = {token_name: set() for token_name in self.tokens}
+        self.donations = {token_name: {} for token_name in self.tokens}
+        # lowercase address -> creation block
+        self.communities = {}
+        self.community_ids = set()
+        self.managers = set()
+        self.beneficiaries = set()
+        self._sizers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        """Snapshots are only loaded for the same contracts and address table."""
+        return json.dumps([
+            self.table.table_id.hex(), self.imarket.address.lower(),
+            sorted(c.address.lower() for c in self.tokens.values()),
+        ])
+
+    def build(self, fetcher, to_block):
+        """State at `to_block` from the steps of the batch pipeline, `fetcher` is its log fetcher."""
+        web3 = get_web3()
+        print('building the follower state at block %s' % to_block)
+        # the caches of the batch pipeline are rolled back if the chain was reorganized since its last run
+        sync_chain(self.save_path, to_block, self.confirmations)
+        self.block_hash = get_block_hashes([to_block])[to_block]
+        communities = get_imarket_communities(self.save_path, web3, self.imarket.address, self.start_block, to_block)
+        for token_name, token in self.tokens.items():
+            transfers = dispatch_get_all_transfers(fetcher, self.save_path, 1, to_block, token.address, token_name)
+            ids, balances = get_balances(self.save_path, token_name, token.address, 1, transfers)
+            self.balances[token_name] = dict(zip(ids.tolist(), balances.tolist()))
+            donations = self.donations[token_name] = {}
+            for donor, amount in get_community_donors(
+                    self.save_path, token_name, token.address, 1, transfers, communities):
+                donations[donor] = donations.get(donor, 0.0) + amount
+        self._add_communities(communities)
+        if communities:
+            managers = get_impact_market_managers(
+                fetcher, self.save_path, communities, self.start_block, to_block, chunk_size=500000)
+            beneficiaries = get_impact_market_beneficiaries(
+                fetcher, self.save_path, communities, self.start_block, to_block, chunk_size=5000)
+            self.managers = set(self.table.get_ids([a for a, block in managers]).tolist()) if managers else set()
+            self.beneficiaries = set(self.table.get_ids(beneficiaries).tolist()) if beneficiaries else set()
+        for token_name in self.tokens:
+            self._update_holders(token_name, self.balances[token_name])
+        self.block = to_block
+
+    def load_snapshot(self):
+        """Load the state saved by `save_snapshot`, False when there is none for these contracts."""
+        path = get_follower_snapshot_path(self.save_path)
+        if not os.path.exists(path):
+            return False
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['key']) != self.key:
+                print('ignoring follower snapshot %s of other contracts or address table' % path)
+                return False
+            block = int(data['block'])
+            block_hash = str(data['block_hash']) if 'block_hash' in data.files else None
+            if block_hash is None or block_hash != get_block_hashes([block])[block]:
+                print('ignoring follower snapshot %s, block %s was reorganized' % (path, block))
+                return False
+            for token_name in self.tokens:
+                self.balances[token_name] = dict(zip(
+                    data['%s_ids' % token_name].tolist(), _decode_ints(data['%s_balances' % token_name])))
+                self.donations[token_name] = dict(zip(
+                    data['%s_donor_ids' % token_name].tolist(), data['%s_donations' % token_name].tolist()))
+                self._update_holders(token_name, self.balances[token_name])
+            self._add_communities(zip(
+                self.table.get_addresses(data['community_ids']), data['community_blocks'].tolist()))
+            self.managers = set(data['managers'].tolist())
+            self.beneficiaries = set(data['beneficiaries'].tolist())
+            self.block = block
+            self.block_hash = block_hash
+        print('loaded follower snapshot at block %s' % self.block)
+        return True
+
+    def save_snapshot(self):
+        with self._lock:
+            block = self.block
+            block_hash = self.block_hash
+            balances = {token_name: list(b.items()) for token_name, b in self.balances.items()}
+            donations = {token_name: list(d.items()) for token_name, d in self.donations.items()}
+            communities = list(self.communities.items())
+            managers = list(self.managers)
+            beneficiaries = list(self.beneficiaries)
+
+        # IDs of the state must be in the address table file
+        self.table.save()
+        arrays = {}
+        for token_name in self.tokens:
+            arrays['%s_ids' % token_name] = np.array([i for i, b in balances[token_name]], dtype=np.int32)
+            arrays['%s_balances' % token_name] = _encode_ints([b for i, b in balances[token_name]])
+            arrays['%s_donor_ids' % token_name] = np.array([i for i, a in donations[token_name]], dtype=np.int32)
+            arrays['%s_donations' % token_name] = np.array([a for i, a in donations[token_name]], dtype=np.float64)
+        community_addresses = [a for a, block in communities]
+        arrays['community_ids'] = self.table.get_ids(community_addresses) if communities else np.empty(0, np.int32)
+        arrays['community_blocks'] = np.array([b for a, b in communities], dtype=np.int64)
+        path = get_follower_snapshot_path(self.save_path)
+        tmp_path = '%s.%s.tmp.npz' % (path, os.getpid())
+        np.savez(
+            tmp_path, key=self.key, block=block, block_hash=block_hash or '', managers=np.array(managers, dtype=np.int32),
+            beneficiaries=np.array(beneficiaries, dtype=np.int32), **arrays
+        )
+        os.replace(tmp_path, path)
+
+    def _sizer(self, name):
+        if name not in self._sizers:
+            self._sizers[name] = AdaptiveChunkSizer(1000)
+        return self._sizers[name]
+
+    def _add_communities(self, communities):
+        communities = [(address.lower(), block) for address, block in communities]
+        self.communities.update(communities)
+        if communities:
+            self.community_ids.update(self.table.get_ids([a for a, block in communities]).tolist())
+
+    def _update_holders(self, token_name, balances):
+        min_amount = to_base_18(HOLDER_MIN_AMOUNTS[token_name])
+        holders = self.holders[token_name]
+        for _id, balance in balances.items():
+            if balance >= min_amount:
+                holders.add(_id)
+            else:
+                holders.discard(_id)
+
+    def fetch(self, from_block, to_block):
+        """Logs of the blocks [from_block, to_block]: new communities, the member events of all
+        communities and the token transfers."""
+        web3 = get_web3()
+        community_logs = self.imarket.get_event_logs(
+            'CommunityAdded', from_block, to_block, {}, web3, verbose=False,
+            chunk_sizer=self._sizer('CommunityAdded'), compact=True)
+        abi = self.imarket.get_event_abi('CommunityAdded')
+        arg_i = [arg['name'] for arg in abi['inputs']].index('_communityAddress')
+        new_communities = [(l[arg_i], l[len(abi['inputs'])]) for l in community_logs]
+
+        addresses = sorted(set(self.communities) | {a.lower() for a, block in new_communities})
+        member_logs = []
+        for i in range(0, len(addresses), 100):
+            group = [web3.toChecksumAddress(a) for a in addresses[i:i + 100]]
+            community = get_contract('Community', os.getenv('COMMUNITY_ABI'), group[0])
+            member_logs.extend(community.get_event_logs(
+                MEMBER_EVENTS, from_block, to_block, {}, web3, verbose=False,
+                chunk_sizer=self._sizer('members'), addresses=group, compact=True))
+
+        transfers = {}
+        for token_name, token in self.tokens.items():
+            transfers[token_name] = token.get_event_logs(
+                'Transfer', from_block, to_block, {}, web3, verbose=False,
+                chunk_sizer=self._sizer(token_name), compact=True)
+        return new_communities, member_logs, transfers
+
+    def apply(self, to_block, new_communities, member_logs, transfers, block_hash=None):
+        """Apply the logs of `fetch` up to `to_block`, queries see the state before or after them.
+
+        :param block_hash: hash of `to_block`, fetched before the logs
+        """
+        with self._lock:
+            entry = JournalEntry(to_block, block_hash, self.block, self.tokens)
+            entry.communities = [
+                a for a in {a.lower() for a, block in new_communities} if a not in self.communities]
+            self._add_communities(new_communities)
+            for l in member_logs:
+                # (_account, blockNumber, logIndex, address, event name)
+                members = self.managers if l[-1] == 'ManagerAdded' else self.beneficiaries
+                added = entry.managers if l[-1] == 'ManagerAdded' else entry.beneficiaries
+                _id = self.table.get_id(l[0])
+                if _id not in members:
+                    members.add(_id)
+                    added.append(_id)
+            for token_name, logs in transfers.items():
+                self._apply_transfers(token_name, logs, entry)
+            self.block = to_block
+            self.block_hash = block_hash
+            self.journal.append(entry)
+            # the ranges that became final can't be undone anymore, the last one is kept to
+            # check the chain against
+            final_block = (self.head if self.head is not None else to_block) - self.confirmations
+            while len(self.journal) > 1 and self.journal[0].block <= final_block:
+                self.journal.pop(0)
+
+    def _apply_transfers(self, token_name, logs, entry):
+        if not logs:
+            return
+        ids = self.table.get_ids([l[0] for l in logs] + [l[1] for l in logs]).tolist()
+        n = len(logs)
+        balances = self.balances[token_name]
+        donations = self.donations[token_name]
+        previous_balances = entry.balances[token_name]
+        previous_donations = entry.donations[token_name]
+        changed = {}
+        for i, l in enumerate(logs):
+            _from, _to, value = ids[i], ids[n + i], l[2]
+            previous_balances.setdefault(_from, balances.get(_from))
+            previous_balances.setdefault(_to, balances.get(_to))
+            changed[_from] = balances[_from] = balances.get(_from, 0) - value
+            changed[_to] = balances[_to] = balances.get(_to, 0) + value
+            if _to in self.community_ids:
+                previous_donations.setdefault(_from, donations.get(_from))
+                donations[_from] = donations.get(_from, 0.0) + from_base_18(value)
+        self._update_holders(token_name, changed)
+
+    def _undo(self, entry):
+        for address in entry.communities:
+            del self.communities[address]
+        if entry.communities:
+            self.community_ids.difference_update(self.table.get_ids(entry.communities).tolist())
+        self.managers.difference_update(entry.managers)
+        self.beneficiaries.difference_update(entry.beneficiaries)
+        for token_name in self.tokens:
+            for values, previous in ((self.balances[token_name], entry.balances[token_name]),
+                                     (self.donations[token_name], entry.donations[token_name])):
+                for _id, value in previous.items():
+                    if value is None:
+                        values.pop(_id, None)
+                    else:
+                        values[_id] = value
+            self.holders[token_name].difference_update(
+                _id for _id, value in entry.balances[token_name].items() if value is None)
+            self._update_holders(token_name, {
+                _id: value for _id, value in entry.balances[token_name].items() if value is not None})
+        self.block = entry.from_block
+
+    def rewind(self):
+        """Undo the ranges whose blocks were reorganized, `follow_to` applies the new blocks.
+
+        :return: the block rewound to, None when there was no reorg
+        """
+        if not self.journal:
+            return None
+        last = self.journal[-1]
+        if _same_hash(get_block_hashes([last.block])[last.block], last.block_hash):
+            # its hash commits to all the blocks before it
+            return None
+
+        hashes = get_block_hashes([entry.block for entry in self.journal])
+        with self._lock:
+            while self.journal and not _same_hash(hashes[self.journal[-1].block], self.journal[-1].block_hash):
+                self._undo(self.journal.pop())
+            self.block_hash = self.journal[-1].block_hash if self.journal else None
+        print('chain reorganized, follower rewound to block %s' % self.block)
+        return self.block
+
+    def follow_to(self, to_block):
+        """Apply the blocks after the current block up to `to_block`, `max_blocks` at a time."""
+        while self.block < to_block:
+            _to = min(to_block, self.block + self.max_blocks)
+            # before the logs, a reorg in between then shows as a mismatch on the next `rewind`
+            block_hash = get_block_hashes([_to])[_to]
+            self.apply(_to, *self.fetch(self.block + 1, _to), block_hash=block_hash)
+
+    def run(self, poll_interval=1.0, snapshot_interval=300):
+        """Follow the head until interrupted, saving the state every `snapshot_interval` seconds."""
+        web3 = get_web3()
+        last_snapshot = time.time()
+        try:
+            while True:
+                self.head = web3.eth.blockNumber
+                self.rewind()
+                if self.head > self.block:
+                    self.follow_to(self.head)
+                if time.time() - last_snapshot > snapshot_interval:
+                    self.save_snapshot()
+                    last_snapshot = time.time()
+                time.sleep(poll_interval)
+        finally:
+            self.save_snapshot()
+
+    def lookup(self, address):
+        """Balances, donations and memberships of `address` at the last block applied."""
+        with self._lock:
+            _id = self.table.find_id(address)
+            result = {
+                'address': address.lower(), 'block': self.block,
+                'balances': {}, 'holder': {}, 'donations': {},
+                'community': address.lower() in self.communities,
+                'manager': _id in self.managers, 'beneficiary': _id in self.beneficiaries,
+            }
+            for token_name in self.tokens:
+                result['balances'][token_name] = from_base_18(self.balances[token_name].get(_id, 0))
+                result['holder'][token_name] = _id in self.holders[token_name]
+                result['donations'][token_name] = self.donations[token_name].get(_id, 0.0)
+        return result
+
+    def status(self):
+        with self._lock:
+            return {
+                'block': self.block, 'head': self.head,
+                'lag': self.head - self.block if self.head is not None else None,
+                'holders': {token_name: len(holders) for token_name, holders in self.holders.items()},
+                'donors': {token_name: len(donations) for token_name, donations in self.donations.items()},
+                'communities': len(self.communities), 'managers': len(self.managers),
+                'beneficiaries': len(self.beneficiaries),
+            }
+
+
+def _same_hash(a, b):
+    return a is not None and b is not None and a.lower() == b.lower()
+
+
+def serve(follower, port=8000, host='0.0.0.0'):
+    """Answer the queries of `follower` over HTTP from a thread of this process."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['status']:
+                result = follower.status()
+            elif len(parts) == 2 and parts[0] == 'address' and len(parts[1]) == 42:
+                result = follower.lookup(parts[1])
+            else:
+                self.send_error(404)
+                return
+            data = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='follower-http', daemon=True).start()
+    return server
+
+
+def main(config_file_path):
+    with open(os.path.expanduser(config_file_path)) as f:
+        config_dict = json.load(f)
+    save_path = os.path.expanduser(config_dict.get("savePath", '~/celo_events_dir'))
+    network = config_dict.get("network", "http://localhost:8545")
+    if isinstance(network, list):
+        network = ','.join(network)
+    set_envvars(network, None)
+    web3 = initConnection()
+
+    follower = Follower(save_path, confirmations=config_dict.get("confirmations", 20))
+    if not follower.load_snapshot():
+        fetcher = AsyncLogFetcher(
+            network, max_concurrency=config_dict.get("maxConcurrency", 200), hedge_kwargs=get_hedge_kwargs())
+        follower.build(fetcher, web3.eth.blockNumber)
+        follower.save_snapshot()
+    port = config_dict.get("followerPort", 8000)
+    serve(follower, port)
+    print('following from block %s, queries on port %s' % (follower.block, port))
+    follower.run(config_dict.get("pollInterval", 1.0), config_dict.get("snapshotInterval", 300))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else './config.json')
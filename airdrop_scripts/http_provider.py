@@ -1,18 +1,190 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import requests
+from eth_utils import to_bytes
+from web3.utils.encoding import FriendlyJsonSerde
+
+from metrics import get_metrics
+from response_cache import cacheable_blocks
+from rpc_pool import EndpointPool, HedgePolicy, split_endpoints
 from web3_request import make_post_request
 from web3 import HTTPProvider
 
+# messages of the nodes rejecting a batch for its size, it succeeds once split
+BATCH_LIMIT_ERRORS = ('too large', 'too big', 'batch size', 'batch limit', 'exceeds the limit',
+                      'maximum batch', 'payload')
 
 class CustomHTTPProvider(HTTPProvider):
-    """Override requests to control the connection pool to make it blocking."""
+    """Override requests to control the connection pool to make it blocking.
+
+    `endpoint_uri` can be a comma separated list (or a list) of endpoints, each request
+    then goes to the best healthy endpoint of an `EndpointPool`.
+
+    With `hedge_kwargs={'percentile': 95}` a request that hasn't returned after the 95th
+    percentile of the recent latency of its method is sent again and the first answer
+    wins, see `HedgePolicy`. Latencies are recorded either way, see `latency_stats`.
+
+    With a `response_cache`, results of calls on finalized blocks are served from and saved
+    to the cache, see `response_cache.ResponseCache`.
+    """
+
+    # Max number of calls packed in one JSON-RPC array payload
+    max_batch_size = 100
+    # Max number of requests (first attempts and duplicates) in flight when hedging
+    max_hedge_threads = 32
+
+    def __init__(self, endpoint_uri=None, request_kwargs=None, pool_kwargs=None, hedge_kwargs=None,
+                 response_cache=None):
+        endpoints = split_endpoints(endpoint_uri) if endpoint_uri else []
+        super().__init__(endpoints[0] if endpoints else None, request_kwargs)
+        self.pool = EndpointPool(endpoints or [self.endpoint_uri], **(pool_kwargs or {}))
+        self.hedge = HedgePolicy(**(hedge_kwargs or {}))
+        self._hedge_executor = None
+        self.response_cache = response_cache
+        get_metrics().add_source('rpc', self.latency_stats)
+
+    def __str__(self):
+        return "RPC connection {0}".format(', '.join(e.uri for e in self.pool.endpoints))
+
+    def _get_hedge_executor(self):
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(self.max_hedge_threads, thread_name_prefix='rpc-hedge')
+        return self._hedge_executor
+
+    def latency_stats(self):
+        """Latency histograms per method and hedging counts, see `HedgePolicy.stats`."""
+        return self.hedge.stats()
+
+    def _post(self, request_data, method):
+        """POST `request_data`, hedged when the method's recent latencies allow it: a request
+        still waiting after the hedge delay is sent again, preferably to another endpoint, and
+        the first answer is used.
+
+        A blocking request can't be interrupted, the losing attempt runs until it ends and then
+        only releases its endpoint. The duplicate gets the time the first attempt has left as its
+        timeout, so a slow node doesn't hold the threads and connections of both much longer than
+        an unhedged request would."""
+        delay = self.hedge.delay(method)
+        if delay is None:
+            return self._post_to_pool(request_data, method, [])
+
+        executor = self._get_hedge_executor()
+        tried = []
+        abandoned = threading.Event()
+        # the attempts count into the metrics stage of the caller
+        futures = [executor.submit(
+            contextvars.copy_context().run, self._post_to_pool, request_data, method, tried, None, abandoned)]
+        if wait(futures, timeout=delay).done:
+            return futures[0].result()
+
+        # the first attempt keeps running, its endpoint is skipped for the duplicate if possible
+        timeout = self.get_request_kwargs().get('timeout', 10)
+        if isinstance(timeout, (int, float)):
+            timeout = max(timeout - delay, self.hedge.min_delay)
+        futures.append(executor.submit(
+            contextvars.copy_context().run, self._post_to_pool, request_data, method, list(tried), timeout, abandoned))
+        error = None
+        try:
+            for future in as_completed(futures):
+                try:
+                    raw_response = future.result()
+                except Exception as err:
+                    error = error or err
+                    continue
+                self.hedge.record_hedge(won=future is futures[1])
+                return raw_response
+        finally:
+            abandoned.set()
+        self.hedge.record_hedge(won=False)
+        raise error
+
+    def _post_to_pool(self, request_data, method, tried, timeout=None, abandoned=None):
+        """POST `request_data` to the best endpoint, moving on to the next one on connection
+        errors and server errors. Read timeouts are raised right away so the caller can
+        shrink the request, the timed out endpoint is less likely to be picked next.
+
+        :param tried: list of the endpoints used for this request, each endpoint is added to it
+            when it's picked and is only picked again once all endpoints were tried
+        :param timeout: seconds, instead of the provider's request timeout
+        :param abandoned: `threading.Event` set once another attempt of a hedged request answered,
+            this attempt then only releases its endpoint when it ends
+        """
+        request_kwargs = self.get_request_kwargs()
+        if timeout is not None:
+            request_kwargs = dict(request_kwargs, timeout=timeout)
+        while True:
+            endpoint = self.pool.acquire(exclude=tried)
+            tried.append(endpoint)
+            start_time = time.time()
+            try:
+                raw_response = make_post_request(endpoint.uri, request_data, **request_kwargs)
+            except requests.exceptions.ConnectionError:
+                self._record_failure(endpoint, method, time.time() - start_time)
+                if len(tried) >= len(self.pool):
+                    raise
+                continue
+            except requests.exceptions.Timeout:
+                self._record_failure(endpoint, method, time.time() - start_time)
+                raise
+            except requests.exceptions.HTTPError as err:
+                if err.response is None or err.response.status_code < 500:
+                    # the request was rejected, not the node's fault
+                    self.pool.record_success(endpoint, time.time() - start_time)
+                    raise
+                self._record_failure(endpoint, method, time.time() - start_time)
+                if len(tried) >= len(self.pool):
+                    raise
+                continue
+            except BaseException:
+                # e.g. a truncated response, the endpoint isn't in flight anymore either way
+                self.pool.release(endpoint, time.time() - start_time)
+                raise
+
+            latency = time.time() - start_time
+            if abandoned is not None and abandoned.is_set():
+                # the other attempt answered first, this one still describes the node
+                self.pool.release(endpoint, latency)
+            else:
+                self.pool.record_success(endpoint, latency)
+            self.hedge.record(method, latency)
+            get_metrics().add(bytes=len(raw_response))
+            return raw_response
+
+    def _record_failure(self, endpoint, method, elapsed):
+        self.pool.record_failure(endpoint, elapsed)
+        # the request took at least this long, leaving it out would bias the hedge delay low
+        self.hedge.record(method, elapsed)
 
     def make_request(self, method, params):
+        if self._is_cacheable(method, params):
+            result = self.response_cache.get(method, params)
+            if result is not None:
+                return {"jsonrpc": "2.0", "id": next(self.request_counter), "result": result}
+            response = self._make_request(method, params)
+            if "error" not in response:
+                self.response_cache.put(method, params, response.get("result"))
+            return response
+        return self._make_request(method, params)
+
+    def _is_cacheable(self, method, params):
+        if self.response_cache is None:
+            return False
+        blocks = cacheable_blocks(method, params)
+        if blocks is None:
+            return False
+        if self.response_cache.needs_head(blocks):
+            self._make_request("eth_blockNumber", [])
+        return self.response_cache.is_final(blocks)
+
+    def _make_request(self, method, params):
         self.logger.debug(
             "Making request HTTP. URI: %s, Method: %s", self.endpoint_uri, method
         )
         request_data = self.encode_rpc_request(method, params)
-        raw_response = make_post_request(
-            self.endpoint_uri, request_data, **self.get_request_kwargs()
-        )
+        raw_response = self._post(request_data, method)
         response = self.decode_rpc_response(raw_response)
         self.logger.debug(
             "Getting response HTTP. URI: %s, " "Method: %s, Response: %s",
@@ -20,4 +192,96 @@ class CustomHTTPProvider(HTTPProvider):
             method,
             response,
         )
+        if method == "eth_blockNumber" and self.response_cache is not None and "result" in response:
+            self.response_cache.set_head(int(response["result"], 16))
         return response
+
+    def make_batch_request(self, calls, use_cache=True):
+        """Send many JSON-RPC calls using batched (array) payloads.
+
+        Calls are split into batches of at most `max_batch_size` entries, and a
+        batch that is rejected by the node for being too large is split in half
+        and retried.
+
+        Cached calls are answered from the response cache and only the others are sent.
+
+        :param calls: list of (method, params) tuples
+        :param use_cache: bool, False to send all the calls to the node, e.g. to check the
+            cached blocks themselves
+        :return: list of raw rpc responses in the same order as `calls`
+        """
+        responses = [None] * len(calls)
+        cacheable = [use_cache and self._is_cacheable(method, params) for method, params in calls]
+        for i, (method, params) in enumerate(calls):
+            result = self.response_cache.get(method, params) if cacheable[i] else None
+            if result is not None:
+                responses[i] = {"jsonrpc": "2.0", "id": next(self.request_counter), "result": result}
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        for j in range(0, len(missing), self.max_batch_size):
+            indexes = missing[j:j + self.max_batch_size]
+            for i, response in zip(indexes, self._make_batch_request([calls[i] for i in indexes])):
+                responses[i] = response
+                if cacheable[i] and "error" not in response:
+                    self.response_cache.put(calls[i][0], calls[i][1], response.get("result"))
+        return responses
+
+    def _make_batch_request(self, calls):
+        self.logger.debug(
+            "Making batch request HTTP. URI: %s, Calls: %s", self.endpoint_uri, len(calls)
+        )
+        rpc_list = [
+            {
+                "jsonrpc": "2.0",
+                "method": method,
+                "params": params or [],
+                "id": next(self.request_counter),
+            }
+            for method, params in calls
+        ]
+        request_data = to_bytes(text=FriendlyJsonSerde().json_encode(rpc_list))
+        try:
+            raw_response = self._post(request_data, _batch_method(calls))
+            response = self.decode_rpc_response(raw_response)
+        except requests.exceptions.HTTPError as err:
+            if len(calls) > 1 and _is_payload_too_large(err.response):
+                return self._split_batch_request(calls)
+            raise
+
+        if not isinstance(response, list):
+            # The node rejected the whole batch with a single error object.
+            if len(calls) > 1 and _is_batch_limit_message(str(response.get("error"))):
+                return self._split_batch_request(calls)
+            response = [dict(response, id=r["id"]) for r in rpc_list]
+
+        id_to_response = {r.get("id"): r for r in response}
+        try:
+            return [id_to_response[r["id"]] for r in rpc_list]
+        except KeyError as err:
+            raise ValueError(f"Missing response for batched request id {err}.")
+
+    def _split_batch_request(self, calls):
+        half = len(calls) // 2
+        self.logger.debug("Splitting batch of %s calls in half.", len(calls))
+        return self._make_batch_request(calls[:half]) + self._make_batch_request(calls[half:])
+
+
+def _is_payload_too_large(response):
+    """413, or a 400 whose body reports a size or batch limit, the other 400 are not fixed by
+    splitting the batch."""
+    if response is None:
+        return False
+    if response.status_code == 413:
+        return True
+    return response.status_code == 400 and _is_batch_limit_message(response.text)
+
+
+def _is_batch_limit_message(message):
+    message = message.lower()
+    return any(error in message for error in BATCH_LIMIT_ERRORS)
+
+
+def _batch_method(calls):
+    """Name batches by their method for the latency histograms, `batch` when it's mixed."""
+    methods = {method for method, params in calls}
+    return 'batch:%s' % methods.pop() if len(methods) == 1 else 'batch'
@@ -0,0 +1,122 @@
+"""Fast decoding of raw eth_getLogs entries into compact tuples.
+
+`web3.utils.events.get_event_data` builds nested `AttributeDict`s for every log
+which callers immediately flatten back into tuples. For events whose arguments
+are all static single-word types (addresses, uints, bools, bytes32), e.g. ERC20
+`Transfer` and the Community events, the values can be sliced straight out of
+the topics/data hex strings.
+
+A compact log is a tuple `(*args, blockNumber, logIndex)` with the arguments in
+abi order, addresses are checksummed like web3 does.
+"""
+import re
+from functools import lru_cache
+
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from web3.middleware.pythonic import log_entry_formatter
+from web3.utils.events import get_event_data
+
+# Logs fetched for several contracts or events get these two extra trailing fields
+COMPACT_ADDRESS = -2
+COMPACT_EVENT = -1
+# scalar uints only, `uint256[]` and the other array types are dynamic
+UINT_TYPE = re.compile(r'uint\d*')
+
+
+@lru_cache(maxsize=2 ** 20)
+def checksum_address(hex_address):
+    return to_checksum_address(hex_address)
+
+
+def _to_address(word):
+    return checksum_address('0x' + word[-40:])
+
+
+def _to_int(word):
+    return int(word, 16)
+
+
+def _to_bool(word):
+    return int(word, 16) != 0
+
+
+def _to_bytes32(word):
+    return '0x' + word
+
+
+def _get_converter(_type):
+    if _type == 'address':
+        return _to_address
+    if UINT_TYPE.fullmatch(_type):
+        return _to_int
+    if _type == 'bool':
+        return _to_bool
+    if _type == 'bytes32':
+        return _to_bytes32
+    return None
+
+
+def make_fast_decoder(event_abi):
+    """Return a function that decodes a raw (hex string) log entry of `event_abi` into a
+    compact tuple, or None when the abi has argument types that need the generic decoder."""
+    if event_abi.get('anonymous'):
+        return None
+
+    fields = []
+    topic_i = 1
+    data_i = 0
+    for arg in event_abi['inputs']:
+        convert = _get_converter(arg['type'])
+        if convert is None:
+            return None
+        if arg['indexed']:
+            fields.append((True, topic_i, convert))
+            topic_i += 1
+        else:
+            fields.append((False, 2 + 64 * data_i, convert))
+            data_i += 1
+
+    def decode(entry):
+        topics = entry['topics']
+        data = entry['data']
+        values = [
+            convert(topics[i][2:] if is_topic else data[i:i + 64])
+            for is_topic, i, convert in fields
+        ]
+        values.append(int(entry['blockNumber'], 16))
+        values.append(int(entry['logIndex'], 16))
+        return tuple(values)
+
+    return decode
+
+
+def log_to_compact(log, event_abi):
+    """Convert a log decoded by `get_event_data` to a compact tuple."""
+    return tuple(log.args[arg['name']] for arg in event_abi['inputs']) + (log.blockNumber, log.logIndex)
+
+
+class CompactLogDecoder:
+    """Decode raw log entries of one or several events into compact tuples, using a fast
+    decoder for each event when possible and `get_event_data` otherwise."""
+
+    def __init__(self, abi, with_source=False):
+        """
+        :param abi: event abi or list of event abis
+        :param with_source: bool append the log address and event name to each tuple
+        """
+        self.with_source = with_source
+        abis = abi if isinstance(abi, list) else [abi]
+        self._decoders = {
+            '0x' + event_abi_to_log_topic(a).hex(): (a, make_fast_decoder(a)) for a in abis
+        }
+
+    def __call__(self, entry):
+        event_abi, decode = self._decoders[entry['topics'][0]]
+        if decode is not None:
+            values = decode(entry)
+        else:
+            values = log_to_compact(get_event_data(event_abi, log_entry_formatter(entry)), event_abi)
+
+        if self.with_source:
+            return values + (checksum_address(entry['address']), event_abi['name'])
+        return values
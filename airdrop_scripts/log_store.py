@@ -0,0 +1,181 @@
+"""Local sqlite store of fetched event logs.
+
+Logs are keyed by (contract address, topic0, block, logIndex) and a coverage
+table records which block ranges were already scanned for each contract/event,
+so finding the ranges still missing between two blocks is a single indexed
+query and fetched logs are added in one transaction together with their
+coverage. The hashes of the blocks a sync ended at are kept with them, so a
+reorg of blocks that were already scanned can be detected and rolled back,
+see `sync_state`.
+"""
+import json
+import os
+import sqlite3
+
+STORE_FILE_NAME = 'logs.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS logs (
+    address TEXT NOT NULL,
+    topic0 TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    args TEXT NOT NULL,
+    PRIMARY KEY (address, topic0, block, log_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    address TEXT NOT NULL,
+    topic0 TEXT NOT NULL,
+    from_block INTEGER NOT NULL,
+    to_block INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coverage_range ON coverage (address, topic0, from_block);
+CREATE TABLE IF NOT EXISTS block_hashes (
+    block INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL,
+    boundary INTEGER NOT NULL
+);
+'''
+
+
+def get_store_path(save_path):
+    return os.path.join(save_path, STORE_FILE_NAME)
+
+
+class LogStore:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared with forked worker processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_coverage(self, address, topic0, from_block, to_block):
+        """Return the sorted (from, to) ranges already scanned that overlap [from_block, to_block]."""
+        return self.conn.execute(
+            'SELECT from_block, to_block FROM coverage '
+            'WHERE address = ? AND topic0 = ? AND from_block <= ? AND to_block >= ? '
+            'ORDER BY from_block',
+            (address.lower(), topic0, to_block, from_block)
+        ).fetchall()
+
+    def missing_ranges(self, address, topic0, from_block, to_block):
+        """Return the (from, to) ranges between `from_block` and `to_block` not scanned yet."""
+        missing = []
+        _from = from_block
+        for start, end in self.get_coverage(address, topic0, from_block, to_block):
+            if start > _from:
+                missing.append((_from, start - 1))
+            _from = max(_from, end + 1)
+        if _from <= to_block:
+            missing.append((_from, to_block))
+        return missing
+
+    def add_logs(self, addresses, topics, from_block, to_block, logs):
+        """Add compact logs fetched for `addresses` and `topics` between `from_block` and `to_block`
+        and mark that range as scanned for every (address, topic) pair.
+
+        :param addresses: list of contract addresses that were scanned
+        :param topics: dict of event name -> topic0 of the events that were scanned
+        :param logs: compact log tuples `(*args, blockNumber, logIndex, address, event_name)`
+        """
+        rows = (
+            (l[-2].lower(), topics[l[-1]], l[-4], l[-3], json.dumps(l[:-4]))
+            for l in logs
+        )
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?)', rows)
+            for address in addresses:
+                for topic0 in topics.values():
+                    self._add_coverage(conn, address.lower(), topic0, from_block, to_block)
+
+    def _add_coverage(self, conn, address, topic0, from_block, to_block):
+        overlapping = conn.execute(
+            'SELECT from_block, to_block FROM coverage '
+            'WHERE address = ? AND topic0 = ? AND from_block <= ? AND to_block >= ?',
+            (address, topic0, to_block + 1, from_block - 1)
+        ).fetchall()
+        if overlapping:
+            from_block = min([from_block] + [r[0] for r in overlapping])
+            to_block = max([to_block] + [r[1] for r in overlapping])
+            conn.execute(
+                'DELETE FROM coverage WHERE address = ? AND topic0 = ? AND from_block >= ? AND to_block <= ?',
+                (address, topic0, from_block, to_block)
+            )
+        conn.execute('INSERT INTO coverage VALUES (?, ?, ?, ?)', (address, topic0, from_block, to_block))
+
+    def iter_logs(self, address, topic0, from_block, to_block):
+        """Iterate the stored compact logs `(*args, blockNumber, logIndex)` ordered by block and log index."""
+        cursor = self.conn.execute(
+            'SELECT args, block, log_index FROM logs '
+            'WHERE address = ? AND topic0 = ? AND block >= ? AND block <= ? '
+            'ORDER BY block, log_index',
+            (address.lower(), topic0, from_block, to_block)
+        )
+        for args, block, log_index in cursor:
+            yield tuple(json.loads(args)) + (block, log_index)
+
+    def get_logs(self, address, topic0, from_block, to_block):
+        return list(self.iter_logs(address, topic0, from_block, to_block))
+
+    def add_block_hashes(self, hashes, boundary):
+        """Record the hashes of synced blocks.
+
+        :param hashes: dict of block number -> hex block hash
+        :param boundary: int, the last block of the sync, its hash is kept after it is final
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO block_hashes VALUES (?, ?, ?)',
+                ((block, block_hash, int(block == boundary)) for block, block_hash in hashes.items())
+            )
+
+    def get_block_hashes(self):
+        """Return the recorded (block, hash) pairs, newest block first."""
+        return self.conn.execute('SELECT block, hash FROM block_hashes ORDER BY block DESC').fetchall()
+
+    def prune_block_hashes(self, final_block):
+        """Forget the hashes of the blocks up to `final_block` that aren't sync boundaries."""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM block_hashes WHERE block <= ? AND boundary = 0', (final_block,))
+
+    def rollback(self, block):
+        """Forget the logs, coverage and block hashes after `block`, as if it was the last block ever scanned.
+
+        :return: number of logs removed
+        """
+        with self._transaction() as conn:
+            removed = conn.execute('DELETE FROM logs WHERE block > ?', (block,)).rowcount
+            conn.execute('DELETE FROM coverage WHERE from_block > ?', (block,))
+            conn.execute('UPDATE coverage SET to_block = ? WHERE to_block > ?', (block, block))
+            conn.execute('DELETE FROM block_hashes WHERE block > ?', (block,))
+        return removed
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
@@ -0,0 +1,302 @@
+"""Push delivery of event logs with `eth_subscribe("logs", filter)` over a websocket.
+
+The node sends the logs of each new block as soon as it imports it, so a listener doesn't wait
+for its next poll and there is no traffic while nothing happens. A websocket connection can drop
+though, and the logs of the blocks imported in the meantime are never pushed: each subscription
+keeps the (block, logIndex) cursor of the last log it delivered, and after a reconnect it is
+subscribed again and the missed block gap is backfilled with `eth_getLogs`, the logs pushed
+during the backfill are delivered after it and the ones already delivered are skipped.
+
+Callbacks are called in the order of the logs, from a single dispatch thread so a slow callback
+doesn't hold up the connection.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import queue
+import threading
+
+import aiohttp
+
+from chunk_sizer import is_result_limit_error
+
+logger = logging.getLogger(__name__)
+
+# above any log index, the cursor of a subscription that delivered all the logs of its block
+END_OF_BLOCK = 1 << 62
+
+
+def log_position(log):
+    """(block number, log index) of a raw log."""
+    return int(log['blockNumber'], 16), int(log['logIndex'], 16)
+
+
+class LogSubscription:
+    def __init__(self, params, callback, from_block=None, error_callback=None):
+        """
+        :param params: `eth_subscribe` logs filter, `address` and `topics`
+        :param callback: called with each raw log
+        :param from_block: int, the logs from this block are backfilled when the subscription
+            starts, only the logs of the new blocks are delivered without it
+        :param error_callback: called with the error when the node refuses the subscription
+        """
+        self.params = params
+        self.callback = callback
+        self.error_callback = error_callback
+        self.cursor = (from_block - 1, END_OF_BLOCK) if from_block is not None else None
+        self.server_id = None
+        self.backfilling = False
+        self.pending = []
+        # seconds before the next attempt after a failed backfill
+        self.retry_delay = None
+
+
+class LogSubscriber:
+
+    """Websocket connection of the log subscriptions of a process, reconnected when it drops.
+
+    The connection runs in an asyncio loop of its own thread, started with the first subscription.
+    """
+
+    def __init__(self, endpoint_uri, reconnect_delay=1.0, max_reconnect_delay=30.0, backfill_chunk=10000):
+        """
+        :param endpoint_uri: ws:// or wss:// URI of the node
+        :param reconnect_delay: seconds before the first reconnection attempt, doubled after each
+            failed one up to `max_reconnect_delay`
+        :param backfill_chunk: blocks per `eth_getLogs` of a backfill, halved on result limit errors
+        """
+        self.endpoint_uri = endpoint_uri
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.backfill_chunk = backfill_chunk
+        self.reconnects = 0
+        self._subscriptions = {}
+        self._by_server_id = {}
+        self._ids = itertools.count(1)
+        self._requests = {}
+        self._subscribing = {}
+        self._ws = None
+        self._loop = None
+        self._lock = threading.Lock()
+        self._dispatch_queue = queue.Queue()
+        self._connected = threading.Event()
+
+    def subscribe(self, params, callback, from_block=None, error_callback=None):
+        """Deliver the raw logs matching `params` to `callback`, see `LogSubscription`.
+
+        :return: id of the subscription for `unsubscribe`
+        """
+        subscription = LogSubscription(params, callback, from_block, error_callback)
+        subscription_id = next(self._ids)
+        with self._lock:
+            self._subscriptions[subscription_id] = subscription
+            if self._loop is None:
+                self._start()
+        asyncio.run_coroutine_threadsafe(self._activate(subscription), self._loop)
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        with self._lock:
+            subscription = self._subscriptions.pop(subscription_id, None)
+        if subscription is not None and subscription.server_id is not None:
+            asyncio.run_coroutine_threadsafe(self._unsubscribe(subscription), self._loop)
+
+    def wait_connected(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _start(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._run_loop, name='log-subscriber', daemon=True).start()
+        threading.Thread(target=self._dispatch, name='log-dispatcher', daemon=True).start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._run())
+
+    def _dispatch(self):
+        while True:
+            callback, arg = self._dispatch_queue.get()
+            try:
+                callback(arg)
+            except Exception as err:
+                logger.error(f"Error in log subscription callback: {str(err)}")
+
+    async def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.endpoint_uri, heartbeat=30, max_msg_size=0) as ws:
+                        self._ws = ws
+                        delay = self.reconnect_delay
+                        reader = asyncio.ensure_future(self._read(ws))
+                        with self._lock:
+                            subscriptions = list(self._subscriptions.values())
+                        self._connected.set()
+                        for subscription in subscriptions:
+                            asyncio.ensure_future(self._activate(subscription))
+                        await reader
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as err:
+                logger.info(f"log subscriptions websocket {self.endpoint_uri}: {str(err)}")
+            finally:
+                self._disconnected()
+
+            logger.info(f"reconnecting to {self.endpoint_uri} in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, self.max_reconnect_delay)
+            self.reconnects += 1
+
+    def _disconnected(self):
+        self._ws = None
+        self._connected.clear()
+        self._by_server_id.clear()
+        self._subscribing.clear()
+        for future in self._requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError('websocket connection closed'))
+        self._requests.clear()
+        with self._lock:
+            for subscription in self._subscriptions.values():
+                subscription.server_id = None
+
+    async def _read(self, ws):
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+            self._on_message(json.loads(message.data))
+
+    def _on_message(self, message):
+        if message.get('method') == 'eth_subscription':
+            params = message['params']
+            subscription = self._by_server_id.get(params['subscription'])
+            if subscription is None:
+                return
+            if subscription.backfilling:
+                subscription.pending.append(params['result'])
+            else:
+                self._deliver(subscription, params['result'])
+            return
+
+        subscription = self._subscribing.pop(message.get('id'), None)
+        if subscription is not None and 'result' in message:
+            # registered here rather than by the caller, the first logs can follow the response
+            subscription.server_id = message['result']
+            self._by_server_id[subscription.server_id] = subscription
+        future = self._requests.pop(message.get('id'), None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    async def _request(self, method, params, subscription=None):
+        if self._ws is None:
+            raise ConnectionError('websocket is not connected')
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._requests[request_id] = future
+        if subscription is not None:
+            self._subscribing[request_id] = subscription
+        await self._ws.send_str(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id}))
+        response = await future
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    async def _activate(self, subscription):
+        """Subscribe on the current connection, then backfill from the subscription's cursor.
+
+        When the backfill fails the subscription is dropped without delivering the logs pushed in
+        the meantime, they are after the gap, and it is activated again after a backoff.
+        """
+        if self._ws is None or subscription.server_id is not None or subscription.backfilling:
+            return
+        if subscription not in self._subscriptions.values():
+            return
+        subscription.backfilling = True
+        subscription.pending = []
+        failed = False
+        try:
+            if subscription.cursor is None:
+                # only the blocks imported after this one are delivered
+                head = int(await self._request('eth_blockNumber', []), 16)
+                subscription.cursor = (head, END_OF_BLOCK)
+            await self._request('eth_subscribe', ['logs', subscription.params], subscription)
+            if subscription not in self._subscriptions.values():
+                # unsubscribed in the meantime
+                await self._unsubscribe(subscription)
+                return
+            # the blocks before the head are backfilled, the newer ones are pushed
+            await self._backfill(subscription, int(await self._request('eth_blockNumber', []), 16))
+        except ConnectionError:
+            # resubscribed by the next connection
+            return
+        except Exception as err:
+            if isinstance(err, ValueError) and subscription.server_id is None:
+                logger.info(f"log subscription refused: {str(err)}")
+                with self._lock:
+                    refused = [i for i, s in self._subscriptions.items() if s is subscription]
+                    for i in refused:
+                        del self._subscriptions[i]
+                if subscription.error_callback is not None:
+                    self._dispatch_queue.put((subscription.error_callback, err))
+                return
+            logger.info(f"log subscription backfill failed: {str(err)}")
+            # unsubscribed while still backfilling, so the logs pushed until then stay pending
+            await self._unsubscribe(subscription)
+            subscription.server_id = None
+            subscription.pending = []
+            failed = True
+        finally:
+            subscription.backfilling = False
+
+        if failed:
+            self._retry_activate(subscription)
+            return
+        subscription.retry_delay = None
+        pending, subscription.pending = subscription.pending, []
+        for log in pending:
+            self._deliver(subscription, log)
+
+    def _retry_activate(self, subscription):
+        delay = subscription.retry_delay or self.reconnect_delay
+        subscription.retry_delay = min(2 * delay, self.max_reconnect_delay)
+        logger.info(f"retrying the log subscription backfill in {delay}s")
+        self._loop.call_later(delay, lambda: asyncio.ensure_future(self._activate(subscription)))
+
+    async def _backfill(self, subscription, head):
+        _from = subscription.cursor[0] + (1 if subscription.cursor[1] == END_OF_BLOCK else 0)
+        if _from > head:
+            return
+        logger.info(f"backfilling logs of blocks {_from}-{head}")
+        chunk = self.backfill_chunk
+        while _from <= head:
+            _to = min(head, _from + chunk - 1)
+            try:
+                logs = await self._request(
+                    'eth_getLogs', [dict(subscription.params, fromBlock=hex(_from), toBlock=hex(_to))])
+            except ValueError as err:
+                if is_result_limit_error(err) and chunk > 1:
+                    chunk //= 2
+                    continue
+                raise
+            for log in logs:
+                self._deliver(subscription, log)
+            _from = _to + 1
+
+    async def _unsubscribe(self, subscription):
+        self._by_server_id.pop(subscription.server_id, None)
+        try:
+            await self._request('eth_unsubscribe', [subscription.server_id])
+        except (ValueError, ConnectionError):
+            pass
+
+    def _deliver(self, subscription, log):
+        if not log.get('removed'):
+            position = log_position(log)
+            if subscription.cursor is not None and position <= subscription.cursor:
+                return
+            subscription.cursor = position
+        self._dispatch_queue.put((subscription.callback, log))
@@ -0,0 +1,305 @@
+"""Throughput counters of the pipeline, to find out whether a slow run is limited by the node,
+the network, log decoding or aggregation.
+
+Counts are kept per stage (a scan like `cUSD Transfer`, or an aggregation step) and worker:
+blocks scanned, logs decoded, bytes received, eth_getLogs requests, timeouts retried and chunks
+halved on result limits, and the seconds spent waiting for RPC responses, decoding, storing and
+aggregating. The current stage is a context variable, so the RPC providers and the asyncio tasks
+of a scan count into the stage of the job that started them.
+
+With `METRICS_DIR` set each process writes its counters to `<METRICS_DIR>/<pid>.json` at most
+every `interval` seconds and at the end of each job. `MetricsReporter` merges them, with the RPC
+latency histograms by method and the response cache hit rates, into `metrics.json` and the
+Prometheus textfile `metrics.prom`, and prints the report of the run.
+"""
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = "METRICS_DIR"
+METRICS_FILE_NAME = 'metrics.json'
+PROMETHEUS_FILE_NAME = 'metrics.prom'
+
+COUNTERS = (
+    'blocks', 'logs', 'bytes', 'requests', 'retries', 'halvings',
+    'rpc_seconds', 'decode_seconds', 'store_seconds', 'aggregate_seconds',
+)
+
+# (stage, worker) the counts of the running code go to
+_stage = contextvars.ContextVar('metrics_stage', default=('main', '-'))
+
+
+class Metrics:
+    def __init__(self, path=None, interval=30):
+        """
+        :param path: directory of the snapshot files, the counters are only kept in memory without it
+        :param interval: seconds, min time between two snapshot files of this process
+        """
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.counters = {}
+        self.sources = []
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, worker='-'):
+        """Count into `name` and `worker` inside the block, including in the threads and asyncio
+        tasks started from it."""
+        token = _stage.set((name, str(worker)))
+        # the stage's time starts now rather than at its first count
+        self.add()
+        try:
+            yield
+        finally:
+            _stage.reset(token)
+
+    def add(self, **counts):
+        """Add `counts` (counter name -> value) to the counters of the current stage."""
+        key = _stage.get()
+        with self._lock:
+            counters = self.counters.get(key)
+            if counters is None:
+                counters = self.counters[key] = dict(dict.fromkeys(COUNTERS, 0), first=time.time())
+            for name, value in counts.items():
+                counters[name] += value
+            counters['last'] = time.time()
+        if self.path and time.time() - self._flushed > self.interval:
+            self.flush()
+
+    @contextmanager
+    def timer(self, counter):
+        """Add the seconds spent in the block to `counter`."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(**{counter: time.time() - start_time})
+
+    def add_source(self, name, stats):
+        """Include `stats()` in the snapshots under `name`, e.g. the latency histograms of a provider."""
+        self.sources.append((name, stats))
+
+    def snapshot(self):
+        with self._lock:
+            stages = [dict(counters, stage=stage, worker=worker) for (stage, worker), counters in self.counters.items()]
+        snapshot = {'pid': os.getpid(), 'started': self.started, 'time': time.time(), 'stages': stages}
+        for name, stats in self.sources:
+            snapshot.setdefault(name, []).append(stats())
+        return snapshot
+
+    def flush(self):
+        """Write the snapshot of this process to `<path>/<pid>.json`."""
+        self._flushed = time.time()
+        if not self.path:
+            return
+        path = os.path.join(self.path, '%s.json' % os.getpid())
+        # counts from several threads can trigger a flush at the same time
+        with self._flush_lock:
+            tmp_path = '%s.tmp' % path
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+
+
+_metrics = None
+
+
+def get_metrics():
+    """The `Metrics` of this process, writing to `METRICS_DIR` when it's set."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics(os.getenv(METRICS_DIR) or None)
+    return _metrics
+
+
+def reset_metrics():
+    """Start from empty counters, in a worker forked from a process that counted already."""
+    global _metrics
+    _metrics = None
+
+
+def merge_latency_stats(stats_list):
+    """Latency histograms by method of several `HedgePolicy.stats`, the percentiles are estimated
+    from the merged buckets."""
+    methods = {}
+    for stats in stats_list:
+        for method, h in stats['methods'].items():
+            merged = methods.setdefault(method, {'count': 0, 'sum': 0.0, 'buckets': {}})
+            merged['count'] += h['count']
+            merged['sum'] += h['sum']
+            for bound, count in h['buckets'].items():
+                merged['buckets'][bound] = merged['buckets'].get(bound, 0) + count
+    for h in methods.values():
+        for q in (50, 90, 99):
+            h['p%s' % q] = _bucket_percentile(h, q)
+    return methods
+
+
+def _add_counters(merged, key, counters):
+    if key not in merged:
+        merged[key] = dict(dict.fromkeys(COUNTERS, 0), first=counters['first'], last=counters['last'])
+    for name in COUNTERS:
+        merged[key][name] += counters.get(name, 0)
+    merged[key]['first'] = min(merged[key]['first'], counters['first'])
+    merged[key]['last'] = max(merged[key]['last'], counters['last'])
+
+
+def _bucket_percentile(histogram, q):
+    # upper bound of the bucket of the `q`th percentile
+    rank = histogram['count'] * q / 100.0
+    for bound, cumulative in histogram['buckets'].items():
+        if cumulative >= rank:
+            return float(bound)
+    return None
+
+
+def merge_snapshots(snapshots):
+    """Run metrics of the snapshots of all the processes: counters by stage and worker, totals and
+    rates by stage, RPC latencies by method and response cache hits."""
+    workers = {}
+    for snapshot in snapshots:
+        for counters in snapshot['stages']:
+            _add_counters(workers, (counters['stage'], counters['worker']), counters)
+    stages = {}
+    for (stage, worker), counters in workers.items():
+        _add_counters(stages, stage, counters)
+
+    elapsed = max([s['time'] for s in snapshots] or [0]) - min([s['started'] for s in snapshots] or [0])
+    for counters in stages.values():
+        # from the first to the last count of any of the stage's workers
+        seconds = counters['last'] - counters['first']
+        counters['blocks_per_second'] = counters['blocks'] / seconds if seconds > 0 else None
+        counters['logs_per_second'] = counters['logs'] / seconds if seconds > 0 else None
+
+    hits = sum(c['hits'] for s in snapshots for c in s.get('rpc_cache', []))
+    misses = sum(c['misses'] for s in snapshots for c in s.get('rpc_cache', []))
+    return {
+        'elapsed': elapsed,
+        'processes': len(snapshots),
+        'stages': stages,
+        'workers': [dict(counters, stage=stage, worker=worker) for (stage, worker), counters in sorted(workers.items())],
+        'rpc': merge_latency_stats([stats for s in snapshots for stats in s.get('rpc', [])]),
+        'rpc_cache': {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None},
+    }
+
+
+def to_prometheus(run):
+    """Prometheus text exposition of merged run metrics."""
+    lines = []
+    for name in COUNTERS:
+        metric = 'airdrop_%s_total' % name
+        lines.append('# TYPE %s counter' % metric)
+        for counters in run['workers']:
+            lines.append('%s{stage="%s",worker="%s"} %s' % (
+                metric, _escape(counters['stage']), _escape(counters['worker']), counters[name]))
+
+    lines.append('# TYPE airdrop_rpc_latency_seconds histogram')
+    for method, h in sorted(run['rpc'].items()):
+        for bound, count in h['buckets'].items():
+            lines.append('airdrop_rpc_latency_seconds_bucket{method="%s",le="%s"} %s' % (_escape(method), bound, count))
+        lines.append('airdrop_rpc_latency_seconds_sum{method="%s"} %s' % (_escape(method), h['sum']))
+        lines.append('airdrop_rpc_latency_seconds_count{method="%s"} %s' % (_escape(method), h['count']))
+
+    for name in ('hits', 'misses'):
+        lines.append('# TYPE airdrop_rpc_cache_%s_total counter' % name)
+        lines.append('airdrop_rpc_cache_%s_total %s' % (name, run['rpc_cache'][name]))
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def format_report(run):
+    """Printable lines of merged run metrics."""
+    lines = ['%.0fs, %s processes' % (run['elapsed'], run['processes'])]
+    lines.append('  %-40s %10s %10s %9s %8s %8s %8s %8s %8s %7s %8s' % (
+        'stage', 'blocks', 'logs', 'MB', 'blocks/s', 'logs/s', 'rpc s', 'decode s', 'store s', 'retries',
+        'halvings'))
+    for stage, c in sorted(run['stages'].items()):
+        if not (c['blocks'] or c['logs'] or c['aggregate_seconds']):
+            # e.g. the bytes of the requests made outside of any scan
+            continue
+        lines.append('  %-40s %10s %10s %9.1f %8s %8s %8.1f %8.1f %8.1f %7s %8s' % (
+            stage[:40], c['blocks'], c['logs'], c['bytes'] / 1e6, _rate(c['blocks_per_second']),
+            _rate(c['logs_per_second']), c['rpc_seconds'], c['decode_seconds'], c['store_seconds'],
+            c['retries'], c['halvings']))
+        if c['aggregate_seconds']:
+            lines.append('  %-40s aggregated in %.1fs' % ('', c['aggregate_seconds']))
+    for method, h in sorted(run['rpc'].items()):
+        lines.append('  %s: %s requests, mean %.3fs, p50 <= %ss, p90 <= %ss, p99 <= %ss' % (
+            method, h['count'], h['sum'] / h['count'] if h['count'] else 0, h['p50'], h['p90'], h['p99']))
+    cache = run['rpc_cache']
+    if cache['hit_rate'] is not None:
+        lines.append('  RPC response cache: %s hits, %s misses (%.0f%% hit rate)' % (
+            cache['hits'], cache['misses'], 100 * cache['hit_rate']))
+    return lines
+
+
+def _rate(value):
+    return '-' if value is None else '%.0f' % value
+
+
+class MetricsReporter:
+    """Merges the snapshot files of all the processes of a run into `metrics.json` and
+    `metrics.prom` every `interval` seconds, from a thread of the main process."""
+
+    def __init__(self, path, interval=30):
+        """
+        :param path: `METRICS_DIR` of the run, the snapshots of earlier runs in it are removed
+        :param interval: seconds between two merged files
+        """
+        self.path = path
+        self.interval = interval
+        os.makedirs(path, exist_ok=True)
+        # the counters of this process are merged from its snapshot file too
+        get_metrics().path = path
+        for snapshot_path in glob.glob(os.path.join(path, '[0-9]*.json')):
+            os.remove(snapshot_path)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def collect(self):
+        get_metrics().flush()
+        snapshots = []
+        for snapshot_path in glob.glob(os.path.join(self.path, '[0-9]*.json')):
+            try:
+                with open(snapshot_path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # replaced while it was read
+                continue
+        return merge_snapshots(snapshots)
+
+    def write(self):
+        run = self.collect()
+        files = ((METRICS_FILE_NAME, json.dumps(run, indent=2)), (PROMETHEUS_FILE_NAME, to_prometheus(run)))
+        for file_name, content in files:
+            path = os.path.join(self.path, file_name)
+            with open('%s.tmp' % path, 'w') as f:
+                f.write(content)
+            os.replace('%s.tmp' % path, path)
+        return run
+
+    def stop(self):
+        """Stop the thread and write the final files, returns the run metrics."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.write()
@@ -0,0 +1,156 @@
+"""Work-stealing scheduler of block ranges shared by the pool workers of a scan.
+
+Transfer density varies by orders of magnitude across the chain history, so
+fixed block steps leave most workers idle while a few grind through the dense
+ranges. The scan starts with one coarse range per worker instead, and a worker
+that runs out of work steals the second half of the largest unfinished range,
+from its current progress point to its end.
+
+The schedule lives in a table of the log store file so all worker processes
+see it, each claim, progress update and steal is a single transaction. Scanned
+chunks are recorded in the log store coverage as they arrive, so a range cut
+short by a steal or an interrupted run is never fetched twice.
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS schedule (
+    key TEXT NOT NULL,
+    range_id INTEGER NOT NULL,
+    from_block INTEGER NOT NULL,
+    to_block INTEGER NOT NULL,
+    next_block INTEGER NOT NULL,
+    span INTEGER NOT NULL,
+    owner INTEGER,
+    stolen_from INTEGER,
+    PRIMARY KEY (key, range_id)
+);
+'''
+
+
+def coarse_ranges(ranges, count):
+    """Split the (from, to) `ranges` into about `count` ranges of the same number of blocks."""
+    total = sum(_to - _from + 1 for _from, _to in ranges)
+    step = max(1, -(-total // max(1, count)))
+    pieces = []
+    for _from, _to in ranges:
+        while _from <= _to:
+            pieces.append((_from, min(_from + step - 1, _to)))
+            _from += step
+    return pieces
+
+
+class RangeScheduler:
+    def __init__(self, path, key, min_steal_spans=4):
+        """
+        :param path: sqlite file of the schedule, the log store of the scan
+        :param key: name of the scan, several scans can share the file
+        :param min_steal_spans: a range is only stolen from when more than this many of the
+            owner's last request spans are left, so the owner's next request stays in its half
+        """
+        self.path = path
+        self.key = key
+        self.min_steal_spans = min_steal_spans
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        # take the write lock right away, claims and steals read then update the schedule
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def seed(self, ranges):
+        """Start a new schedule of `self.key` with the (from, to) `ranges`, all unclaimed."""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM schedule WHERE key = ?', (self.key,))
+            conn.executemany(
+                'INSERT INTO schedule VALUES (?, ?, ?, ?, ?, 0, NULL, NULL)',
+                [(self.key, i, _from, _to, _from) for i, (_from, _to) in enumerate(ranges)]
+            )
+
+    def claim(self, worker):
+        """Claim the next unclaimed range or, when there is none, steal half of the largest
+        unfinished range.
+
+        :return: (range_id, from_block, to_block) or None when there is nothing left to do
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT range_id, next_block, to_block FROM schedule '
+                'WHERE key = ? AND owner IS NULL AND next_block <= to_block ORDER BY from_block LIMIT 1',
+                (self.key,)
+            ).fetchone()
+            if row is not None:
+                conn.execute('UPDATE schedule SET owner = ? WHERE key = ? AND range_id = ?', (worker, self.key, row[0]))
+            else:
+                row = self._steal(conn, worker)
+        return row
+
+    def _steal(self, conn, worker):
+        victim = conn.execute(
+            'SELECT range_id, next_block, to_block, span FROM schedule '
+            'WHERE key = ? AND owner IS NOT NULL AND to_block - next_block + 1 > ? * MAX(span, 1) '
+            'ORDER BY to_block - next_block DESC LIMIT 1',
+            (self.key, self.min_steal_spans)
+        ).fetchone()
+        if victim is None:
+            return None
+
+        range_id, next_block, to_block, span = victim
+        remaining = to_block - next_block + 1
+        split = next_block + max(remaining // 2, 2 * span)
+        new_id = conn.execute('SELECT MAX(range_id) + 1 FROM schedule WHERE key = ?', (self.key,)).fetchone()[0]
+        conn.execute(
+            'UPDATE schedule SET to_block = ? WHERE key = ? AND range_id = ?', (split - 1, self.key, range_id))
+        conn.execute(
+            'INSERT INTO schedule VALUES (?, ?, ?, ?, ?, 0, ?, ?)',
+            (self.key, new_id, split, to_block, split, worker, range_id)
+        )
+        return new_id, split, to_block
+
+    def advance(self, range_id, next_block, span):
+        """Record that a range was scanned up to `next_block - 1` with requests of `span` blocks.
+
+        :return: the range's current last block, it's lower than `next_block` once the rest was stolen
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE schedule SET next_block = ?, span = ? WHERE key = ? AND range_id = ?',
+                (next_block, span, self.key, range_id)
+            )
+            to_block = conn.execute(
+                'SELECT to_block FROM schedule WHERE key = ? AND range_id = ?', (self.key, range_id)
+            ).fetchone()[0]
+        return to_block
+
+    def finish(self, range_id):
+        self.conn.execute(
+            'UPDATE schedule SET next_block = to_block + 1 WHERE key = ? AND range_id = ?', (self.key, range_id))
+
+    def summary(self):
+        """Number of ranges scanned and the number of them stolen from another worker."""
+        nranges, nstolen = self.conn.execute(
+            'SELECT COUNT(*), COUNT(stolen_from) FROM schedule WHERE key = ?', (self.key,)
+        ).fetchone()
+        return {'ranges': nranges, 'stolen': nstolen}
+
+    def clear(self):
+        self.conn.execute('DELETE FROM schedule WHERE key = ?', (self.key,))
@@ -0,0 +1,202 @@
+"""Disk cache of RPC responses that can't change anymore.
+
+`eth_getLogs` over a finalized block range, `eth_call` at a fixed block or an
+old block by number always return the same result, so the providers keep them
+in a SQLite file keyed by (method, canonical params). Anything that refers to
+`latest`/`pending` or to a block within `confirmations` blocks of the chain
+head is never cached. The file is bounded to `max_bytes`, the least recently
+used responses are evicted first. Hits only update the last use time in memory,
+it is written with the next put, every `USED_FLUSH_SIZE` hits, before an
+eviction and on close, so reads don't take the write lock of the shared file.
+"""
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import get_metrics
+
+RESPONSE_CACHE_FILE_NAME = 'rpc_cache.sqlite'
+# last use times of this many hits are kept in memory before they are written
+USED_FLUSH_SIZE = 1000
+
+# method -> index of its block parameter
+BLOCK_PARAM_INDEX = {
+    'eth_call': 1,
+    'eth_getBalance': 1,
+    'eth_getCode': 1,
+    'eth_getTransactionCount': 1,
+    'eth_getStorageAt': 2,
+    'eth_getBlockByNumber': 0,
+    'eth_getBlockTransactionCountByNumber': 0,
+}
+# methods identified by a block hash, their result is fixed
+BLOCK_HASH_METHODS = {'eth_getBlockByHash', 'eth_getBlockTransactionCountByHash'}
+
+
+def get_response_cache_path(save_path):
+    return os.path.join(save_path, RESPONSE_CACHE_FILE_NAME)
+
+
+def cacheable_blocks(method, params):
+    """Block numbers/tags a `method` call depends on, None when its result can't be cached at all."""
+    params = params or []
+    if method in BLOCK_HASH_METHODS:
+        return []
+    if method == 'eth_getLogs':
+        _filter = params[0] if params else {}
+        if _filter.get('blockHash'):
+            return []
+        return [_filter.get('fromBlock', 'latest'), _filter.get('toBlock', 'latest')]
+    if method in BLOCK_PARAM_INDEX:
+        index = BLOCK_PARAM_INDEX[method]
+        return [params[index] if len(params) > index else 'latest']
+    return None
+
+
+def block_number(block):
+    """Block number of a block parameter, None for `latest`, `pending` and other tags."""
+    if isinstance(block, int):
+        return block
+    if block == 'earliest':
+        return 0
+    if isinstance(block, str) and block.startswith('0x'):
+        return int(block, 16)
+    return None
+
+
+def cache_key(method, params):
+    # addresses and hex data are case insensitive, so are the keys
+    canonical = json.dumps([method, params or []], sort_keys=True, separators=(',', ':')).lower()
+    return hashlib.sha256(canonical.encode()).digest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=1 << 30, confirmations=20, head_max_age=15):
+        """
+        :param path: SQLite file of the cache
+        :param max_bytes: the least recently used responses are evicted above this size
+        :param confirmations: responses depending on the last `confirmations` blocks are not cached
+        :param head_max_age: seconds, the chain head is fetched again when it's older than this and
+            a request's blocks are close to it
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.confirmations = confirmations
+        self.head_max_age = head_max_age
+        self.head = None
+        self._head_time = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> last use time not written yet
+        self._used = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key BLOB PRIMARY KEY, method TEXT NOT NULL, result BLOB NOT NULL, '
+            'size INTEGER NOT NULL, used REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self._conn.commit()
+        self._size = self._total_size()
+        get_metrics().add_source('rpc_cache', self.stats)
+        atexit.register(self.close)
+
+    def _total_size(self):
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def set_head(self, head):
+        self.head = head
+        self._head_time = time.time()
+
+    def needs_head(self, blocks):
+        """Whether the chain head should be fetched before deciding if `blocks` are final."""
+        numbers = [block_number(b) for b in blocks]
+        if not numbers or None in numbers:
+            return False
+        if self.head is not None and max(numbers) <= self.head - self.confirmations:
+            return False
+        return time.time() - self._head_time > self.head_max_age
+
+    def is_final(self, blocks):
+        numbers = [block_number(b) for b in blocks]
+        if None in numbers:
+            return False
+        if not numbers:
+            return True
+        return self.head is not None and max(numbers) <= self.head - self.confirmations
+
+    def get(self, method, params):
+        """Cached result of a call, None when it's not cached."""
+        key = cache_key(method, params)
+        with self._lock:
+            row = self._conn.execute('SELECT result FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._used[key] = time.time()
+            if len(self._used) >= USED_FLUSH_SIZE:
+                self._flush_used()
+                self._conn.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def _flush_used(self):
+        if self._used:
+            self._conn.executemany(
+                'UPDATE responses SET used = ? WHERE key = ?', [(used, key) for key, used in self._used.items()])
+            self._used = {}
+
+    def put(self, method, params, result):
+        if result is None:
+            # e.g. a block that doesn't exist on this node (yet)
+            return
+        data = zlib.compress(json.dumps(result, separators=(',', ':')).encode(), 1)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, method, result, size, used) VALUES (?, ?, ?, ?, ?)',
+                (cache_key(method, params), method, data, len(data), time.time())
+            )
+            self._flush_used()
+            self._conn.commit()
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        self._flush_used()
+        # other processes may write to the same file, start from the actual size
+        self._size = self._total_size()
+        target = int(self.max_bytes * 0.9)
+        while self._size > target:
+            rows = self._conn.execute('SELECT key, size FROM responses ORDER BY used LIMIT 1000').fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            self._conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        self._conn.commit()
+        print('evicted RPC responses from %s, %s bytes left' % (self.path, self._size))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self._size}
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._flush_used()
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
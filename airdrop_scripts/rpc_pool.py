@@ -0,0 +1,252 @@
+"""Latency-aware selection among several RPC endpoints.
+
+Each endpoint keeps an exponentially weighted moving average (EWMA) of its
+latency and error rate. Requests go to the healthy endpoint with the lowest
+expected wait, its latency times the requests already in flight to it, so load
+spreads across nodes in proportion to their speed. An endpoint that fails too
+often or is much slower than the others is ejected for a cool-down period.
+
+`HedgePolicy` keeps latency histograms per RPC method and decides when a
+request that is still waiting should be duplicated (hedged), so a single slow
+node or request doesn't hold up a whole batch of scans.
+"""
+import bisect
+import threading
+import time
+from collections import deque
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def split_endpoints(network_url):
+    """List of endpoint URIs of a comma separated `network_url` (or a list of URIs)."""
+    if isinstance(network_url, (list, tuple)):
+        return list(network_url)
+    return [uri.strip() for uri in network_url.split(',') if uri.strip()]
+
+
+class Endpoint:
+    def __init__(self, uri, initial_latency):
+        self.uri = uri
+        self.latency = initial_latency
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return 'Endpoint(%s, latency=%.3f, error_rate=%.2f, in_flight=%s)' % (
+            self.uri, self.latency, self.error_rate, self.in_flight)
+
+    def is_healthy(self, now):
+        return now >= self.cooldown_until
+
+    def expected_wait(self):
+        return self.latency * (1 + self.in_flight)
+
+
+class EndpointPool:
+    def __init__(
+        self,
+        endpoint_uris,
+        alpha=0.2,
+        initial_latency=0.5,
+        max_error_rate=0.5,
+        slow_factor=5.0,
+        cooldown=30.0,
+    ):
+        """
+        :param endpoint_uris: list of endpoint URIs
+        :param alpha: weight of the latest sample in the moving averages
+        :param initial_latency: seconds, latency assumed for endpoints not used yet
+        :param max_error_rate: an endpoint with a higher error rate average is ejected
+        :param slow_factor: an endpoint whose latency is `slow_factor` times the best healthy
+            endpoint's latency is ejected
+        :param cooldown: seconds an ejected endpoint is left out
+        """
+        assert endpoint_uris, 'at least one endpoint is required.'
+        self.endpoints = [Endpoint(uri, initial_latency) for uri in endpoint_uris]
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self, exclude=()):
+        """Pick the endpoint for the next request and count it as in flight, release it with
+        `record_success` or `record_failure`.
+
+        :param exclude: endpoints already tried for this request, used only when no other is left
+        """
+        with self._lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+            healthy = [e for e in candidates if e.is_healthy(now)]
+            if healthy:
+                endpoint = min(healthy, key=Endpoint.expected_wait)
+            else:
+                # all ejected, use the one coming back first rather than failing the request
+                endpoint = min(candidates, key=lambda e: e.cooldown_until)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def record_success(self, endpoint, latency):
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.latency += self.alpha * (latency - endpoint.latency)
+            endpoint.error_rate -= self.alpha * endpoint.error_rate
+            self._eject_if_slow(endpoint)
+
+    def record_failure(self, endpoint, latency=None):
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.errors += 1
+            endpoint.error_rate += self.alpha * (1.0 - endpoint.error_rate)
+            if latency is not None:
+                endpoint.latency += self.alpha * (max(latency, endpoint.latency) - endpoint.latency)
+            if endpoint.error_rate > self.max_error_rate:
+                self._eject(endpoint)
+
+    def release(self, endpoint, latency=None):
+        """Release an endpoint whose request was abandoned, e.g. the slower attempt of a hedged
+        request, it was at least `latency` seconds slow but didn't fail."""
+        with self._lock:
+            endpoint.in_flight -= 1
+            if latency is not None:
+                endpoint.latency += self.alpha * (max(latency, endpoint.latency) - endpoint.latency)
+
+    def _eject_if_slow(self, endpoint):
+        if len(self.endpoints) < 2:
+            return
+        now = time.time()
+        if not endpoint.is_healthy(now):
+            # already ejected, requests sent before that are still completing
+            return
+        others = [e.latency for e in self.endpoints if e is not endpoint and e.is_healthy(now)]
+        if others and endpoint.latency > self.slow_factor * min(others):
+            self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        if len(self.endpoints) < 2:
+            return
+        print('RPC endpoint %s ejected for %ss: %s' % (endpoint.uri, self.cooldown, endpoint))
+        endpoint.cooldown_until = time.time() + self.cooldown
+        # start again from neutral averages once it is back
+        endpoint.error_rate = 0.0
+        endpoint.latency = min(e.latency for e in self.endpoints)
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    'uri': e.uri, 'latency': e.latency, 'error_rate': e.error_rate, 'in_flight': e.in_flight,
+                    'requests': e.requests, 'errors': e.errors, 'ejected': not e.is_healthy(time.time()),
+                }
+                for e in self.endpoints
+            ]
+
+
+class LatencyHistogram:
+    """Counts of latencies per bucket since the start, plus the latest `window` samples
+    for percentiles of the recent latency."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=500):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.sum += latency
+        self.recent.append(latency)
+
+    def percentile(self, q):
+        """`q`th percentile (0-100) of the recent latencies, None without samples."""
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))]
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            'count': self.count, 'sum': self.sum, 'buckets': buckets,
+            'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+        }
+
+
+class HedgePolicy:
+    def __init__(self, percentile=None, min_samples=20, min_delay=0.05, window=500):
+        """
+        :param percentile: a request still waiting after this percentile (0-100) of the recent
+            latency of its method is sent again, None to only record latencies
+        :param min_samples: number of latencies of a method needed before its requests are hedged
+        :param min_delay: seconds, lower bound of the hedge delay
+        :param window: number of recent latencies the percentile is computed on
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self.histograms = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def record(self, method, latency):
+        """Record the latency of a single attempt, so the histograms keep describing the nodes
+        rather than the hedging. The providers record the losing attempt of a hedged request too,
+        with the time it was cancelled at when it is cancelled (asyncio) or its latency when it
+        ends (threads), and the time failed and timed out attempts took."""
+        with self._lock:
+            if method not in self.histograms:
+                self.histograms[method] = LatencyHistogram(window=self.window)
+            self.histograms[method].add(latency)
+
+    def delay(self, method):
+        """Seconds to wait before hedging a `method` request, None when it shouldn't be hedged."""
+        if self.percentile is None:
+            return None
+        with self._lock:
+            histogram = self.histograms.get(method)
+            if histogram is None or len(histogram.recent) < self.min_samples:
+                return None
+            return max(self.min_delay, histogram.percentile(self.percentile))
+
+    def record_hedge(self, won):
+        with self._lock:
+            self.hedged += 1
+            self.hedge_wins += int(won)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hedge_percentile': self.percentile, 'hedged': self.hedged, 'hedge_wins': self.hedge_wins,
+                'methods': {method: h.snapshot() for method, h in self.histograms.items()},
+            }
+
+    def summary(self):
+        """Printable lines with the latency percentiles of each method."""
+        stats = self.stats()
+        lines = [
+            '%s: %s requests, p50 %.3fs, p90 %.3fs, p99 %.3fs (recent), mean %.3fs' % (
+                method, h['count'], h['p50'], h['p90'], h['p99'], h['sum'] / h['count'])
+            for method, h in sorted(stats['methods'].items())
+        ]
+        if self.percentile is not None:
+            lines.append('hedged %s requests at p%s, %s answered first by the hedge' % (
+                self.hedged, self.percentile, self.hedge_wins))
+        return lines
@@ -0,0 +1,260 @@
+"""Plan the block ranges of an event log scan from the log density of the contract/event.
+
+Partitioning by block count gives some workers a few quiet ranges and others
+the busiest part of the history. The planner samples small windows spread over
+the range with `eth_getLogs` to estimate the logs (and response bytes) per
+block, or reuses the samples saved by earlier runs, and then cuts the range
+into partitions with about the same number of expected logs.
+
+Running this file prints the plan of the token transfer scans of a config
+file without fetching them, to size the worker count and chunk sizes first:
+
+    python scan_planner.py config.json [workers] [samples]
+"""
+import json
+import math
+import os
+import sys
+
+from web3.middleware.pythonic import filter_params_formatter
+
+from chunk_sizer import AdaptiveChunkSizer, is_result_limit_error
+from contract import get_contract
+from log_store import LogStore, get_store_path
+from range_scheduler import coarse_ranges
+from util import initConnection, set_envvars
+
+PROFILE_FILE_NAME = 'density_profile.json'
+
+
+def get_profile_path(save_path):
+    return os.path.join(save_path, PROFILE_FILE_NAME)
+
+
+def probe_windows(contract, event_names, addresses, from_block, to_block, web3, samples=16, window=1000):
+    """Count the logs of `samples` windows of `window` blocks evenly spread over [from_block, to_block].
+
+    A window that hits a node result limit is shrunk until it passes.
+
+    :return: list of [from, to, number of logs, response bytes] windows
+    """
+    abi = contract.get_event_abi(event_names)
+    provider = web3.providers[0]
+    nblocks = to_block - from_block + 1
+    samples = max(1, min(samples, nblocks // max(window, 1)))
+    windows = []
+    for i in range(samples):
+        center = from_block + int((i + 0.5) * nblocks / samples)
+        size = min(window, nblocks)
+        while True:
+            _from = max(from_block, center - size // 2)
+            _to = min(to_block, _from + size - 1)
+            params = filter_params_formatter(
+                contract._get_filter_params(abi, {}, fromBlock=_from, toBlock=_to, addresses=addresses)
+            )
+            response = provider.make_request('eth_getLogs', [params])
+            if 'error' not in response:
+                break
+            if not is_result_limit_error(response['error']) or size <= 1:
+                raise ValueError(response['error'])
+            size //= 2
+
+        result = response['result']
+        windows.append([_from, _to, len(result), len(json.dumps(result))])
+    return windows
+
+
+def load_profile_windows(save_path, key):
+    path = get_profile_path(save_path)
+    if not save_path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f).get(key, [])
+
+
+def save_profile_windows(save_path, key, windows):
+    """Add `windows` to the saved samples of `key`, merging with samples written by other runs."""
+    path = get_profile_path(save_path)
+    profiles = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profiles = json.load(f)
+    merged = {w[0]: w for w in profiles.get(key, []) + windows}
+    profiles[key] = [merged[b] for b in sorted(merged)]
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(profiles, f)
+    os.replace(tmp_path, path)
+
+
+class DensityProfile:
+    """Piecewise constant logs and bytes per block: each sample window's density applies up to
+    halfway to the next sample."""
+
+    def __init__(self, windows, logs_per_block=None, bytes_per_log=600):
+        """
+        :param windows: list of [from, to, number of logs, response bytes] samples
+        :param logs_per_block: density used when there is no sample, e.g. the average one
+            learned by `AdaptiveChunkSizer`
+        :param bytes_per_log: response bytes per log used when there is no sample
+        """
+        windows = sorted(windows)
+        self.segments = []
+        for i, (_from, _to, nlogs, nbytes) in enumerate(windows):
+            start = (windows[i - 1][1] + _from) // 2 + 1 if i else -math.inf
+            end = (_to + windows[i + 1][0]) // 2 if i + 1 < len(windows) else math.inf
+            nblocks = _to - _from + 1
+            self.segments.append((start, end, nlogs / nblocks, nbytes / nblocks))
+        if not self.segments:
+            density = logs_per_block or 0.0
+            self.segments.append((-math.inf, math.inf, density, density * bytes_per_log))
+
+    def expected(self, from_block, to_block):
+        """Expected (logs, response bytes) of the blocks [from_block, to_block]."""
+        nlogs = 0.0
+        nbytes = 0.0
+        for start, end, logs_per_block, bytes_per_block in self.segments:
+            overlap = min(end, to_block) - max(start, from_block) + 1
+            if overlap > 0:
+                nlogs += overlap * logs_per_block
+                nbytes += overlap * bytes_per_block
+        return nlogs, nbytes
+
+    def split(self, ranges, parts):
+        """Cut the (from, to) `ranges` into about `parts` consecutive ranges with the same expected
+        number of logs, ranges don't span the gaps between the given ranges. Each range gets a
+        share of the parts in proportion to its expected logs, at least one."""
+        # pieces of constant density of each range, in block order
+        range_pieces = []
+        for _from, _to in ranges:
+            pieces = []
+            for start, end, logs_per_block, bytes_per_block in self.segments:
+                lo, hi = max(start, _from), min(end, _to)
+                if lo <= hi:
+                    pieces.append((int(lo), int(hi), logs_per_block))
+            if pieces:
+                range_pieces.append(pieces)
+        totals = [sum((hi - lo + 1) * density for lo, hi, density in pieces) for pieces in range_pieces]
+        total = sum(totals)
+        if not range_pieces or total <= 0 or parts <= 1:
+            return coarse_ranges(ranges, parts)
+
+        shares = [parts * t / total for t in totals]
+        counts = [max(1, int(share)) for share in shares]
+        # the parts left go to the ranges with the largest remainders
+        by_remainder = sorted(range(len(shares)), key=lambda i: shares[i] - int(shares[i]), reverse=True)
+        for i in by_remainder[:max(0, parts - sum(counts))]:
+            counts[i] += 1
+
+        partitions = []
+        for pieces, count in zip(range_pieces, counts):
+            partitions.extend(_split_pieces(pieces, count))
+        return partitions
+
+
+def _split_pieces(pieces, parts):
+    """Cut consecutive (from, to, logs per block) pieces into `parts` ranges of about the same expected logs."""
+    total = sum((hi - lo + 1) * density for lo, hi, density in pieces)
+    if total <= 0 or parts <= 1:
+        return [(pieces[0][0], pieces[-1][1])]
+
+    per_part = total / parts
+    partitions = []
+    start = pieces[0][0]
+    acc = 0.0
+    for lo, hi, density in pieces:
+        block = lo
+        while density > 0 and acc + (hi - block + 1) * density >= per_part and len(partitions) < parts - 1:
+            cut = block + max(0, int(math.ceil((per_part - acc) / density)) - 1)
+            if cut >= hi:
+                break
+            partitions.append((start, cut))
+            start = block = cut + 1
+            acc = 0.0
+        acc += (hi - block + 1) * density
+    partitions.append((start, pieces[-1][1]))
+    return partitions
+
+
+def get_profile(save_path, contract, event_names, addresses, from_block, to_block, web3, samples=16, window=1000):
+    """Density profile of `event_names` of `addresses` between `from_block` and `to_block`, from the
+    samples saved by earlier runs or, when there are less than half of `samples` of them in the
+    range, from new samples that are saved for the next runs."""
+    density_key = addresses[0] if len(addresses) == 1 else contract.contract_name
+    key = '%s:%s' % (density_key.lower(), '+'.join(sorted(event_names)))
+    windows = [w for w in load_profile_windows(save_path, key) if w[0] >= from_block and w[1] <= to_block]
+    if samples and len(windows) < samples / 2:
+        windows = probe_windows(contract, event_names, addresses, from_block, to_block, web3, samples, window)
+        save_profile_windows(save_path, key, windows)
+
+    sizer = AdaptiveChunkSizer.from_store(save_path, density_key, '+'.join(sorted(event_names)), 1000)
+    return DensityProfile(windows, logs_per_block=sizer.logs_per_block)
+
+
+def describe_plan(partitions, profile, target_logs=5000, max_chunk=2000000):
+    """Rows of the expected size of each partition of a scan.
+
+    :param target_logs: logs per eth_getLogs response the scan aims for, see `AdaptiveChunkSizer`
+    :return: list of dicts with the range, expected logs, bytes, eth_getLogs calls and chunk size
+    """
+    rows = []
+    for _from, _to in partitions:
+        nblocks = _to - _from + 1
+        nlogs, nbytes = profile.expected(_from, _to)
+        chunk = max(1, min(max_chunk, int(target_logs * nblocks / nlogs) if nlogs else max_chunk))
+        rows.append({
+            'from': _from, 'to': _to, 'blocks': nblocks, 'logs': int(nlogs), 'bytes': int(nbytes),
+            'calls': int(math.ceil(nblocks / chunk)), 'chunk': chunk,
+        })
+    return rows
+
+
+def print_plan(title, rows):
+    print(title)
+    print('  %10s %10s %10s %10s %12s %7s %9s' % ('from', 'to', 'blocks', 'logs', 'bytes', 'calls', 'chunk'))
+    for r in rows:
+        print('  %(from)10s %(to)10s %(blocks)10s %(logs)10s %(bytes)12s %(calls)7s %(chunk)9s' % r)
+    print('  total: %s logs, %.1f MB, %s eth_getLogs calls' % (
+        sum(r['logs'] for r in rows), sum(r['bytes'] for r in rows) / 1e6, sum(r['calls'] for r in rows)))
+
+
+def dry_run(config_file_path, workers=None, samples=16):
+    """Print the plan of the cUSD and CELO transfer scans of a config file, only the sample
+    windows are fetched."""
+    # export_recipients plans its scans with this module
+    from export_recipients import get_impact_market_info
+
+    with open(os.path.expanduser(config_file_path)) as f:
+        config_dict = json.load(f)
+    save_path = os.path.expanduser(config_dict.get("savePath", '~/celo_events_dir'))
+    network = config_dict.get("network", "http://localhost:8545")
+    set_envvars(','.join(network) if isinstance(network, list) else network, config_dict.get("targetBlock"))
+    web3 = initConnection()
+    target_block = int(config_dict.get("targetBlock") or web3.eth.blockNumber)
+    imarket_address, factory_address, cusd_address, celo_address, start_block = get_impact_market_info(target_block)
+    workers = workers or max(1, os.cpu_count() - 2)
+
+    store = LogStore(get_store_path(save_path))
+    for token_name, token_address in (('cUSD', cusd_address), ('CELO', celo_address)):
+        erc20 = get_contract(token_name, os.getenv('ERC20_ABI'), web3.toChecksumAddress(token_address))
+        topic0 = erc20.get_event_signature('Transfer')
+        missing = store.missing_ranges(erc20.address, topic0, 1, target_block)
+        if not missing:
+            print('%s transfers are all in the log store' % token_name)
+            continue
+        profile = get_profile(
+            save_path, erc20, ['Transfer'], [erc20.address], missing[0][0], missing[-1][1], web3, samples)
+        rows = describe_plan(profile.split(missing, workers), profile)
+        print_plan('%s transfers, %s workers:' % (token_name, workers), rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('usage: python scan_planner.py <config.json> [workers] [samples]')
+        sys.exit(1)
+
+    dry_run(
+        sys.argv[1],
+        int(sys.argv[2]) if len(sys.argv) > 2 else None,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 16,
+    )
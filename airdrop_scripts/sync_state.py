@@ -0,0 +1,114 @@
+"""Reorg-safe incremental sync.
+
+The log store, transfers caches and checkpoints of the save path hold the results of the runs up
+to their target block, and a block within `confirmations` blocks of the head can still be replaced
+by a reorg. Each run records the hash of its target block, and of each block of the provisional
+tail before it, in the log store before anything is fetched. The next run compares the recorded
+hashes with the chain, newest first: as a block hash commits to all the blocks before it, the
+first one that still matches proves nothing before it changed, and only what was cached after
+that block is rolled back and fetched again:
+
+  * the logs and coverage of the log store
+  * the transfers caches, cut back to that block
+  * the balance and donor checkpoints saved after it
+
+The hashes of the blocks that became final are forgotten, except the target blocks of the runs,
+so a reorg deeper than `confirmations` is still detected, it is only located less precisely.
+"""
+import logging
+
+from address_table import get_address_table
+from balance_snapshots import rollback_snapshots
+from log_store import LogStore, get_store_path
+from transfer_cache import rollback_caches
+from web3_instance import get_web3
+
+logger = logging.getLogger(__name__)
+
+# the hashes of a rollback check are fetched this many blocks at a time
+CHECK_BATCH_SIZE = 100
+
+
+def get_block_hashes(blocks):
+    """Hex hashes of `blocks` on the chain, with one batch request when the provider supports it.
+    The response cache is bypassed, it would answer the final blocks with the hashes it saw when
+    they were cached.
+
+    :return: dict of block number -> hash, None for the blocks after the head
+    """
+    web3 = get_web3()
+    blocks = list(blocks)
+    provider = web3.providers[0]
+    if hasattr(provider, 'make_batch_request'):
+        responses = provider.make_batch_request(
+            [('eth_getBlockByNumber', [hex(b), False]) for b in blocks], use_cache=False)
+        hashes = {}
+        for block, response in zip(blocks, responses):
+            if 'error' in response:
+                raise ValueError(response['error'])
+            hashes[block] = response['result']['hash'] if response['result'] else None
+        return hashes
+
+    # the other providers don't cache responses
+    hashes = {}
+    for block in blocks:
+        result = web3.eth.getBlock(block)
+        hashes[block] = result['hash'].hex() if result else None
+    return hashes
+
+
+def find_rollback_block(store):
+    """Last recorded block that is still on the chain, when a block recorded after it was reorganized.
+
+    :return: block number, 0 when none of the recorded blocks matches and None when there was no reorg
+    """
+    recorded = store.get_block_hashes()
+    for i in range(0, len(recorded), CHECK_BATCH_SIZE):
+        batch = recorded[i:i + CHECK_BATCH_SIZE]
+        hashes = get_block_hashes([block for block, block_hash in batch])
+        for block, block_hash in batch:
+            if hashes[block] is not None and hashes[block].lower() == block_hash.lower():
+                return block if block != recorded[0][0] else None
+            logger.info(f"block {block} was reorganized: {block_hash} is now {hashes[block]}")
+    return 0 if recorded else None
+
+
+def rollback(save_path, store, block):
+    """Forget what was cached after `block` in `save_path`, the next run fetches it again."""
+    removed = store.rollback(block)
+    print('rolled back %s logs after block %s in %s' % (removed, block, store.path))
+    for path in rollback_caches(save_path, block, get_address_table(save_path)):
+        print('rolled back transfers cache %s' % path)
+    for path in rollback_snapshots(save_path, block):
+        print('removed checkpoint %s' % path)
+
+
+def record_sync(store, to_block, confirmations):
+    """Record the hashes of `to_block` and of the blocks before it that aren't final yet."""
+    head = get_web3().eth.blockNumber
+    final_block = head - confirmations
+    blocks = [b for b in range(max(0, to_block - confirmations + 1), to_block) if b > final_block]
+    hashes = get_block_hashes(blocks + [to_block])
+    # a target block after the head has no hash yet
+    store.add_block_hashes({b: h for b, h in hashes.items() if h is not None}, to_block)
+    store.prune_block_hashes(final_block)
+
+
+def sync_chain(save_path, to_block, confirmations=20):
+    """Roll back what the chain reorganized since the last run, then record the hashes of this run
+    up to `to_block`. Called before anything is fetched, a reorg during the run then shows as a
+    hash mismatch on the next one.
+
+    :param confirmations: blocks this far from the head are final, the others are provisional
+    :return: the block rolled back to, None when there was no reorg
+    """
+    store = LogStore(get_store_path(save_path))
+    try:
+        block = find_rollback_block(store)
+        if block is not None:
+            print('chain reorganized after block %s' % block)
+            rollback(save_path, store, block)
+        record_sync(store, to_block, confirmations)
+        return block
+    finally:
+        store.close()
@@ -0,0 +1,283 @@
+"""Columnar binary cache of token transfers.
+
+A list of `(from, to, value, block)` tuples of the full CELO/cUSD history takes
+minutes to `json.load` and several GB of memory. This cache stores each field
+as a fixed width column in a single file that is memory-mapped on load, so
+transfers are only materialized while iterating over them. Addresses are
+stored as IDs of the `address_table` of the save path.
+
+File layout (little-endian):
+    header  magic, count, from_block, to_block, address table id, address table size
+    from    count x uint32 address ID
+    to      count x uint32 address ID
+    value   count x 32 bytes big-endian uint256
+    block   count x uint32
+    index   count x uint32 logIndex
+"""
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+
+from address_table import get_address_table, to_address_array
+from log_decoder import checksum_address
+
+CACHE_NAME = re.compile(r'^(.+)\.transfers\.(\d+)-(\d+)\.bin$')
+MAGIC = b'AIRDTRF2'
+HEADER = struct.Struct('<8sQQQ8sQ')
+VALUE_SIZE = 32
+
+
+def get_cache_path(save_path, token_name, from_block, to_block):
+    return os.path.join(save_path, '%s.transfers.%s-%s.bin' % (token_name, from_block, to_block))
+
+
+def _uint32_column(values):
+    column = array('I', values)
+    assert column.itemsize == 4
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def write_transfers(path, transfers, table, from_block=0, to_block=0, base=None):
+    """Write transfers to a columnar cache file.
+
+    :param transfers: iterable of `(from, to, value, block)` or `(from, to, value, block, logIndex)` tuples,
+        without a logIndex the position of the transfer within its block is used
+    :param table: AddressTable the addresses are interned in, it is saved before the cache is written
+    :param base: `TransferColumns` of earlier transfers to copy before `transfers`, optional
+    :return: number of transfers written
+    """
+    _from = []
+    _to = []
+    _value = bytearray()
+    blocks = []
+    indexes = []
+    last_block = None
+    for t in transfers:
+        _from.append(t[0])
+        _to.append(t[1])
+        _value += int(t[2]).to_bytes(VALUE_SIZE, 'big')
+        blocks.append(t[3])
+        if len(t) > 4:
+            indexes.append(t[4])
+        else:
+            indexes.append(indexes[-1] + 1 if t[3] == last_block else 0)
+        last_block = t[3]
+
+    if base is not None and base.table_id != table.table_id:
+        raise ValueError('Base transfers cache %s uses another address table.' % base.path)
+
+    from_ids = table.get_ids(to_address_array(_from)) if _from else []
+    to_ids = table.get_ids(to_address_array(_to)) if _to else []
+    table.save()
+
+    base_columns = base.columns() if base is not None else [b''] * 5
+    count = len(blocks) + (len(base) if base is not None else 0)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, from_block, to_block, table.table_id, len(table)))
+        for base_column, column in zip(base_columns, (from_ids, to_ids, _value, blocks, indexes)):
+            f.write(base_column)
+            f.write(column if isinstance(column, bytearray) else _uint32_column(column))
+    os.replace(tmp_path, path)
+    return count
+
+
+class TransferColumns:
+    """Memory-mapped transfers cache, behaves like a read-only list of
+    `(from, to, value, block)` tuples with checksummed addresses and int values."""
+
+    def __init__(self, path, table):
+        """
+        :param table: AddressTable the cache was written with
+        """
+        self.path = path
+        self.table = table
+        if path is None:
+            # a slice of another TransferColumns, see `__getitem__`
+            return
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, self.from_block, self.to_block, self.table_id, table_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError('%s is not a transfers cache file.' % path)
+        if self.table_id != table.table_id or table_size > len(table):
+            self._mmap.close()
+            raise ValueError('%s was written with another address table.' % path)
+
+        self.count = count
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        self.from_column = self._uint32_view(view[offset:offset + 4 * count])
+        offset += 4 * count
+        self.to_column = self._uint32_view(view[offset:offset + 4 * count])
+        offset += 4 * count
+        self.value_column = view[offset:offset + VALUE_SIZE * count]
+        offset += VALUE_SIZE * count
+        self.block_column = self._uint32_view(view[offset:offset + 4 * count])
+        offset += 4 * count
+        self.index_column = self._uint32_view(view[offset:offset + 4 * count])
+
+    @staticmethod
+    def _uint32_view(view):
+        if sys.byteorder == 'big':
+            column = array('I', view.tobytes())
+            column.byteswap()
+            return column
+        return view.cast('I')
+
+    def __len__(self):
+        return self.count
+
+    def _transfer(self, i):
+        v = VALUE_SIZE * i
+        return (
+            checksum_address(self.table.get_address(self.from_column[i])),
+            checksum_address(self.table.get_address(self.to_column[i])),
+            int.from_bytes(self.value_column[v:v + VALUE_SIZE], 'big'),
+            self.block_column[i],
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._slice(*i.indices(self.count)[:2])
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('transfer index out of range')
+        return self._transfer(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._transfer(i)
+
+    def _slice(self, start, stop):
+        stop = max(start, stop)
+        sliced = TransferColumns(None, self.table)
+        # the column views keep the parent's mmap open
+        sliced._mmap = None
+        sliced.table_id = self.table_id
+        sliced.count = stop - start
+        sliced.from_block = self.block_column[start] if stop > start else self.to_block
+        sliced.to_block = self.block_column[stop - 1] if stop > start else self.to_block
+        sliced.from_column = self.from_column[start:stop]
+        sliced.to_column = self.to_column[start:stop]
+        sliced.value_column = self.value_column[VALUE_SIZE * start:VALUE_SIZE * stop]
+        sliced.block_column = self.block_column[start:stop]
+        sliced.index_column = self.index_column[start:stop]
+        return sliced
+
+    def index_after(self, block):
+        """Index of the first transfer after `block`, transfers are ordered by block."""
+        return bisect.bisect_right(self.block_column, block)
+
+    def columns(self):
+        """Raw bytes of the from, to, value, block and logIndex columns, in file order."""
+        return [
+            column.tobytes() if isinstance(column, memoryview) else _uint32_column(column)
+            for column in (self.from_column, self.to_column, self.value_column, self.block_column, self.index_column)
+        ]
+
+    def iter_raw(self):
+        """Iterate `(from ID, to ID, value, block, logIndex)`, avoids the hex/checksum conversion
+        when only comparing or hashing addresses."""
+        for i in range(self.count):
+            v = VALUE_SIZE * i
+            yield (
+                self.from_column[i],
+                self.to_column[i],
+                int.from_bytes(self.value_column[v:v + VALUE_SIZE], 'big'),
+                self.block_column[i],
+                self.index_column[i],
+            )
+
+    def close(self):
+        for column in (self.from_column, self.to_column, self.value_column, self.block_column, self.index_column):
+            if isinstance(column, memoryview):
+                column.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+
+def load_transfers(path, table):
+    return TransferColumns(path, table)
+
+
+def find_cache_path(save_path, token_name, from_block, to_block):
+    """Path of the cache of `token_name` transfers starting at `from_block` that covers the
+    most blocks up to `to_block`, None if there isn't any."""
+    prefix = '%s.transfers.%s-' % (token_name, from_block)
+    best = None
+    for name in os.listdir(save_path):
+        if not name.startswith(prefix) or not name.endswith('.bin'):
+            continue
+        try:
+            _to = int(name[len(prefix):-len('.bin')])
+        except ValueError:
+            continue
+        if _to <= to_block and (best is None or _to > best):
+            best = _to
+    return get_cache_path(save_path, token_name, from_block, best) if best is not None else None
+
+
+def rollback_caches(save_path, block, table):
+    """Cut the transfers caches of `save_path` that go past `block` back to it, the transfers
+    after it were reorganized. A cache starting after `block` is removed.
+
+    :return: list of the paths of the caches cut or removed
+    """
+    changed = []
+    for name in sorted(os.listdir(save_path)):
+        match = CACHE_NAME.match(name)
+        if match is None or int(match.group(3)) <= block:
+            continue
+        path = os.path.join(save_path, name)
+        token_name, from_block = match.group(1), int(match.group(2))
+        if from_block <= block:
+            try:
+                transfers = load_transfers(path, table)
+            except ValueError:
+                transfers = None
+            if transfers is not None:
+                write_transfers(get_cache_path(save_path, token_name, from_block, block), [], table,
+                                from_block, block, base=transfers[:transfers.index_after(block)])
+                transfers.close()
+        os.remove(path)
+        changed.append(path)
+    return changed
+
+
+def convert_json_cache(json_paths, out_path, table):
+    """Convert JSON transfers caches (lists of `[from, to, value, block]`) into a single columnar
+    cache file, the files are concatenated in block order.
+
+    :return: number of transfers written
+    """
+    transfers = []
+    for path in json_paths:
+        with open(path) as f:
+            transfers.extend(json.load(f))
+    transfers.sort(key=lambda t: t[3])
+    from_block = transfers[0][3] if transfers else 0
+    to_block = transfers[-1][3] if transfers else 0
+    return write_transfers(out_path, transfers, table, from_block, to_block)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('usage: python transfer_cache.py <out.bin> <transfers.json> [<transfers.json> ...]')
+        sys.exit(1)
+
+    out_path = sys.argv[1]
+    # addresses are interned in the table next to the cache file
+    n = convert_json_cache(sys.argv[2:], out_path, get_address_table(os.path.dirname(os.path.abspath(out_path))))
+    print('wrote %s transfers to %s' % (n, out_path))
@@ -4,11 +4,22 @@ import os
 from web3 import WebsocketProvider, Web3
 
 from http_provider import CustomHTTPProvider
+from metrics import reset_metrics
+from response_cache import ResponseCache
 from web3_instance import get_web3, set_web3
+from web3_request import reset_sessions
 
 ENV_WEB3_NETWORK = "WEB3_NETWORK"
 IMPACT_MARKET_START_BLOCK = "IMPACT_MARKET_START_BLOCK"
 TARGET_BLOCK = "TARGET_BLOCK"
+RPC_HEDGE_PERCENTILE = "RPC_HEDGE_PERCENTILE"
+RPC_CACHE_PATH = "RPC_CACHE_PATH"
+RPC_CACHE_CONFIRMATIONS = "RPC_CACHE_CONFIRMATIONS"
+RPC_CACHE_MAX_MB = "RPC_CACHE_MAX_MB"
+ABI_ENVVARS = (
+    "IMARKET_ABI", "CFACTORY_ABI", "COMMUNITY_ABI", "ERC20_ABI", "UBE_FACTORY_ABI", "UBE_PAIR_ABI",
+    "MOOLA_LENDINGPOOL_ABI",
+)
 
 GANACHE_URL = "http://127.0.0.1:8545"
 
@@ -17,7 +28,7 @@ SUPPORTED_NETWORK_NAMES = {"rinkeby", "kovan", "ganache", "mainnet", "ropsten"}
 
 
 def get_start_block():
-    return os.getenv(IMPACT_MARKET_START_BLOCK, 0)
+    return int(os.getenv(IMPACT_MARKET_START_BLOCK, 0))
 
 
 def get_target_block():
@@ -28,6 +39,47 @@ def get_web3_network():
     return os.getenv(ENV_WEB3_NETWORK, "http://localhost:8545")
 
 
+def get_hedge_kwargs():
+    """`hedge_kwargs` of the RPC providers, requests are hedged when `RPC_HEDGE_PERCENTILE` is set."""
+    percentile = os.getenv(RPC_HEDGE_PERCENTILE)
+    return {'percentile': float(percentile)} if percentile else None
+
+
+_response_caches = {}
+
+
+def get_response_cache():
+    """The RPC response cache at `RPC_CACHE_PATH`, None when it's not set."""
+    path = os.getenv(RPC_CACHE_PATH)
+    if not path:
+        return None
+    if path not in _response_caches:
+        _response_caches[path] = ResponseCache(
+            path,
+            max_bytes=int(float(os.getenv(RPC_CACHE_MAX_MB, 1024)) * (1 << 20)),
+            confirmations=int(os.getenv(RPC_CACHE_CONFIRMATIONS, 20)),
+        )
+    return _response_caches[path]
+
+
+def init_worker(web3_network, target_block=None):
+    """Initializer of the pool worker processes, connects once per worker rather than per job.
+
+    A worker forked after the parent connected inherits its web3 instance, HTTP sessions,
+    response cache connection and metrics, none of which can be shared with another process, so
+    they are made again here. The ABI files are parsed up front as well.
+    """
+    set_envvars(web3_network, target_block)
+    reset_metrics()
+    _response_caches.clear()
+    reset_sessions()
+    set_web3(None)
+    initConnection()
+    for envvar in ABI_ENVVARS:
+        if os.path.exists(os.getenv(envvar, '')):
+            load_contract_definition(os.getenv(envvar))
+
+
 def set_envvars(web3_network, target_block=None):
     if os.getenv('WEB3_NETWORK'):
         return
@@ -39,6 +91,7 @@ def set_envvars(web3_network, target_block=None):
 
     # os.getcwd()
     # '/home/ssallam/pycharm_projects/impact-market-token'
+    # the ABI paths are listed in ABI_ENVVARS
     os.environ["IMARKET_ABI"]="./abi/ImpactMarket.json"
     os.environ["CFACTORY_ABI"] = "./abi/CommunityFactory.json"
     os.environ["COMMUNITY_ABI"] = "./abi/Community.json"
@@ -82,6 +135,11 @@ def get_web3_connection_provider(network_url):
         - the issue is described here: https://github.com/ethereum/web3.py/issues/549
         - and the fix is here: https://web3py.readthedocs.io/en/latest/middleware.html#geth-style-proof-of-authority
 
+    Several http(s) endpoints can be given separated by commas, requests are then balanced
+    across them, see `rpc_pool.EndpointPool`. Requests are hedged when the `RPC_HEDGE_PERCENTILE`
+    envvar is set, see `rpc_pool.HedgePolicy`, and results on finalized blocks are cached when
+    `RPC_CACHE_PATH` is set, see `response_cache.ResponseCache`.
+
     :param network_url: str
     :return: provider : HTTPProvider
     """
@@ -89,7 +147,9 @@ def get_web3_connection_provider(network_url):
         network_url = GANACHE_URL
 
     if network_url.startswith("http"):
-        provider = CustomHTTPProvider(network_url)
+        provider = CustomHTTPProvider(
+            network_url, hedge_kwargs=get_hedge_kwargs(), response_cache=get_response_cache()
+        )
 
     else:
         if network_url.startswith("http"):
@@ -118,33 +178,42 @@ def from_base(num_base: int, dec: int) -> float:
     return float(num_base / (10 ** dec))
 
 
-def load_contract(filename, address):
-    with open(filename) as f:
-        contract_definition = json.loads(f.read())
-
-        if not address and "address" in contract_definition:
-            address = contract_definition.get("address")
-            assert address, "Cannot find contract address in the abi file."
-            address = get_web3().toChecksumAddress(address)
-        assert address is not None, "address shouldn't be None at this point"
-
-        bytecode = None
-        if isinstance(contract_definition, dict):
-            abi = contract_definition["abi"]
-            bytecode = contract_definition.get("bytecode")
-        elif isinstance(contract_definition, list):
-            abi = contract_definition
-        else:
-            raise AssertionError(f'Unrecognized abi file content of type {type(contract_definition)}.')
+_contract_definitions = {}
 
 
-        contract = get_web3().eth.contract(
-            address=address, abi=abi, bytecode=bytecode
-        )
-        if contract.address is None:  # if web3 drops address, fix it
-            contract.address = address
-        assert contract.address is not None
-        return contract
+def load_contract_definition(filename):
+    """Parsed content of an ABI file, read once per process."""
+    path = os.path.abspath(filename)
+    if path not in _contract_definitions:
+        with open(path) as f:
+            _contract_definitions[path] = json.loads(f.read())
+    return _contract_definitions[path]
+
+
+def load_contract(filename, address):
+    contract_definition = load_contract_definition(filename)
+    if not address and "address" in contract_definition:
+        address = contract_definition.get("address")
+        assert address, "Cannot find contract address in the abi file."
+        address = get_web3().toChecksumAddress(address)
+    assert address is not None, "address shouldn't be None at this point"
+
+    bytecode = None
+    if isinstance(contract_definition, dict):
+        abi = contract_definition["abi"]
+        bytecode = contract_definition.get("bytecode")
+    elif isinstance(contract_definition, list):
+        abi = contract_definition
+    else:
+        raise AssertionError(f'Unrecognized abi file content of type {type(contract_definition)}.')
+
+    contract = get_web3().eth.contract(
+        address=address, abi=abi, bytecode=bytecode
+    )
+    if contract.address is None:  # if web3 drops address, fix it
+        contract.address = address
+    assert contract.address is not None
+    return contract
 
 
 def read_abi_from_file(contract_name, abi_path):
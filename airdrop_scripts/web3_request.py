@@ -30,6 +30,13 @@ def _get_session(*args, **kwargs):
     return _session_cache[cache_key]
 
 
+def reset_sessions():
+    """Forget the sessions without closing them, in a process forked from the one that made them:
+    their connections belong to the parent."""
+    global _session_cache
+    _session_cache = lru.LRU(8, callback=_remove_session)
+
+
 def make_post_request(endpoint_uri, data, *args, **kwargs):
     kwargs.setdefault("timeout", 10)
     session = _get_session(endpoint_uri)